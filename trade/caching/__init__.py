@@ -4,19 +4,40 @@ from django.conf import settings
 from django.core.cache import cache
 from django.utils.encoding import smart_str
 import cPickle as pickle
-import types
+import Queue
+import threading
+import time
 import logging
 
 from django.utils.hashcompat import md5_constructor
 
-from trade.utils import is_string_like, is_list_or_tuple
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+from trade.caching.nodes import MultiNodeCache
+from trade.caching.registry import KeyRegistry
+from trade.caching.serializers import get_codec
+from trade.caching.stats import CacheStats
 
 log = logging.getLogger('caching')
 
-CACHED_KEYS = {}
+CACHED_KEYS = KeyRegistry(getattr(settings, 'CACHE_KEY_REGISTRY_SIZE', 10000))
 CACHE_CALLS = 0
 CACHE_HITS = 0
+# key prefix -> bytes written under it, see _record_size
+CACHE_SIZES = {}
 KEY_DELIM = "::"
+GENERATION_KEY = "__generation__"
+LOCK_KEY = "__lock__"
+# keys removed per backend call when deleting many
+DELETE_BATCH = 100
+STALE_KEY = "__stale__"
+LOCK_TIMEOUT = getattr(settings, 'CACHE_LOCK_TIMEOUT', 30)
+LOCK_WAIT = getattr(settings, 'CACHE_LOCK_WAIT', 5)
+REFRESH_THREADS = getattr(settings, 'CACHE_REFRESH_THREADS', 2)
+NAMESPACE_TIMEOUT = getattr(settings, 'CACHE_NAMESPACE_TIMEOUT', 60*60*24*30)
 try:
     CACHE_PREFIX = settings.CACHE_PREFIX
 except AttributeError:
@@ -25,10 +46,122 @@ except AttributeError:
 
 _CACHE_ENABLED = settings.CACHE_TIMEOUT > 0
 
+if getattr(settings, 'CACHE_NODES', None):
+    cache = MultiNodeCache(settings.CACHE_NODES,
+        retry_after=getattr(settings, 'CACHE_NODE_RETRY', 30))
+
+class LocalLRUCache(object):
+    """A bounded, in-process LRU cache with a per-entry timeout.
+
+    Sits in front of the Django cache backend so hot keys can be served
+    without a network round trip.  A ``size`` of 0 disables it.  Entries are
+    kept pickled, like the backend keeps them, so every ``get`` returns a
+    copy a caller can change without affecting the others.
+    """
+
+    def __init__(self, size=0, timeout=0):
+        self.size = size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        # key -> (expires, pickled wrapper), least recently used first
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def enabled(self):
+        return self.size > 0 and self.timeout > 0
+
+    def get(self, key):
+        """Return the stored wrapper for ``key``, or None on a miss."""
+        if not self.enabled():
+            return None
+
+        self._lock.acquire()
+        try:
+            entry = self._data.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                self._data[key] = entry
+                self.hits += 1
+            else:
+                entry = None
+                self.misses += 1
+        finally:
+            self._lock.release()
+
+        if entry is not None:
+            return pickle.loads(entry[1])
+        return None
+
+    def set(self, key, obj, length=None):
+        if not self.enabled():
+            return
+
+        timeout = self.timeout
+        if length:
+            timeout = min(timeout, length)
+
+        try:
+            data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError), e:
+            log.debug("Not keeping %s in the local cache: %s", key, e)
+            self.delete(key)
+            return
+
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + timeout, data)
+            while len(self._data) > self.size:
+                del self._data[self._data.iterkeys().next()]
+        finally:
+            self._lock.release()
+
+    def delete(self, key, children=False):
+        """Remove ``key`` and optionally every key below it."""
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            if children:
+                key = key + KEY_DELIM
+                for k in [x for x in self._data if x.startswith(key)]:
+                    del self._data[k]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data = OrderedDict()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+CODEC = get_codec()
+
+STATS = CacheStats(CACHE_PREFIX + KEY_DELIM + '__stats__', cache,
+    enabled=getattr(settings, 'CACHE_STATS', True),
+    flush_interval=getattr(settings, 'CACHE_STATS_FLUSH_INTERVAL', 5))
+
+L1_CACHE = LocalLRUCache(
+    size=getattr(settings, 'CACHE_L1_SIZE', 0),
+    timeout=getattr(settings, 'CACHE_L1_TIMEOUT', 0))
+
 class CacheWrapper(object):
-    def __init__(self, val, inprocess=False):
+    # wrappers pickled before soft timeouts existed have no such attribute
+    fresh_until = None
+    # name of the codec ``val`` was encoded with, None for a plain value;
+    # only set on wrappers stored by older versions, see _encode
+    codec = None
+
+    def __init__(self, val, inprocess=False, fresh_until=None):
         self.val = val
         self.inprocess = inprocess
+        self.fresh_until = fresh_until
+
+    def is_stale(self):
+        return self.fresh_until is not None and self.fresh_until < time.time()
 
     def __str__(self):
         return str(self.val)
@@ -59,26 +192,31 @@ class CacheNotRespondingError(Exception):
 def cache_delete(*keys, **kwargs):
     removed = []
     if cache_enabled():
-        global CACHED_KEYS
         log.debug('cache_delete')
         children = kwargs.pop('children',False)
 
         if (keys or kwargs):
             key = cache_key(*keys, **kwargs)
 
-            if CACHED_KEYS.has_key(key):
-                del CACHED_KEYS[key]
+            if CACHED_KEYS.discard(key):
                 removed.append(key)
 
             cache.delete(key)
+            L1_CACHE.delete(key, children=children)
 
             if children:
+                if _namespace_bump(key) is not None and key not in removed:
+                    removed.append(key)
+
+                # keys that were not stored under a namespace are only
+                # known to this process
                 key = key + KEY_DELIM
-                children = [x for x in CACHED_KEYS.keys() if x.startswith(key)]
-                for k in children:
-                    del CACHED_KEYS[k]
-                    cache.delete(k)
-                    removed.append(k)
+                while True:
+                    batch = CACHED_KEYS.pop_children(key, DELETE_BATCH)
+                    if not batch:
+                        break
+                    cache.delete_many(batch)
+                    removed.extend(batch)
         else:
             key = "All Keys"
             deleteneeded = _cache_flush_all()
@@ -86,10 +224,11 @@ def cache_delete(*keys, **kwargs):
             removed = CACHED_KEYS.keys()
 
             if deleteneeded:
-                for k in CACHED_KEYS:
-                    cache.delete(k)
+                for i in range(0, len(removed), DELETE_BATCH):
+                    cache.delete_many(removed[i:i + DELETE_BATCH])
 
-            CACHED_KEYS = {}
+            CACHED_KEYS.clear()
+            L1_CACHE.clear()
 
         if removed:
             log.debug("Cache delete: %s", removed)
@@ -100,7 +239,116 @@ def cache_delete(*keys, **kwargs):
 
 
 def cache_delete_function(func):
-    return cache_delete(['func', func.__name__, func.__module__], children=True)
+    if not cache_enabled():
+        return []
+    return cache_namespace_bump('func', func.__name__, func.__module__)
+
+def cache_namespace(*keys):
+    """Return the versioned key prefix for the namespace named by ``keys``.
+
+    Keys built on top of the returned prefix are invalidated all at once,
+    in every process, by ``cache_namespace_bump``.  Other processes see the
+    bump once their local copy of the generation expires, so at most
+    CACHE_L1_TIMEOUT seconds later.
+    """
+    return _namespace(cache_key(keys))
+
+def cache_namespace_get(namespace, *keys, **kwargs):
+    """``cache_get`` of ``keys`` under ``cache_namespace(*namespace)``.
+
+    Once this process has seen the namespace, its generation and the value
+    are fetched together with one backend call, instead of one call for
+    each, whether or not the local cache is on."""
+    use_default = kwargs.has_key('default')
+    default_value = kwargs.pop('default', None)
+
+    def make_key(prefix):
+        return cache_key([prefix] + list(keys), **kwargs)
+
+    if not cache_enabled():
+        raise NotCachedError(make_key(cache_key(namespace)))
+
+    key, obj = _namespace_lookup(cache_key(namespace), make_key)
+    if obj is None:
+        if use_default:
+            return default_value
+        raise NotCachedError(key)
+    if obj.inprocess:
+        raise MethodNotFinishedError(obj.val)
+    return obj.val
+
+# namespace base -> the last generation this process saw, to fetch with
+# the value and compare; never trusted on its own
+_GENERATIONS = {}
+
+def _namespace_lookup(base, make_key):
+    """The key ``make_key`` builds on the namespace ``base`` and the
+    CacheWrapper stored at it, or None."""
+    gen = _GENERATIONS.get(base)
+    if gen is not None and not L1_CACHE.enabled():
+        genkey = base + KEY_DELIM + GENERATION_KEY
+        key = make_key(_generation_prefix(base, gen))
+        found = cache.get_many([genkey, key])
+        if found.get(genkey) == gen:
+            return key, _cache_get_wrapper(key, found.get(key))
+        # bumped or evicted since: look the generation up again
+
+    key = make_key(_namespace(base))
+    return key, _cache_get_wrapper(key)
+
+def _namespace(base):
+    if not cache_enabled():
+        return base
+
+    genkey = base + KEY_DELIM + GENERATION_KEY
+    obj = L1_CACHE.get(genkey)
+    if obj is not None:
+        gen = obj.val
+    else:
+        gen = cache.get(genkey)
+        if gen is None:
+            gen = _new_generation()
+            if not cache.add(genkey, gen, NAMESPACE_TIMEOUT):
+                gen = cache.get(genkey, gen)
+        L1_CACHE.set(genkey, CacheWrapper(gen))
+
+    _remember_generation(base, gen)
+    return _generation_prefix(base, gen)
+
+def _generation_prefix(base, gen):
+    return "%s%sg%s" % (base, KEY_DELIM, gen)
+
+def _remember_generation(base, gen):
+    if len(_GENERATIONS) >= CACHED_KEYS.size:
+        _GENERATIONS.clear()
+    _GENERATIONS[base] = gen
+
+def cache_namespace_bump(*keys):
+    """Invalidate every key stored under the namespace named by ``keys``."""
+    base = cache_key(keys)
+    removed = []
+    if cache_enabled() and _namespace_bump(base) is not None:
+        removed.append(base)
+        log.debug("Cache namespace bumped: %s", base)
+    return removed
+
+def _namespace_bump(base):
+    genkey = base + KEY_DELIM + GENERATION_KEY
+    L1_CACHE.delete(base, children=True)
+    try:
+        gen = cache.incr(genkey)
+    except ValueError:
+        # never used as a namespace, or evicted: there is nothing to bump
+        # and the next cache_namespace call starts a fresh generation.
+        return None
+    L1_CACHE.set(genkey, CacheWrapper(gen))
+    _remember_generation(base, gen)
+    return gen
+
+def _new_generation():
+    # Time based, so a generation key lost to eviction does not come back
+    # with a value that was already used.
+    return int(time.time() * 1000)
 
 def cache_enabled():
     global _CACHE_ENABLED
@@ -111,12 +359,17 @@ def cache_enable(state=True):
     _CACHE_ENABLED=state
 
 def _cache_flush_all():
+    if is_multinode_backend():
+        cache.flush_all()
+        return False
     if is_memcached_backend():
         cache._cache.flush_all()
         return False
     return True
 
-def cache_function(length=settings.CACHE_TIMEOUT):
+def cache_function(length=settings.CACHE_TIMEOUT, single_flight=False,
+        lock_timeout=LOCK_TIMEOUT, wait=LOCK_WAIT, soft_length=None,
+        background=False):
     """
     A variant of the snippet posted by Jeff Wheeler at
     http://www.djangosnippets.org/snippets/109/
@@ -133,34 +386,167 @@ def cache_function(length=settings.CACHE_TIMEOUT):
     threads, you won't be able to get the previous value, and will need to
     wait until the function finishes. If this is not desired behavior, you can
     remove the first two lines after the ``else``.
+
+    With ``single_flight`` only one caller at a time computes the value,
+    holding a lock key taken with ``add`` that expires after
+    ``lock_timeout`` seconds.  The others get the previous value if one is
+    still around, otherwise they poll for the new one with backoff for up to
+    ``wait`` seconds before giving up and calling the function themselves.
+
+    With ``soft_length`` a value is considered fresh for that many seconds
+    and then served stale, up to ``length``, while a single caller refreshes
+    it: inline, or on a background thread when ``background`` is set.
     """
     def decorator(func):
+        base = cache_key('func', func.__name__, func.__module__)
+
         def inner_func(*args, **kwargs):
             if not cache_enabled():
                 value = func(*args, **kwargs)
 
             else:
-                try:
-                    value = cache_get('func', func.__name__, func.__module__, args, kwargs)
+                key, obj = _namespace_lookup(base,
+                    lambda namespace: cache_key(namespace, args, kwargs))
+                if soft_length:
+                    return _soft_cached(key, obj, func, args, kwargs, length,
+                        soft_length, background, single_flight, lock_timeout, wait)
 
-                except NotCachedError, e:
+                if obj is not None and not obj.inprocess:
+                    value = obj.val
+
+                elif obj is not None:
+                    # another caller is still computing it
+                    value = func(*args, **kwargs)
+
+                elif single_flight:
+                    return _single_flight(key, func, args, kwargs,
+                        length, lock_timeout, wait)
+
+                else:
                     # This will set a temporary value while ``func`` is being
                     # processed. When using threads, this is vital, as otherwise
                     # the function can be called several times before it finishes
                     # and is put into the cache.
                     funcwrapper = CacheWrapper(".".join([func.__module__, func.__name__]), inprocess=True)
-                    cache_set(e.key, value=funcwrapper, length=length, skiplog=True)
-                    value = func(*args, **kwargs)
-                    cache_set(e.key, value=value, length=length)
-
-                except MethodNotFinishedError, e:
+                    cache_set(key, value=funcwrapper, length=length, skiplog=True)
                     value = func(*args, **kwargs)
+                    cache_set(key, value=value, length=length)
 
             return value
+        # cache_delete_function finds the namespace by name and module
+        inner_func.__name__ = func.__name__
+        inner_func.__module__ = func.__module__
+        inner_func.__doc__ = func.__doc__
         return inner_func
     return decorator
 
 
+def _soft_cached(key, obj, func, args, kwargs, length, soft_length, background,
+        single_flight, lock_timeout, wait):
+    if obj is None or obj.inprocess:
+        if single_flight:
+            return _single_flight(key, func, args, kwargs, length, lock_timeout,
+                wait, soft_length=soft_length)
+        obj = _fresh_wrapper(func(*args, **kwargs), soft_length)
+        cache_set(key, value=obj, length=length)
+        return obj.val
+
+    if obj.is_stale():
+        lockkey = key + KEY_DELIM + LOCK_KEY
+        if cache.add(lockkey, 1, lock_timeout):
+            log.debug("Refreshing stale %s", key)
+            if background:
+                _refresh_queue().put((key, func, args, kwargs, length, soft_length))
+            else:
+                obj = _refresh(key, func, args, kwargs, length, soft_length)
+
+    return obj.val
+
+def _fresh_wrapper(value, soft_length):
+    return CacheWrapper(value, fresh_until=time.time() + soft_length)
+
+def _refresh(key, func, args, kwargs, length, soft_length):
+    """Recompute a stale value and release the lock taken for it."""
+    try:
+        obj = _fresh_wrapper(func(*args, **kwargs), soft_length)
+        cache_set(key, value=obj, length=length)
+    finally:
+        cache.delete(key + KEY_DELIM + LOCK_KEY)
+    return obj
+
+_REFRESH_QUEUE = None
+_REFRESH_LOCK = threading.Lock()
+
+def _refresh_queue():
+    """Return the queue feeding the background refresh threads, starting
+    them on first use."""
+    global _REFRESH_QUEUE
+    if _REFRESH_QUEUE is None:
+        _REFRESH_LOCK.acquire()
+        try:
+            if _REFRESH_QUEUE is None:
+                queue = Queue.Queue()
+                for x in range(0, REFRESH_THREADS):
+                    t = threading.Thread(target=_refresh_worker, args=(queue,),
+                        name='cache-refresh-%i' % x)
+                    t.setDaemon(True)
+                    t.start()
+                _REFRESH_QUEUE = queue
+        finally:
+            _REFRESH_LOCK.release()
+    return _REFRESH_QUEUE
+
+def _refresh_worker(queue):
+    while True:
+        job = queue.get()
+        try:
+            _refresh(*job)
+        except Exception, e:
+            log.error("Background refresh of %s failed: %s", job[0], e)
+
+def _single_flight(key, func, args, kwargs, length, lock_timeout, wait,
+        soft_length=None):
+    lockkey = key + KEY_DELIM + LOCK_KEY
+    stalekey = key + KEY_DELIM + STALE_KEY
+
+    if not cache.add(lockkey, 1, lock_timeout):
+        try:
+            return cache_get(stalekey)
+        except NotCachedError:
+            pass
+
+        delay = 0.05
+        waited = 0
+        while waited < wait:
+            time.sleep(delay)
+            waited += delay
+            delay = min(delay * 2, 1)
+            try:
+                return cache_get(key)
+            except (NotCachedError, MethodNotFinishedError):
+                pass
+            if cache.get(lockkey) is None and cache.add(lockkey, 1, lock_timeout):
+                # the previous holder gave up without storing a value
+                break
+        else:
+            log.debug("Gave up waiting for %s after %.2f seconds", key, waited)
+            return func(*args, **kwargs)
+
+    try:
+        value = func(*args, **kwargs)
+        if soft_length:
+            # stale values are served from the entry itself
+            cache_set(key, value=_fresh_wrapper(value, soft_length), length=length)
+        else:
+            cache_set(key, value=value, length=length)
+            # outlives the value by the lock timeout, so callers waiting on
+            # the next computation can be answered right away
+            cache_set(stalekey, value=value, length=length + lock_timeout, skiplog=True)
+    finally:
+        cache.delete(lockkey)
+    return value
+
+
 def cache_get(*keys, **kwargs):
     if kwargs.has_key('default'):
         default_value = kwargs.pop('default')
@@ -173,36 +559,55 @@ def cache_get(*keys, **kwargs):
     if not cache_enabled():
         raise NotCachedError(key)
     else:
-        global CACHE_CALLS, CACHE_HITS
-        CACHE_CALLS += 1
-        if CACHE_CALLS == 1:
-            cache_require()
-
-        obj = cache.get(key)
-        if obj and isinstance(obj, CacheWrapper):
-            CACHE_HITS += 1
-            CACHED_KEYS[key] = True
-            log.debug('got cached [%i/%i]: %s', CACHE_CALLS, CACHE_HITS, key)
-            if obj.inprocess:
-                raise MethodNotFinishedError(obj.val)
-
-            return obj.val
-        else:
-            try:
-                del CACHED_KEYS[key]
-            except KeyError:
-                pass
-
+        obj = _cache_get_wrapper(key)
+        if obj is None:
             if use_default:
                 return default_value
 
             raise NotCachedError(key)
 
+        if obj.inprocess:
+            raise MethodNotFinishedError(obj.val)
+
+        return obj.val
+
+_UNFETCHED = object()
+
+def _cache_get_wrapper(key, stored=_UNFETCHED):
+    """Return the CacheWrapper stored at ``key``, or None.  ``stored`` is
+    what the backend returned for it, when already fetched."""
+    global CACHE_CALLS, CACHE_HITS
+    CACHE_CALLS += 1
+    if CACHE_CALLS == 1:
+        cache_require()
+
+    start = time.time()
+    if stored is _UNFETCHED:
+        obj = L1_CACHE.get(key)
+        if obj is not None:
+            CACHE_HITS += 1
+            STATS.record_get(_stats_prefix(key), True, time.time() - start)
+            return obj
+        stored = cache.get(key)
+
+    obj = _decode(key, stored)
+    if obj and isinstance(obj, CacheWrapper):
+        CACHE_HITS += 1
+        CACHED_KEYS.add(key)
+        log.debug('got cached [%i/%i]: %s', CACHE_CALLS, CACHE_HITS, key)
+        if not obj.inprocess:
+            L1_CACHE.set(key, obj)
+    else:
+        obj = None
+        CACHED_KEYS.discard(key)
+
+    STATS.record_get(_stats_prefix(key), obj is not None, time.time() - start)
+    return obj
+
 
 def cache_set(*keys, **kwargs):
     """Set an object into the cache."""
     if cache_enabled():
-        global CACHED_KEYS
         obj = kwargs.pop('value')
         length = kwargs.pop('length', settings.CACHE_TIMEOUT)
         skiplog = kwargs.pop('skiplog', False)
@@ -211,20 +616,207 @@ def cache_set(*keys, **kwargs):
         val = CacheWrapper.wrap(obj)
         if not skiplog:
             log.debug('setting cache: %s', key)
-        cache.set(key, val, length)
-        CACHED_KEYS[key] = True
+        start = time.time()
+        stored = _encode(key, val)
+        cache.set(key, stored, length)
+        STATS.record_set(_stats_prefix(key), time.time() - start)
+        CACHED_KEYS.add(key)
+        if val.inprocess:
+            L1_CACHE.delete(key)
+        else:
+            L1_CACHE.set(key, val, length)
+
+
+def cache_get_many(keylist):
+    """Look up several objects with a single backend call.
+
+    ``keylist`` is a list of keys, each one what would be passed to
+    ``cache_get``.  Returns a dict mapping the derived key of every hit to
+    its value; misses are simply absent.
+    """
+    found = {}
+    if not cache_enabled() or not keylist:
+        return found
+
+    global CACHE_CALLS, CACHE_HITS
+    first = CACHE_CALLS == 0
+    CACHE_CALLS += len(keylist)
+    if first:
+        cache_require()
+
+    keys = []
+    for k in keylist:
+        key = cache_key(k)
+        obj = L1_CACHE.get(key)
+        if obj is not None:
+            CACHE_HITS += 1
+            found[key] = obj.val
+        else:
+            keys.append(key)
+
+    if keys:
+        start = time.time()
+        objs = cache.get_many(keys)
+        elapsed = (time.time() - start) / len(keys)
+        for key in keys:
+            obj = _decode(key, objs.get(key))
+            if obj and isinstance(obj, CacheWrapper) and not obj.inprocess:
+                CACHE_HITS += 1
+                CACHED_KEYS.add(key)
+                L1_CACHE.set(key, obj)
+                found[key] = obj.val
+            else:
+                CACHED_KEYS.discard(key)
+            STATS.record_get(_stats_prefix(key), key in found, elapsed)
 
+    log.debug('got cached many [%i/%i]: %i of %i keys', CACHE_CALLS, CACHE_HITS, len(found), len(keylist))
+    return found
 
+def cache_set_many(items, length=settings.CACHE_TIMEOUT):
+    """Set several objects into the cache with a single backend call.
+
+    ``items`` is a dict or a list of (key, value) pairs, where each key is
+    what would be passed to ``cache_set``.
+    """
+    if cache_enabled():
+        if hasattr(items, 'items'):
+            items = items.items()
+
+        data = {}
+        for k, obj in items:
+            data[cache_key(k)] = CacheWrapper.wrap(obj)
+
+        if data:
+            log.debug('setting cache many: %s', data.keys())
+            start = time.time()
+            stored = dict([(key, _encode(key, val)) for key, val in data.items()])
+            cache.set_many(stored, length)
+            elapsed = (time.time() - start) / len(stored)
+            for key in stored:
+                STATS.record_set(_stats_prefix(key), elapsed)
+            for key, val in data.items():
+                CACHED_KEYS.add(key)
+                L1_CACHE.set(key, val, length)
+
+
+# starts the strings _encode stores, followed by "codec|fresh_until|data"
+ENCODED_PREFIX = '\x00tc\x00'
+
+def _encode(key, val):
+    """Return what to store in the backend for the CacheWrapper ``val``.
+
+    Encoded values are stored as a plain string, which memcached keeps as
+    is instead of pickling the value a second time."""
+    if val.inprocess:
+        return val
+
+    codec, data, size = CODEC.dumps(val.val)
+    _record_size(key, len(data), size)
+    if val.fresh_until is None:
+        fresh_until = ''
+    else:
+        fresh_until = repr(val.fresh_until)
+    return '%s%s|%s|%s' % (ENCODED_PREFIX, codec, fresh_until, data)
+
+def _decode(key, obj):
+    """Return the CacheWrapper for what ``_encode`` stored, or None."""
+    if type(obj) is str and obj.startswith(ENCODED_PREFIX):
+        codec, fresh_until, data = obj[len(ENCODED_PREFIX):].split('|', 2)
+        fresh_until = fresh_until and float(fresh_until) or None
+    elif isinstance(obj, CacheWrapper) and obj.codec is not None:
+        codec, fresh_until, data = obj.codec, obj.fresh_until, obj.val
+    else:
+        return obj
+
+    try:
+        val = CODEC.loads(codec, data)
+    except Exception, e:
+        log.warn("Could not decode cached %s: %s", key, e)
+        return None
+    return CacheWrapper(val, fresh_until=fresh_until)
+
+def _stats_prefix(key):
+    """The part of ``key`` statistics are grouped by."""
+    parts = key[len(_KEY_PREFIX):].split(KEY_DELIM, 2)
+    if parts[0] == 'func' and len(parts) > 1:
+        return KEY_DELIM.join(parts[:2])
+    return parts[0]
+
+def _record_size(key, stored, raw):
+    prefix = _stats_prefix(key)
+    sizes = CACHE_SIZES.get(prefix)
+    if sizes is None:
+        sizes = CACHE_SIZES[prefix] = {'prefix' : prefix, 'sets' : 0,
+            'bytes' : 0, 'raw_bytes' : 0, 'largest' : 0}
+    STATS.record_size(prefix, stored, raw)
+    sizes['sets'] += 1
+    sizes['bytes'] += stored
+    sizes['raw_bytes'] += raw
+    if stored > sizes['largest']:
+        sizes['largest'] = stored
+
+# types whose string form is used as is in a key
+_SCALAR_TYPES = frozenset([str, unicode, int, long, float, bool])
+# types whose repr() is stable enough to hash instead of pickling
+_REPR_TYPES = _SCALAR_TYPES | frozenset([type(None)])
 
 def _hash_or_string(key):
-    if is_string_like(key) or isinstance(key, (types.IntType, types.LongType, types.FloatType)):
+    t = type(key)
+    if t is str:
+        return key
+    if t in _SCALAR_TYPES or isinstance(key, basestring):
         return smart_str(key)
+    if t is tuple or t is list:
+        return _hash_sequence(key)
+    if t is dict:
+        return _hash_dict(key)
+
+    #if it has a PK, use it.
+    get_pk = getattr(key, '_get_pk_val', None)
+    if get_pk is not None:
+        return str(get_pk())
+    return md5_hash(key)
+
+def _hash_sequence(seq):
+    """Hash a tuple or list of scalars and model instances without pickling
+    it, falling back to ``md5_hash`` for anything else."""
+    if not seq:
+        return _EMPTY_HASHES[type(seq)]
+
+    parts = []
+    for x in seq:
+        part = _repr_part(x)
+        if part is None:
+            return md5_hash(seq)
+        parts.append(part)
+
+    if type(seq) is tuple:
+        rep = '(%s)' % ','.join(parts)
     else:
-        try:
-            #if it has a PK, use it.
-            return str(key._get_pk_val())
-        except AttributeError:
-            return md5_hash(key)
+        rep = '[%s]' % ','.join(parts)
+    return md5_constructor(rep).hexdigest()
+
+def _hash_dict(d):
+    """Hash a dict of scalar keys to scalars and model instances, in key
+    order, the same way ``_hash_sequence`` does."""
+    if not d:
+        return _EMPTY_DICT_HASH
+
+    parts = []
+    for k, v in sorted(d.items()):
+        part = _repr_part(v)
+        if type(k) not in _REPR_TYPES or part is None:
+            return md5_hash(d)
+        parts.append('%r:%s' % (k, part))
+    return md5_constructor('{%s}' % ','.join(parts)).hexdigest()
+
+def _repr_part(x):
+    if type(x) in _REPR_TYPES:
+        return repr(x)
+    get_pk = getattr(x, '_get_pk_val', None)
+    if get_pk is None:
+        return None
+    return '%s:%r' % (x.__class__.__name__, get_pk())
 
 def cache_contains(*keys, **kwargs):
     key = cache_key(keys, **kwargs)
@@ -234,33 +826,33 @@ def cache_key(*keys, **pairs):
     """Smart key maker, returns the object itself if a key, else a list
     delimited by ':', automatically hashing any non-scalar objects."""
 
-    if is_string_like(keys):
-        keys = [keys]
-
-    if is_list_or_tuple(keys):
-        if len(keys) == 1 and is_list_or_tuple(keys[0]):
-            keys = keys[0]
-    else:
-        keys = [md5_hash(keys)]
+    if len(keys) == 1 and isinstance(keys[0], (tuple, list)):
+        keys = keys[0]
 
     if pairs:
         keys = list(keys)
-        klist = pairs.keys()
-        klist.sort()
-        for k in klist:
+        for k in sorted(pairs):
             keys.append(k)
             keys.append(pairs[k])
 
     key = KEY_DELIM.join([_hash_or_string(x) for x in keys])
-    prefix = CACHE_PREFIX + KEY_DELIM
-    if not key.startswith(prefix):
-        key = prefix+key
-    return key.replace(" ", ".")
+    if not key.startswith(_KEY_PREFIX):
+        key = _KEY_PREFIX + key
+    if ' ' in key:
+        key = key.replace(" ", ".")
+    return key
 
 def md5_hash(obj):
     pickled = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
     return md5_constructor(pickled).hexdigest()
 
+_KEY_PREFIX = CACHE_PREFIX + KEY_DELIM
+_EMPTY_HASHES = {
+    tuple : md5_constructor('()').hexdigest(),
+    list : md5_constructor('[]').hexdigest(),
+}
+_EMPTY_DICT_HASH = md5_constructor('{}').hexdigest()
+
 
 def is_memcached_backend():
     try:
@@ -268,11 +860,21 @@ def is_memcached_backend():
     except AttributeError:
         return False
 
+def is_multinode_backend():
+    return isinstance(cache, MultiNodeCache)
+
 def cache_require():
-    """Error if caching isn't running."""
+    """Error if caching isn't running.
+
+    With several nodes, the ones not responding are marked down and it is an
+    error only when none is left."""
     if cache_enabled():
+        if is_multinode_backend() and not cache.check():
+            raise CacheNotRespondingError()
         key = cache_key('require_cache')
         cache_set(key,value='1')
+        # make sure the answer comes from the backend, not the local tier
+        L1_CACHE.delete(key)
         v = cache_get(key, default = '0')
         if v != '1':
             raise CacheNotRespondingError()
@@ -0,0 +1,215 @@
+"""Benchmarks for the caching layer.
+
+Run them with ``manage.py cache_benchmark``.
+"""
+
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+import time
+import timeit
+import types
+
+from django.core.cache import get_cache
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+
+from trade import caching
+from trade.utils import is_string_like, is_list_or_tuple
+
+def legacy_cache_key(*keys, **pairs):
+    """``cache_key`` as it was before keys were built without pickling,
+    kept to measure the new one against."""
+
+    def md5_hash(obj):
+        pickled = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        return md5_constructor(pickled).hexdigest()
+
+    def _hash_or_string(key):
+        if is_string_like(key) or isinstance(key, (types.IntType, types.LongType, types.FloatType)):
+            return smart_str(key)
+        else:
+            try:
+                return str(key._get_pk_val())
+            except AttributeError:
+                return md5_hash(key)
+
+    if is_string_like(keys):
+        keys = [keys]
+
+    if is_list_or_tuple(keys):
+        if len(keys) == 1 and is_list_or_tuple(keys[0]):
+            keys = keys[0]
+    else:
+        keys = [md5_hash(keys)]
+
+    if pairs:
+        keys = list(keys)
+        klist = pairs.keys()
+        klist.sort()
+        for k in klist:
+            keys.append(k)
+            keys.append(pairs[k])
+
+    key = caching.KEY_DELIM.join([_hash_or_string(x) for x in keys])
+    prefix = caching.CACHE_PREFIX + caching.KEY_DELIM
+    if not key.startswith(prefix):
+        key = prefix+key
+    return key.replace(" ", ".")
+
+class _FakeModel(object):
+    """Stands in for a model instance, which only needs a primary key."""
+
+    def __init__(self, pk):
+        self.pk = pk
+        self.name = 'x' * 200
+
+    def _get_pk_val(self):
+        return self.pk
+
+# name -> (args, kwargs) typical of the calls made by the site
+KEY_CASES = (
+    ('strings', (('product', 'bicicleta-roja'), {})),
+    ('string and int', (('product', 1234), {})),
+    ('kwargs', (('product', 3), {'page': 2, 'order': 'name'})),
+    ('function, no args', (('T::func::listing::trade.product::g1', (), {}), {})),
+    ('function, scalar args', (('T::func::listing::trade.product::g1', (1, u'bici', 2.5), {}), {})),
+    ('model instance', (('Product', _FakeModel(7)), {})),
+    ('tuple of models', (('related', (_FakeModel(1), _FakeModel(2))), {})),
+    ('function, dict kwargs', (('T::func::search::trade.product::g1', (u'bici',),
+        {'page': 2, 'order': 'name', 'category': _FakeModel(3)}), {})),
+)
+
+def bench_cache_key(number=20000, repeat=3):
+    """Time ``cache_key`` against ``legacy_cache_key`` for each of
+    KEY_CASES.  Returns a list of dicts with the best time per call in
+    microseconds for both, and the speedup."""
+    results = []
+    for name, (args, kwargs) in KEY_CASES:
+        new = min(timeit.repeat(lambda: caching.cache_key(*args, **kwargs),
+            number=number, repeat=repeat))
+        old = min(timeit.repeat(lambda: legacy_cache_key(*args, **kwargs),
+            number=number, repeat=repeat))
+        results.append({
+            'case' : name,
+            'legacy_us' : old / number * 1e6,
+            'current_us' : new / number * 1e6,
+            'speedup' : old / new,
+        })
+    return results
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    """The given percentiles of ``samples``, as a dict keyed 'p50' etc."""
+    ordered = sorted(samples)
+    result = {}
+    for p in points:
+        if ordered:
+            i = min(int(round(len(ordered) * p / 100.0)), len(ordered)) - 1
+            result['p%i' % p] = ordered[max(i, 0)]
+        else:
+            result['p%i' % p] = None
+    return result
+
+def _measure(name, calls):
+    """Time each of ``calls`` separately.  Returns ops/sec over the whole
+    run and latency percentiles in microseconds."""
+    samples = []
+    start = time.time()
+    for call in calls:
+        t = time.time()
+        call()
+        samples.append((time.time() - t) * 1e6)
+    total = time.time() - start
+
+    row = {'operation' : name, 'ops' : len(samples),
+        'ops_per_sec' : total and len(samples) / total or None}
+    row.update(percentiles(samples))
+    return row
+
+def available_backends(memcached=None):
+    """(name, backend) pairs to benchmark against: locmem, file and, when
+    one answers at ``memcached`` ('host:port'), memcached."""
+    tmpdir = tempfile.mkdtemp(prefix='cache_benchmark')
+    backends = [
+        ('locmem', get_cache('locmem://')),
+        ('file', get_cache('file://%s' % tmpdir)),
+    ]
+    if memcached:
+        try:
+            mc = get_cache('memcached://%s/' % memcached)
+            mc.set('cache_benchmark', 1)
+            if mc.get('cache_benchmark') == 1:
+                backends.append(('memcached', mc))
+        except Exception:
+            pass
+    return backends, tmpdir
+
+def _use_backend(backend):
+    """Point trade.caching at ``backend``, with the local tier off so the
+    backend is what gets measured.  Returns what ``_restore`` needs."""
+    saved = (caching.cache, caching.STATS.backend, caching.L1_CACHE)
+    caching.cache = backend
+    caching.STATS.backend = backend
+    caching.L1_CACHE = caching.LocalLRUCache()
+    return saved
+
+def _restore(saved):
+    caching.cache, caching.STATS.backend, caching.L1_CACHE = saved
+
+def _bench_function(a):
+    return a
+
+def bench_backend(backend, keycount, size):
+    """Run cache_set, cache_get, cache_function and cache_delete with
+    children for ``keycount`` keys holding ``size`` byte values."""
+    payload = 'x' * size
+    results = []
+    keys = range(0, keycount)
+    cached = caching.cache_function(600)(_bench_function)
+
+    saved = _use_backend(backend)
+    try:
+        results.append(_measure('cache_set',
+            [lambda i=i: caching.cache_set('bench', i, value=payload) for i in keys]))
+        results.append(_measure('cache_get',
+            [lambda i=i: caching.cache_get('bench', i) for i in keys]))
+        results.append(_measure('cache_get miss',
+            [lambda i=i: caching.cache_get('bench-miss', i, default=None) for i in keys]))
+
+        caching.cache_delete_function(cached)
+        results.append(_measure('cache_function miss', [lambda i=i: cached(i) for i in keys]))
+        results.append(_measure('cache_function hit', [lambda i=i: cached(i) for i in keys]))
+
+        caching.cache_set_many([(('bench-del', i), payload) for i in keys])
+        row = _measure('cache_delete children', [lambda: caching.cache_delete('bench-del', children=True)])
+        row['keys_per_sec'] = row['ops_per_sec'] and row['ops_per_sec'] * keycount
+        results.append(row)
+
+        caching.cache_delete('bench', children=True)
+    finally:
+        _restore(saved)
+    return results
+
+def run_suite(keycounts=(100, 1000, 10000), sizes=(16, 1024, 65536), memcached=None):
+    """Sweep every backend over ``keycounts`` and ``sizes``.  Returns a list
+    of flat result dicts, ready to be dumped as JSON."""
+    results = []
+    for keycount in keycounts:
+        args = [('product', i) for i in range(0, keycount)]
+        row = _measure('cache_key', [lambda a=a: caching.cache_key(*a) for a in args])
+        row.update({'backend' : None, 'keys' : keycount, 'size' : None})
+        results.append(row)
+
+    backends, tmpdir = available_backends(memcached)
+    try:
+        for name, backend in backends:
+            for keycount in keycounts:
+                for size in sizes:
+                    for row in bench_backend(backend, keycount, size):
+                        row.update({'backend' : name, 'keys' : keycount, 'size' : size})
+                        results.append(row)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
@@ -0,0 +1,57 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.utils import simplejson
+
+from trade.caching import benchmarks
+
+def _int_list(value):
+    return [int(x) for x in value.split(',') if x.strip()]
+
+class Command(NoArgsCommand):
+    help = "Runs the benchmarks for trade.caching."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--number', dest='number', type='int', default=20000,
+            help='Calls per cache_key comparison run.'),
+        make_option('--keys', dest='keys', default='100,1000,10000',
+            help='Comma separated key counts to sweep.'),
+        make_option('--sizes', dest='sizes', default='16,1024,65536',
+            help='Comma separated value sizes, in bytes, to sweep.'),
+        make_option('--memcached', dest='memcached', default='',
+            help='host:port of a memcached to include when it answers.'),
+        make_option('--json', dest='json', default='',
+            help='Also write the results to this file as JSON.'),
+        make_option('--keys-only', dest='keys_only', action='store_true', default=False,
+            help='Only compare cache_key with the legacy implementation.'),
+    )
+
+    def handle_noargs(self, **options):
+        number = options['number']
+
+        self.stdout.write("cache_key, best of 3 x %i calls\n" % number)
+        self.stdout.write("%-24s %12s %12s %8s\n" % ('case', 'legacy us', 'current us', 'speedup'))
+        keyrows = benchmarks.bench_cache_key(number=number)
+        for row in keyrows:
+            self.stdout.write("%(case)-24s %(legacy_us)12.2f %(current_us)12.2f %(speedup)7.1fx\n" % row)
+
+        if options['keys_only']:
+            results = {'cache_key' : keyrows}
+        else:
+            rows = benchmarks.run_suite(_int_list(options['keys']),
+                _int_list(options['sizes']), options['memcached'])
+            self.stdout.write("\n%-10s %6s %6s %-22s %12s %10s %10s %10s\n" % ('backend',
+                'keys', 'size', 'operation', 'ops/s', 'p50 us', 'p95 us', 'p99 us'))
+            for row in rows:
+                self.stdout.write("%-10s %6s %6s %-22s %12.0f %10.1f %10.1f %10.1f\n" % (
+                    row['backend'] or '-', row['keys'], row['size'] or '-', row['operation'],
+                    row['ops_per_sec'] or 0, row['p50'], row['p95'], row['p99']))
+            results = {'cache_key' : keyrows, 'suite' : rows}
+
+        if options['json']:
+            out = open(options['json'], 'w')
+            try:
+                simplejson.dump(results, out, indent=2)
+            finally:
+                out.close()
+            self.stdout.write("\nResults written to %s\n" % options['json'])
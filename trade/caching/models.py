@@ -1,4 +1,7 @@
+from django.conf import settings
+from django.db.models import signals
 from trade import caching
+from trade.caching.request import request_memo, request_forget
 import logging
 
 log = logging.getLogger('caching')
@@ -7,16 +10,19 @@ class CachedObjectMixin(object):
     """Provides basic object caching for any objects using this as a mixin."""
 
     def cache_delete(self, *args, **kwargs):
-        key = self.cache_key(*args, **kwargs)
-        log.debug("clearing cache for %s", key)
-        caching.cache_delete(key, children=True)
+        if not (args or kwargs):
+            log.debug("clearing cache namespace for %s", self)
+            caching.cache_namespace_bump(self.__class__.__name__, self)
+        else:
+            key = self.cache_key(*args, **kwargs)
+            log.debug("clearing cache for %s", key)
+            caching.cache_delete(key, children=True)
 
     def cache_get(self, *args, **kwargs):
-        key = self.cache_key(*args, **kwargs)
-        return caching.cache_get(key)
+        return caching.cache_namespace_get((self.__class__.__name__, self), *args, **kwargs)
 
     def cache_key(self, *args, **kwargs):
-        keys = [self.__class__.__name__, self]
+        keys = [caching.cache_namespace(self.__class__.__name__, self)]
         keys.extend(args)
         return caching.cache_key(keys, **kwargs)
 
@@ -32,55 +38,162 @@ class CachedObjectMixin(object):
     def is_cached(self, *args, **kwargs):
         return caching.is_cached(self.cache_key(*args, **kwargs))
 
-def find_by_id(cls, groupkey, objectid, raises=False):
-    """A helper function to look up an object by id"""
+class NotFound(object):
+    """Cached in place of an object that does not exist, so repeated misses
+    do not reach the database."""
+
+    def __repr__(self):
+        return '<NotFound>'
+
+NEGATIVE_TIMEOUT = getattr(settings, 'CACHE_NEGATIVE_TIMEOUT', 60)
+
+# model class -> list of (groupkey, attribute) declared with register_cache_groups
+_CACHE_GROUPS = {}
+_REFRESH_MODELS = set()
+
+def register_cache_groups(cls, *groups, **kwargs):
+    """Declare the find_by_* groups instances of ``cls`` are cached in, as
+    (groupkey, attribute) pairs, e.g. ``('product', 'pk')``.
+
+    Saving or deleting an instance then clears exactly those keys, including
+    the ones for an attribute value (such as a slug) that changed.  With
+    ``refresh=True`` a save stores the instance again instead of clearing it.
+    """
+    refresh = kwargs.pop('refresh', False)
+    registered = _CACHE_GROUPS.setdefault(cls, [])
+    for group in groups:
+        if group not in registered:
+            registered.append(group)
+    if refresh:
+        _REFRESH_MODELS.add(cls)
+
+    uid = 'caching-groups-%s.%s' % (cls.__module__, cls.__name__)
+    signals.post_init.connect(_remember_cache_values, sender=cls, dispatch_uid=uid)
+    signals.post_save.connect(_cache_groups_saved, sender=cls, dispatch_uid=uid)
+    signals.post_delete.connect(_cache_groups_deleted, sender=cls, dispatch_uid=uid)
+
+def cache_groups(cls):
+    """The (groupkey, attribute) pairs registered for ``cls``."""
+    return list(_CACHE_GROUPS.get(cls, ()))
+
+def _remember_cache_values(sender, instance, **kwargs):
+    values = {}
+    for groupkey, attr in _CACHE_GROUPS.get(sender, ()):
+        values[attr] = getattr(instance, attr, None)
+    instance._cache_group_values = values
+
+def _cache_groups_saved(sender, instance, **kwargs):
+    previous = getattr(instance, '_cache_group_values', {})
+    for groupkey, attr in _CACHE_GROUPS.get(sender, ()):
+        value = getattr(instance, attr)
+        old = previous.get(attr)
+        if old is not None and old != value:
+            _forget(groupkey, old)
+        if sender in _REFRESH_MODELS:
+            caching.cache_set(groupkey, value, value=instance)
+            request_forget(caching.cache_key(groupkey, value))
+        else:
+            _forget(groupkey, value)
+
+    _remember_cache_values(sender, instance)
+    if isinstance(instance, CachedObjectMixin):
+        instance.cache_delete()
+
+def _cache_groups_deleted(sender, instance, **kwargs):
+    previous = getattr(instance, '_cache_group_values', {})
+    for groupkey, attr in _CACHE_GROUPS.get(sender, ()):
+        for value in set([getattr(instance, attr, None), previous.get(attr)]):
+            if value is not None:
+                _forget(groupkey, value)
+
+    if isinstance(instance, CachedObjectMixin):
+        instance.cache_delete()
+
+def forget_cached(instance):
+    """Drop ``instance`` from its registered groups, after a change made
+    without saving it (a queryset ``update``, say)."""
+    _cache_groups_deleted(instance.__class__, instance)
+
+def cache_set_not_found(cls, groupkey, attr, key):
+    """Remember that no ``cls`` has ``attr`` equal to the last part of
+    ``key``, until one is saved.
+
+    Only done for groups declared with ``register_cache_groups``: their
+    handlers are connected when the models are imported, so a save in any
+    process clears the entry.  Misses in other groups are not cached.
+    """
+    if _caches_misses(cls, groupkey, attr):
+        caching.cache_set(key, value=NotFound(), length=NEGATIVE_TIMEOUT)
+
+def _caches_misses(cls, groupkey, attr):
+    return (groupkey, attr) in _CACHE_GROUPS.get(cls, ())
+
+def _forget(groupkey, value):
+    """Drop a find_by_* entry from the cache and from this request."""
+    caching.cache_delete(groupkey, value)
+    request_forget(caching.cache_key(groupkey, value))
+
+def _find(cls, groupkey, value, attr, lookup, raises):
+    ob = request_memo(caching.cache_key(groupkey, value), _find_cached,
+        cls, groupkey, value, attr, lookup)
+    if isinstance(ob, NotFound):
+        log.debug("No such %s: %s (cached)", groupkey, value)
+        if raises:
+            raise cls.DoesNotExist
+        ob = None
+
+    return ob
+
+def _find_cached(cls, groupkey, value, attr, lookup):
     ob = None
     try:
-        ob = caching.cache_get(groupkey, objectid)
+        ob = caching.cache_get(groupkey, value)
     except caching.NotCachedError, e:
         try:
-            ob = cls.objects.get(pk=objectid)
+            ob = cls.objects.get(**{lookup: value})
             caching.cache_set(e.key, value=ob)
 
         except cls.DoesNotExist:
-            log.debug("No such %s: %s", groupkey, objectid)
-            if raises:
-                raise cls.DoesNotExist
+            log.debug("No such %s: %s", groupkey, value)
+            cache_set_not_found(cls, groupkey, attr, e.key)
+            ob = NotFound()
 
     return ob
 
+def find_by_id(cls, groupkey, objectid, raises=False):
+    """A helper function to look up an object by id"""
+    return _find(cls, groupkey, objectid, 'pk', 'pk', raises)
+
+def find_many_by_id(cls, groupkey, ids):
+    """A helper function to look up several objects by id.
+
+    Objects are fetched from the cache in one call and the misses from the
+    database with a single query.  Returns the objects found, in the order
+    of ``ids``.
+    """
+    keys = [caching.cache_key(groupkey, objectid) for objectid in ids]
+    found = caching.cache_get_many([(groupkey, objectid) for objectid in ids])
+
+    missing = [(objectid, key) for objectid, key in zip(ids, keys) if key not in found]
+    if missing:
+        fetched = {}
+        for ob in cls.objects.filter(pk__in=[objectid for objectid, key in missing]):
+            fetched[caching.cache_key(groupkey, ob.pk)] = ob
+        if fetched:
+            caching.cache_set_many(fetched)
+            found.update(fetched)
+        if _caches_misses(cls, groupkey, 'pk'):
+            caching.cache_set_many([(key, NotFound()) for objectid, key in missing
+                if key not in fetched], length=NEGATIVE_TIMEOUT)
+        log.debug("Fetched %i of %i missing %s", len(fetched), len(missing), groupkey)
+
+    return [found[key] for key in keys
+        if key in found and not isinstance(found[key], NotFound)]
 
 def find_by_key(cls, groupkey, key, raises=False):
     """A helper function to look up an object by key"""
-    ob = None
-    try:
-        ob = caching.cache_get(groupkey, key)
-    except caching.NotCachedError, e:
-        try:
-            ob = cls.objects.get(key__exact=key)
-            caching.cache_set(e.key, value=ob)
-
-        except cls.DoesNotExist:
-            log.debug("No such %s: %s", groupkey, key)
-            if raises:
-                raise
-
-    return ob
+    return _find(cls, groupkey, key, 'key', 'key__exact', raises)
 
 def find_by_slug(cls, groupkey, slug, raises=False):
     """A helper function to look up an object by slug"""
-    ob = None
-    try:
-        ob = caching.cache_get(groupkey, slug)
-    except caching.NotCachedError, e:
-        try:
-            ob = cls.objects.get(slug__exact=slug)
-            caching.cache_set(e.key, value=ob)
-
-        except cls.DoesNotExist:
-            log.debug("No such %s: %s", groupkey, slug)
-            if raises:
-                raise
-
-    return ob
-
+    return _find(cls, groupkey, slug, 'slug', 'slug__exact', raises)
@@ -0,0 +1,243 @@
+"""A cache client spreading keys over several backends by consistent hashing.
+
+Set CACHE_NODES to a list of cache URIs (as for CACHE_BACKEND) and
+trade.caching uses a MultiNodeCache over them instead of the single
+Django cache.  Each node owns many points on a hash ring, so adding or
+removing one only moves the keys between it and its neighbours, about 1/N
+of them.  A node that raises is marked down for ``retry_after`` seconds and
+its keys go to the next node on the ring meanwhile.
+"""
+
+import bisect
+import threading
+import time
+import logging
+
+from django.core.cache import get_cache
+from django.utils.hashcompat import md5_constructor
+
+log = logging.getLogger('caching.nodes')
+
+def _hash(value):
+    return long(md5_constructor(value).hexdigest()[:16], 16)
+
+class CacheNode(object):
+    """One backend on the ring, with its own counters."""
+
+    def __init__(self, name, backend):
+        self.name = name
+        self.backend = backend
+        self.down_until = 0
+        self.gets = 0
+        self.hits = 0
+        self.sets = 0
+        self.errors = 0
+
+    def is_up(self, now=None):
+        return self.down_until <= (now or time.time())
+
+    def stats(self):
+        return {
+            'name' : self.name,
+            'up' : self.is_up(),
+            'gets' : self.gets,
+            'hits' : self.hits,
+            'sets' : self.sets,
+            'errors' : self.errors,
+        }
+
+class ConsistentHashRing(object):
+    """Maps keys to nodes, skipping nodes that are down."""
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.nodes = []
+        self._points = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        self.nodes.append(node)
+        self._rebuild()
+
+    def remove(self, node):
+        self.nodes.remove(node)
+        self._rebuild()
+
+    def _rebuild(self):
+        points = []
+        for node in self.nodes:
+            for i in range(0, self.replicas):
+                points.append((_hash('%s-%i' % (node.name, i)), node))
+        points.sort(key=lambda x: x[0])
+        self._points = [p for p, node in points]
+        self._owners = [node for p, node in points]
+
+    def get_node(self, key):
+        """The first node up at or after ``key`` on the ring, None if every
+        node is down."""
+        if not self._points:
+            return None
+        now = time.time()
+        start = bisect.bisect_left(self._points, _hash(key)) % len(self._points)
+        seen = set()
+        for i in range(0, len(self._points)):
+            node = self._owners[(start + i) % len(self._points)]
+            if node.is_up(now):
+                return node
+            seen.add(node.name)
+            if len(seen) == len(self.nodes):
+                break
+        return None
+
+class MultiNodeCache(object):
+    """The subset of the Django cache API trade.caching uses, over several
+    backends."""
+
+    def __init__(self, uris=(), backends=None, replicas=100, retry_after=30):
+        if backends is None:
+            backends = [(uri, get_cache(uri)) for uri in uris]
+        self.retry_after = retry_after
+        self.ring = ConsistentHashRing([CacheNode(name, backend) for name, backend in backends],
+            replicas=replicas)
+        self._lock = threading.Lock()
+
+    def add_node(self, name, backend):
+        self._lock.acquire()
+        try:
+            self.ring.add(CacheNode(name, backend))
+        finally:
+            self._lock.release()
+
+    def remove_node(self, name):
+        self._lock.acquire()
+        try:
+            for node in self.ring.nodes:
+                if node.name == name:
+                    self.ring.remove(node)
+                    break
+        finally:
+            self._lock.release()
+
+    def _mark_down(self, node, e):
+        node.errors += 1
+        node.down_until = time.time() + self.retry_after
+        log.warn("Cache node %s is not responding, marked down for %is: %s",
+            node.name, self.retry_after, e)
+
+    def _call(self, key, method, default, *args):
+        node = self.ring.get_node(key)
+        if node is None:
+            return node, default
+        try:
+            return node, getattr(node.backend, method)(key, *args)
+        except ValueError:
+            # incr on a missing key, not a node failure
+            raise
+        except Exception, e:
+            self._mark_down(node, e)
+            return node, default
+
+    def get(self, key, default=None):
+        node, value = self._call(key, 'get', None)
+        if node is not None:
+            node.gets += 1
+            if value is not None:
+                node.hits += 1
+        if value is None:
+            return default
+        return value
+
+    def set(self, key, value, timeout=None):
+        node, result = self._call(key, 'set', None, value, timeout)
+        if node is not None:
+            node.sets += 1
+
+    def add(self, key, value, timeout=None):
+        node, result = self._call(key, 'add', False, value, timeout)
+        return result
+
+    def delete(self, key):
+        self._call(key, 'delete', None)
+
+    def incr(self, key, delta=1):
+        node, result = self._call(key, 'incr', None, delta)
+        if result is None:
+            raise ValueError("Key '%s' not found" % key)
+        return result
+
+    def decr(self, key, delta=1):
+        return self.incr(key, -delta)
+
+    def _by_node(self, keys):
+        groups = {}
+        for key in keys:
+            node = self.ring.get_node(key)
+            if node is not None:
+                groups.setdefault(node, []).append(key)
+        return groups
+
+    def get_many(self, keys):
+        found = {}
+        for node, nodekeys in self._by_node(keys).items():
+            try:
+                values = node.backend.get_many(nodekeys)
+            except Exception, e:
+                self._mark_down(node, e)
+                continue
+            node.gets += len(nodekeys)
+            node.hits += len(values)
+            found.update(values)
+        return found
+
+    def set_many(self, data, timeout=None):
+        for node, nodekeys in self._by_node(data.keys()).items():
+            try:
+                node.backend.set_many(dict([(k, data[k]) for k in nodekeys]), timeout)
+                node.sets += len(nodekeys)
+            except Exception, e:
+                self._mark_down(node, e)
+
+    def delete_many(self, keys):
+        for node, nodekeys in self._by_node(keys).items():
+            try:
+                node.backend.delete_many(nodekeys)
+            except Exception, e:
+                self._mark_down(node, e)
+
+    def flush_all(self):
+        """Empty every node that is up."""
+        for node in self.ring.nodes:
+            if not node.is_up():
+                continue
+            try:
+                backend = node.backend
+                if hasattr(backend, '_cache') and hasattr(backend._cache, 'flush_all'):
+                    backend._cache.flush_all()
+                else:
+                    backend.clear()
+            except Exception, e:
+                self._mark_down(node, e)
+
+    def check(self):
+        """Write and read back a probe on every node, marking the ones that
+        fail down and the ones that answer up again."""
+        for node in self.ring.nodes:
+            probe = 'cache_node_probe'
+            try:
+                node.backend.set(probe, node.name, 10)
+                ok = node.backend.get(probe) == node.name
+            except Exception, e:
+                ok = False
+            if ok:
+                node.down_until = 0
+            elif node.is_up():
+                self._mark_down(node, 'probe failed')
+        return self.up_nodes()
+
+    def up_nodes(self):
+        return [node for node in self.ring.nodes if node.is_up()]
+
+    def node_stats(self):
+        return [node.stats() for node in self.ring.nodes]
@@ -0,0 +1,119 @@
+"""The index of keys set by this process."""
+
+import bisect
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+class KeyRegistry(object):
+    """A bounded, thread-safe set of cache keys.
+
+    Holds at most ``size`` keys, dropping the least recently used, and keeps
+    them sorted so the keys under a prefix are found by bisection instead of
+    scanning everything.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self._recent = OrderedDict()
+        self._sorted = []
+        self._lock = threading.RLock()
+
+    def add(self, key):
+        """Register ``key``, or mark it as recently used."""
+        self._lock.acquire()
+        try:
+            if key in self._recent:
+                del self._recent[key]
+            else:
+                bisect.insort(self._sorted, key)
+            self._recent[key] = True
+
+            while len(self._recent) > self.size:
+                oldest = self._recent.iterkeys().next()
+                del self._recent[oldest]
+                self._remove_sorted(oldest)
+        finally:
+            self._lock.release()
+
+    def discard(self, key):
+        """Forget ``key``, returning whether it was known."""
+        self._lock.acquire()
+        try:
+            if key not in self._recent:
+                return False
+            del self._recent[key]
+            self._remove_sorted(key)
+            return True
+        finally:
+            self._lock.release()
+
+    def page(self, prefix='', offset=0, limit=100):
+        """Up to ``limit`` keys starting with ``prefix``, in order, skipping
+        the first ``offset``."""
+        self._lock.acquire()
+        try:
+            start = bisect.bisect_left(self._sorted, prefix) + offset
+            keys = self._sorted[start:start + limit]
+        finally:
+            self._lock.release()
+
+        if prefix and keys and not keys[-1].startswith(prefix):
+            keys = [k for k in keys if k.startswith(prefix)]
+        return keys
+
+    def count(self, prefix=''):
+        """How many keys start with ``prefix``."""
+        if not prefix:
+            return len(self)
+        self._lock.acquire()
+        try:
+            return (bisect.bisect_left(self._sorted, prefix + '\xff')
+                - bisect.bisect_left(self._sorted, prefix))
+        finally:
+            self._lock.release()
+
+    def pop_children(self, prefix, limit=100):
+        """Remove and return up to ``limit`` keys starting with ``prefix``."""
+        self._lock.acquire()
+        try:
+            keys = self.page(prefix, 0, limit)
+            for key in keys:
+                del self._recent[key]
+            if keys:
+                start = bisect.bisect_left(self._sorted, keys[0])
+                del self._sorted[start:start + len(keys)]
+            return keys
+        finally:
+            self._lock.release()
+
+    def keys(self):
+        self._lock.acquire()
+        try:
+            return list(self._sorted)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._recent = OrderedDict()
+            self._sorted = []
+        finally:
+            self._lock.release()
+
+    def has_key(self, key):
+        return key in self._recent
+
+    __contains__ = has_key
+
+    def __len__(self):
+        return len(self._recent)
+
+    def _remove_sorted(self, key):
+        i = bisect.bisect_left(self._sorted, key)
+        if i < len(self._sorted) and self._sorted[i] == key:
+            del self._sorted[i]
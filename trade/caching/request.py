@@ -0,0 +1,69 @@
+"""Memoization for the lifetime of a single request.
+
+RequestMemoMiddleware opens a store when a request comes in and drops it
+with the response, so a value computed by ``request_memoize`` is computed
+once per request and never seen by the next one.  Outside a request (in
+management commands, for instance) nothing is memoized.
+"""
+
+import threading
+
+from trade import caching
+
+_local = threading.local()
+
+def memo_start():
+    _local.store = {}
+
+def memo_end():
+    _local.store = None
+
+def memo_active():
+    return getattr(_local, 'store', None) is not None
+
+def _memo_key(key):
+    try:
+        hash(key)
+        return key
+    except TypeError:
+        return caching.cache_key(key)
+
+def request_memo(key, compute, *args, **kwargs):
+    """Return the value memoized under ``key`` in this request, calling
+    ``compute(*args, **kwargs)`` to get it the first time."""
+    store = getattr(_local, 'store', None)
+    if store is None:
+        return compute(*args, **kwargs)
+
+    key = _memo_key(key)
+    try:
+        return store[key]
+    except KeyError:
+        value = store[key] = compute(*args, **kwargs)
+        return value
+
+def request_forget(key):
+    """Drop ``key`` from this request's store, after the value changed."""
+    store = getattr(_local, 'store', None)
+    if store is not None:
+        store.pop(_memo_key(key), None)
+
+def request_memoize(func):
+    """Decorator memoizing ``func`` per request, keyed on its arguments."""
+    def inner_func(*args, **kwargs):
+        key = (func.__module__, func.__name__, args, tuple(sorted(kwargs.items())))
+        return request_memo(key, func, *args, **kwargs)
+    inner_func.__name__ = func.__name__
+    inner_func.__module__ = func.__module__
+    inner_func.__doc__ = func.__doc__
+    return inner_func
+
+class RequestMemoMiddleware(object):
+    """Gives every request its own memo store."""
+
+    def process_request(self, request):
+        memo_start()
+
+    def process_response(self, request, response):
+        memo_end()
+        return response
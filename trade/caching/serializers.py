@@ -0,0 +1,44 @@
+"""Codecs turning cached values into the bytes stored in the backend."""
+
+import cPickle as pickle
+import zlib
+
+from django.conf import settings
+
+class PickleCodec(object):
+    """Pickles values, compressing them with zlib when the pickle is at
+    least ``compress_threshold`` bytes long (0 never compresses)."""
+
+    def __init__(self, protocol=None, compress_threshold=None, compress_level=None):
+        if protocol is None:
+            protocol = getattr(settings, 'CACHE_PICKLE_PROTOCOL', pickle.HIGHEST_PROTOCOL)
+        if compress_threshold is None:
+            compress_threshold = getattr(settings, 'CACHE_COMPRESS_THRESHOLD', 0)
+        if compress_level is None:
+            compress_level = getattr(settings, 'CACHE_COMPRESS_LEVEL', 6)
+        self.protocol = protocol
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def dumps(self, val):
+        """Returns (codec name, data, uncompressed size)."""
+        data = pickle.dumps(val, self.protocol)
+        size = len(data)
+        if self.compress_threshold and size >= self.compress_threshold:
+            compressed = zlib.compress(data, self.compress_level)
+            if len(compressed) < size:
+                return 'zlib', compressed, size
+        return 'pickle', data, size
+
+    def loads(self, codec, data):
+        if codec == 'zlib':
+            data = zlib.decompress(data)
+        elif codec != 'pickle':
+            raise ValueError("Unknown cache codec: %s" % codec)
+        return pickle.loads(data)
+
+def get_codec():
+    """Instantiates the codec named by CACHE_CODEC."""
+    path = getattr(settings, 'CACHE_CODEC', 'trade.caching.serializers.PickleCodec')
+    module, attr = path.rsplit('.', 1)
+    return getattr(__import__(module, {}, {}, [attr]), attr)()
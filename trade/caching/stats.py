@@ -0,0 +1,190 @@
+"""Cache statistics shared by every process using the same cache backend.
+
+Each process buffers its counts and adds them to counters kept in the
+backend with ``incr`` every few seconds, from a background thread, so the
+stats page can show the whole fleet rather than the one worker that served
+it.
+"""
+
+import threading
+import time
+import logging
+
+log = logging.getLogger('caching.stats')
+
+# Upper bounds, in milliseconds, of the latency histogram buckets.  The last
+# bucket counts everything slower.
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250)
+
+COUNTERS = ('gets', 'hits', 'sets', 'bytes', 'raw_bytes')
+OPERATIONS = ('get', 'set')
+
+class CacheStats(object):
+    """Counters per key prefix, stored under ``base`` in ``backend``."""
+
+    def __init__(self, base, backend, enabled=True, flush_interval=5, timeout=60*60*24*30):
+        self.base = base
+        self.backend = backend
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self._pending = {}
+        self._prefixes = set()
+        self._registered = set()
+        self._last_flush = time.time()
+        self._flusher = None
+        self._lock = threading.Lock()
+
+    def record_get(self, prefix, hit, elapsed):
+        if self.enabled:
+            self._count(prefix, (('gets', 1), ('hits', hit and 1 or 0),
+                ('get_%i' % _bucket(elapsed * 1000), 1)))
+
+    def record_set(self, prefix, elapsed):
+        if self.enabled:
+            self._count(prefix, (('sets', 1), ('set_%i' % _bucket(elapsed * 1000), 1)))
+
+    def record_size(self, prefix, stored, raw):
+        """Count the bytes written for one value, and before compression."""
+        if self.enabled:
+            self._count(prefix, (('bytes', stored), ('raw_bytes', raw)))
+
+    def _count(self, prefix, counts):
+        self._lock.acquire()
+        try:
+            pending = self._pending
+            for name, value in counts:
+                if value:
+                    k = (prefix, name)
+                    pending[k] = pending.get(k, 0) + value
+            self._prefixes.add(prefix)
+            due = (self._flusher is None
+                and time.time() - self._last_flush >= self.flush_interval)
+            if due:
+                # one incr per counter is too slow for the request thread
+                self._flusher = threading.Thread(target=self._background_flush,
+                    name='cache-stats-flush')
+                self._flusher.setDaemon(True)
+        finally:
+            self._lock.release()
+
+        if due:
+            self._flusher.start()
+
+    def _background_flush(self):
+        try:
+            self.flush()
+        finally:
+            self._lock.acquire()
+            try:
+                self._flusher = None
+            finally:
+                self._lock.release()
+
+    def flush(self):
+        """Add the counts buffered by this process to the shared counters."""
+        self._lock.acquire()
+        try:
+            pending, self._pending = self._pending, {}
+            new = self._prefixes - self._registered
+            self._registered |= new
+            self._last_flush = time.time()
+        finally:
+            self._lock.release()
+
+        try:
+            if new:
+                self._register(new)
+            for (prefix, name), value in pending.items():
+                self._incr(self._key(prefix, name), value)
+        except Exception, e:
+            # stats must never take the site down with them
+            log.warn("Could not flush cache stats: %s", e)
+
+    def _incr(self, key, value):
+        try:
+            self.backend.incr(key, value)
+        except ValueError:
+            if not self.backend.add(key, value, self.timeout):
+                self.backend.incr(key, value)
+
+    def _register(self, prefixes):
+        key = self._key('prefixes')
+        known = set(self.backend.get(key) or ())
+        if not prefixes <= known:
+            self.backend.set(key, list(known | prefixes), self.timeout)
+
+    def _key(self, *parts):
+        return '::'.join((self.base,) + parts)
+
+    def fleet(self):
+        """Returns a list with one dict of totals per key prefix, for all
+        processes, busiest first."""
+        self.flush()
+        prefixes = self.backend.get(self._key('prefixes')) or []
+
+        keys = []
+        for prefix in prefixes:
+            keys.extend([self._key(prefix, name) for name in COUNTERS])
+            for op in OPERATIONS:
+                keys.extend([self._key(prefix, '%s_%i' % (op, i))
+                    for i in range(0, len(LATENCY_BUCKETS) + 1)])
+        values = keys and self.backend.get_many(keys) or {}
+
+        rows = []
+        for prefix in prefixes:
+            row = {'prefix' : prefix}
+            for name in COUNTERS:
+                row[name] = int(values.get(self._key(prefix, name), 0))
+            if row['gets']:
+                row['hit_rate'] = "%02.1f" % (float(row['hits'])/row['gets']*100)
+            else:
+                row['hit_rate'] = "0.0"
+            for op in OPERATIONS:
+                histogram = [int(values.get(self._key(prefix, '%s_%i' % (op, i)), 0))
+                    for i in range(0, len(LATENCY_BUCKETS) + 1)]
+                for p in (50, 95, 99):
+                    row['%s_p%i' % (op, p)] = percentile(histogram, p)
+            rows.append(row)
+
+        rows.sort(key=lambda x: x['gets'] + x['sets'], reverse=True)
+        return rows
+
+    def reset(self):
+        """Forget every shared counter."""
+        self._lock.acquire()
+        try:
+            self._pending = {}
+            self._registered = set()
+        finally:
+            self._lock.release()
+
+        prefixes = self.backend.get(self._key('prefixes')) or []
+        for prefix in prefixes:
+            for name in COUNTERS:
+                self.backend.delete(self._key(prefix, name))
+            for op in OPERATIONS:
+                for i in range(0, len(LATENCY_BUCKETS) + 1):
+                    self.backend.delete(self._key(prefix, '%s_%i' % (op, i)))
+        self.backend.delete(self._key('prefixes'))
+
+def _bucket(ms):
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if ms <= bound:
+            return i
+    return len(LATENCY_BUCKETS)
+
+def percentile(histogram, p):
+    """The upper bound in milliseconds of the bucket holding the ``p``th
+    percentile, None without samples; a string for the open last bucket."""
+    total = sum(histogram)
+    if not total:
+        return None
+    wanted = total * p / 100.0
+    seen = 0
+    for i, count in enumerate(histogram):
+        seen += count
+        if seen >= wanted:
+            if i < len(LATENCY_BUCKETS):
+                return LATENCY_BUCKETS[i]
+            return ">%s" % LATENCY_BUCKETS[-1]
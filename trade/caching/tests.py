@@ -1,13 +1,32 @@
 # -*- coding: UTF-8 -*-
+from django.core.cache import cache
+from django.db import models
 from django.http import Http404
 from trade import caching
+from trade.caching import benchmarks
+from trade.caching.models import find_by_slug, find_by_id, find_many_by_id, NotFound
+from trade.caching.models import register_cache_groups
+from trade.caching.nodes import MultiNodeCache
+from trade.caching.serializers import PickleCodec
+from trade.caching.registry import KeyRegistry
+from trade.caching.request import RequestMemoMiddleware, request_memoize
+from trade.caching.stats import CacheStats, percentile
 import random
 from django.test import TestCase
 import re
+import threading
 import time
 
 CACHE_HIT=0
 
+class CachedThing(models.Model):
+    slug = models.SlugField()
+
+class RegisteredThing(models.Model):
+    slug = models.SlugField()
+
+register_cache_groups(RegisteredThing, ('registered', 'pk'), ('registered-slug', 'slug'))
+
 def cachetest(a,b,c):
     global CACHE_HIT
     CACHE_HIT += 1
@@ -17,6 +36,25 @@ def cachetest(a,b,c):
 
 cachetest = caching.cache_function(2)(cachetest)
 
+MEMO_CALLS=0
+
+def memotest(a):
+    global MEMO_CALLS
+    MEMO_CALLS += 1
+    return a
+
+memotest = request_memoize(memotest)
+
+SLOW_CALLS=0
+
+def slowtest(a):
+    global SLOW_CALLS
+    SLOW_CALLS += 1
+    time.sleep(0.5)
+    return a * 2
+
+slowtest = caching.cache_function(1, single_flight=True)(slowtest)
+
 class DecoratorTest(TestCase):
 
     def testCachePut(self):
@@ -43,6 +81,75 @@ class DecoratorTest(TestCase):
         after = cachetest(10,20,30)
         self.assertNotEqual(orig,caching)
 
+class SingleFlightTest(TestCase):
+
+    def _run(self, count):
+        results = []
+        def call():
+            results.append(slowtest(21))
+        threads = [threading.Thread(target=call) for x in range(0, count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def testComputedOnce(self):
+        caching.cache_delete_function(slowtest)
+        start = SLOW_CALLS
+        results = self._run(5)
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(SLOW_CALLS, start + 1)
+
+    def testStaleWhileLocked(self):
+        caching.cache_delete_function(slowtest)
+        self._run(1)
+        start = SLOW_CALLS
+        # let the value expire, the stale copy is still there
+        time.sleep(1.5)
+        results = self._run(5)
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(SLOW_CALLS, start + 1)
+
+SOFT_CALLS=0
+
+def softinline(a):
+    global SOFT_CALLS
+    SOFT_CALLS += 1
+    return SOFT_CALLS
+
+softinline = caching.cache_function(10, soft_length=1)(softinline)
+
+def softbackground(a):
+    global SOFT_CALLS
+    SOFT_CALLS += 1
+    return SOFT_CALLS
+
+softbackground = caching.cache_function(10, soft_length=1, background=True)(softbackground)
+
+class SoftTimeoutTest(TestCase):
+
+    def testInlineRefresh(self):
+        first = softinline(1)
+        self.assertEqual(softinline(1), first)
+
+        time.sleep(1.5)
+        second = softinline(1)
+        self.assertNotEqual(first, second)
+        self.assertEqual(softinline(1), second)
+
+    def testBackgroundRefresh(self):
+        first = softbackground(1)
+        time.sleep(1.5)
+        # the stale value is served while the refresh runs elsewhere
+        self.assertEqual(softbackground(1), first)
+        time.sleep(0.5)
+        self.assertNotEqual(softbackground(1), first)
+
+    def testOldWrapper(self):
+        self.assertFalse(caching.CacheWrapper('x').is_stale())
+        self.assert_(caching.CacheWrapper('x', fresh_until=time.time() - 1).is_stale())
+
 class CachingTest(TestCase):
 
     def testCacheGetFail(self):
@@ -151,3 +258,551 @@ class TestKeyMaker(TestCase):
 
 
 
+
+class TestLocalCache(TestCase):
+
+    def setUp(self):
+        self.orig = caching.L1_CACHE
+        caching.L1_CACHE = caching.LocalLRUCache(size=3, timeout=60)
+
+    def tearDown(self):
+        caching.L1_CACHE = self.orig
+
+    def testFilledOnSet(self):
+        caching.cache_set('l1', 'a', value='A')
+        key = caching.cache_key('l1', 'a')
+        self.assertEqual(caching.L1_CACHE.get(key).val, 'A')
+        self.assertEqual(caching.cache_get('l1', 'a'), 'A')
+
+    def testFilledOnBackendHit(self):
+        caching.cache_set('l1', 'b', value='B')
+        caching.L1_CACHE.clear()
+        self.assertEqual(caching.cache_get('l1', 'b'), 'B')
+        self.assertEqual(caching.L1_CACHE.misses, 1)
+        self.assertEqual(caching.cache_get('l1', 'b'), 'B')
+        self.assertEqual(caching.L1_CACHE.hits, 1)
+
+    def testReturnsCopies(self):
+        caching.cache_set('l1', 'list', value=[1, 2])
+        caching.cache_get('l1', 'list').append(3)
+        self.assertEqual(caching.cache_get('l1', 'list'), [1, 2])
+
+    def testBounded(self):
+        for x in range(0, 5):
+            caching.cache_set('l1', 'bound', x, value=x)
+        self.assertEqual(len(caching.L1_CACHE), 3)
+        self.assertEqual(caching.L1_CACHE.get(caching.cache_key('l1', 'bound', 0)), None)
+        self.assert_(caching.L1_CACHE.get(caching.cache_key('l1', 'bound', 4)))
+
+    def testExpires(self):
+        caching.cache_set('l1', 'short', value=True, length=1)
+        time.sleep(2)
+        self.assertEqual(caching.L1_CACHE.get(caching.cache_key('l1', 'short')), None)
+
+    def testDeleteInvalidates(self):
+        caching.cache_set('l1', 'del', value=True)
+        caching.cache_set('l1', 'del', 'child', value=True)
+        caching.cache_delete('l1', 'del', children=True)
+        self.assertEqual(len(caching.L1_CACHE), 0)
+        self.assertFalse(caching.cache_get('l1', 'del', 'child', default=False))
+
+class TestNamespace(TestCase):
+
+    def testBumpInvalidatesChildren(self):
+        ns = caching.cache_namespace('ns', 'products')
+        for x in range(0, 5):
+            caching.cache_set(ns, x, value=x)
+        self.assertEqual(caching.cache_get(ns, 3), 3)
+
+        caching.cache_namespace_bump('ns', 'products')
+        ns2 = caching.cache_namespace('ns', 'products')
+        self.assertNotEqual(ns, ns2)
+        for x in range(0, 5):
+            self.assertFalse(caching.cache_get(ns2, x, default=False))
+
+    def testChildrenDeleteBumps(self):
+        ns = caching.cache_namespace('ns', 'other')
+        caching.cache_set(ns, 'x', value=True)
+        caching.cache_delete('ns', 'other', children=True)
+        ns2 = caching.cache_namespace('ns', 'other')
+        self.assertFalse(caching.cache_get(ns2, 'x', default=False))
+
+    def testBumpUnknownNamespace(self):
+        self.assertEqual(caching.cache_namespace_bump('ns', 'never'), [])
+
+    def testDeleteFunction(self):
+        orig = cachetest(7, 8, 9)
+        hits = CACHE_HIT
+        self.assertEqual(orig, cachetest(7, 8, 9))
+        self.assertEqual(CACHE_HIT, hits)
+        caching.cache_delete_function(cachetest)
+        cachetest(7, 8, 9)
+        self.assertEqual(CACHE_HIT, hits + 1)
+
+    def testOneBackendCallWithoutLocalCache(self):
+        l1 = caching.L1_CACHE
+        caching.L1_CACHE = caching.LocalLRUCache(size=0, timeout=0)
+        calls = []
+        nested = []
+        def counting(name):
+            # the base get_many calls get for each key; count round trips
+            orig = getattr(caching.cache, name)
+            def wrapper(*args, **kwargs):
+                if not nested:
+                    calls.append(name)
+                nested.append(name)
+                try:
+                    return orig(*args, **kwargs)
+                finally:
+                    nested.pop()
+            return orig, wrapper
+        get, caching.cache.get = counting('get')
+        get_many, caching.cache.get_many = counting('get_many')
+        try:
+            self.assertEqual(cachetest(4, 5, 6), cachetest(4, 5, 6))
+            del calls[:]
+            cachetest(4, 5, 6)
+            self.assertEqual(calls, ['get_many'])
+
+            # a bump made by another process is seen on the next call
+            base = caching.cache_key('func', 'cachetest', __name__)
+            seen = caching._GENERATIONS[base]
+            hits = CACHE_HIT
+            caching._namespace_bump(base)
+            caching._GENERATIONS[base] = seen
+            cachetest(4, 5, 6)
+            self.assertEqual(CACHE_HIT, hits + 1)
+        finally:
+            caching.cache.get = get
+            caching.cache.get_many = get_many
+            caching.L1_CACHE = l1
+
+class TestMany(TestCase):
+
+    def testSetGetMany(self):
+        caching.cache_set_many([(('many', x), x * 10) for x in range(0, 5)])
+        found = caching.cache_get_many([('many', x) for x in range(0, 7)])
+        self.assertEqual(len(found), 5)
+        for x in range(0, 5):
+            self.assertEqual(found[caching.cache_key('many', x)], x * 10)
+        self.assertFalse(caching.cache_key('many', 6) in found)
+
+    def testSharesKeysWithSingle(self):
+        caching.cache_set('many', 'single', value='one')
+        found = caching.cache_get_many([('many', 'single')])
+        self.assertEqual(found.values(), ['one'])
+
+        caching.cache_set_many({('many', 'bulk'): 'two'})
+        self.assertEqual(caching.cache_get('many', 'bulk'), 'two')
+
+    def testEmpty(self):
+        self.assertEqual(caching.cache_get_many([]), {})
+
+class TestNotFound(TestCase):
+
+    def testMissCached(self):
+        self.assertEqual(find_by_slug(RegisteredThing, 'registered-slug', 'nothere'), None)
+        cached = caching.cache_get('registered-slug', 'nothere')
+        self.assert_(isinstance(cached, NotFound))
+        self.assertEqual(find_by_slug(RegisteredThing, 'registered-slug', 'nothere'), None)
+
+    def testRaises(self):
+        find_by_id(RegisteredThing, 'registered', 999)
+        self.assertRaises(RegisteredThing.DoesNotExist, find_by_id, RegisteredThing, 'registered', 999, raises=True)
+
+    def testSaveInvalidates(self):
+        self.assertEqual(find_by_slug(RegisteredThing, 'registered-slug', 'later'), None)
+        thing = RegisteredThing.objects.create(slug='later')
+        self.assertEqual(find_by_slug(RegisteredThing, 'registered-slug', 'later'), thing)
+
+    def testUnregisteredMissNotCached(self):
+        self.assertEqual(find_by_slug(CachedThing, 'thing', 'nothere'), None)
+        self.assertFalse(caching.cache_get('thing', 'nothere', default=False))
+
+    def testManyMissesCached(self):
+        thing = RegisteredThing.objects.create(slug='many')
+        found = find_many_by_id(RegisteredThing, 'registered', [thing.pk, 998, 999])
+        self.assertEqual(found, [thing])
+        self.assert_(isinstance(caching.cache_get('registered', 999), NotFound))
+
+class TestCacheGroups(TestCase):
+
+    def testSaveClears(self):
+        thing = RegisteredThing.objects.create(slug='one')
+        self.assertEqual(find_by_id(RegisteredThing, 'registered', thing.pk), thing)
+        self.assertEqual(find_by_slug(RegisteredThing, 'registered-slug', 'one'), thing)
+
+        thing.save()
+        self.assertFalse(caching.cache_get('registered', thing.pk, default=False))
+        self.assertFalse(caching.cache_get('registered-slug', 'one', default=False))
+
+    def testSlugChange(self):
+        thing = RegisteredThing.objects.create(slug='before')
+        find_by_slug(RegisteredThing, 'registered-slug', 'before')
+        find_by_slug(RegisteredThing, 'registered-slug', 'after')
+
+        thing.slug = 'after'
+        thing.save()
+        self.assertFalse(caching.cache_get('registered-slug', 'before', default=False))
+        self.assertEqual(find_by_slug(RegisteredThing, 'registered-slug', 'before'), None)
+        self.assertEqual(find_by_slug(RegisteredThing, 'registered-slug', 'after'), thing)
+
+    def testDeleteClears(self):
+        thing = RegisteredThing.objects.create(slug='gone')
+        find_by_slug(RegisteredThing, 'registered-slug', 'gone')
+        thing.delete()
+        self.assertEqual(find_by_slug(RegisteredThing, 'registered-slug', 'gone'), None)
+
+class TestFastKeyMaker(TestCase):
+
+    def testModelKey(self):
+        thing = CachedThing.objects.create(slug='key')
+        v = caching.cache_key('thing', thing)
+        self.assertEqual(v, caching.CACHE_PREFIX + '::thing::%s' % thing.pk)
+
+    def testScalarTuplesStable(self):
+        self.assertEqual(caching.cache_key('t', (1, 'a')), caching.cache_key('t', (1, 'a')))
+        self.assertNotEqual(caching.cache_key('t', (1, 'a')), caching.cache_key('t', ('1', 'a')))
+        self.assertNotEqual(caching.cache_key('t', (1, 2)), caching.cache_key('t', [1, 2]))
+        self.assertNotEqual(caching.cache_key('t', ()), caching.cache_key('t', {}))
+
+    def testModelsInTuple(self):
+        one = CachedThing.objects.create(slug='one')
+        two = CachedThing.objects.create(slug='two')
+        self.assertNotEqual(caching.cache_key('t', (one,)), caching.cache_key('t', (two,)))
+        self.assertEqual(caching.cache_key('t', (one, 2)), caching.cache_key('t', (one, 2)))
+
+    def testScalarDictsStable(self):
+        one = CachedThing.objects.create(slug='one')
+        self.assertEqual(caching.cache_key('t', {'a': 1, 'b': one}),
+            caching.cache_key('t', dict([('b', one), ('a', 1)])))
+        self.assertNotEqual(caching.cache_key('t', {'a': 1}), caching.cache_key('t', {'a': '1'}))
+        self.assertNotEqual(caching.cache_key('t', {'a': 1}), caching.cache_key('t', [('a', 1)]))
+        self.assertEqual(caching.cache_key('t', {'s': set([1])}),
+            caching.CACHE_PREFIX + '::t::' + caching.md5_hash({'s': set([1])}))
+
+    def testUnhandledTypesHashed(self):
+        v = caching.cache_key('t', set([1, 2]))
+        self.assertEqual(v, caching.CACHE_PREFIX + '::t::' + caching.md5_hash(set([1, 2])))
+
+class TestCodec(TestCase):
+
+    def setUp(self):
+        self.orig = caching.CODEC
+        caching.CODEC = PickleCodec(compress_threshold=100)
+
+    def tearDown(self):
+        caching.CODEC = self.orig
+
+    def testCompressed(self):
+        big = 'x' * 10000
+        caching.cache_set('codec', 'big', value=big)
+        caching.L1_CACHE.clear()
+        stored = cache.get(caching.cache_key('codec', 'big'))
+        self.assert_(stored.startswith(caching.ENCODED_PREFIX + 'zlib|'))
+        self.assert_(len(stored) < 1000)
+        self.assertEqual(caching.cache_get('codec', 'big'), big)
+
+    def testSmallNotCompressed(self):
+        caching.cache_set('codec', 'small', value=[1, 2])
+        stored = cache.get(caching.cache_key('codec', 'small'))
+        self.assert_(stored.startswith(caching.ENCODED_PREFIX + 'pickle|'))
+
+    def testSoftTimeoutKept(self):
+        key = caching.cache_key('codec', 'soft')
+        caching.cache_set(key, value=caching.CacheWrapper('soft', fresh_until=12.5))
+        caching.L1_CACHE.clear()
+        self.assertEqual(caching._cache_get_wrapper(key).fresh_until, 12.5)
+
+    def testOldEncodedWrapperStillRead(self):
+        key = caching.cache_key('codec', 'older')
+        stored = caching.CacheWrapper(caching.CODEC.dumps('older')[1])
+        stored.codec = 'pickle'
+        cache.set(key, stored)
+        caching.L1_CACHE.clear()
+        self.assertEqual(caching.cache_get('codec', 'older'), 'older')
+
+    def testPlainWrapperStillRead(self):
+        key = caching.cache_key('codec', 'plain')
+        cache.set(key, caching.CacheWrapper('old'))
+        caching.L1_CACHE.clear()
+        self.assertEqual(caching.cache_get('codec', 'plain'), 'old')
+
+    def testSizesRecorded(self):
+        caching.cache_set('codecsize', 1, value='y' * 50)
+        caching.cache_set('codecsize', 2, value='y' * 50)
+        sizes = caching.CACHE_SIZES['codecsize']
+        self.assertEqual(sizes['sets'], 2)
+        self.assert_(sizes['bytes'] >= 100)
+
+class TestStats(TestCase):
+
+    def setUp(self):
+        self.orig = caching.STATS
+        caching.STATS = CacheStats(caching.cache_key('statstest'), cache, flush_interval=3600)
+        caching.STATS.reset()
+
+    def tearDown(self):
+        caching.STATS.reset()
+        caching.STATS = self.orig
+
+    def testFleet(self):
+        caching.cache_set('counted', 1, value='one')
+        caching.cache_get('counted', 1)
+        caching.L1_CACHE.clear()
+        caching.cache_get('counted', 1)
+        caching.cache_get('counted', 2, default=None)
+
+        rows = caching.STATS.fleet()
+        self.assertEqual(len(rows), 1)
+        row = rows[0]
+        self.assertEqual(row['prefix'], 'counted')
+        self.assertEqual(row['gets'], 3)
+        self.assertEqual(row['hits'], 2)
+        self.assertEqual(row['sets'], 1)
+        self.assertEqual(row['hit_rate'], '66.7')
+        self.assert_(row['get_p50'] is not None)
+
+    def testSharedBetweenProcesses(self):
+        other = CacheStats(caching.STATS.base, cache, flush_interval=3600)
+        caching.STATS.record_get('shared', True, 0.001)
+        other.record_get('shared', False, 0.001)
+        other.flush()
+        row = caching.STATS.fleet()[0]
+        self.assertEqual(row['gets'], 2)
+        self.assertEqual(row['hits'], 1)
+
+    def testFlushedInBackground(self):
+        threads = []
+        class Backend(object):
+            def __getattr__(self, name):
+                return getattr(cache, name)
+            def incr(self, key, delta=1):
+                threads.append(threading.currentThread())
+                return cache.incr(key, delta)
+        stats = CacheStats(caching.STATS.base, Backend(), flush_interval=0)
+        stats.record_set('background', 0.001)
+        while stats._flusher is not None:
+            time.sleep(0.01)
+        self.assertEqual(caching.STATS.fleet()[0]['sets'], 1)
+        self.assert_(threads)
+        self.failIf(threading.currentThread() in threads)
+
+    def testPercentile(self):
+        self.assertEqual(percentile([0] * 12, 50), None)
+        self.assertEqual(percentile([5, 5] + [0] * 10, 50), 0.1)
+        self.assertEqual(percentile([5, 5] + [0] * 10, 99), 0.25)
+        self.assertEqual(percentile([0] * 11 + [1], 50), '>250')
+
+class TestKeyRegistry(TestCase):
+
+    def testBounded(self):
+        keys = KeyRegistry(size=3)
+        for k in ('a', 'b', 'c'):
+            keys.add(k)
+        keys.add('a')
+        keys.add('d')
+        self.assertEqual(len(keys), 3)
+        self.assertFalse('b' in keys)
+        self.assertEqual(keys.keys(), ['a', 'c', 'd'])
+
+    def testPrefix(self):
+        keys = KeyRegistry()
+        for k in ('x::1', 'x::2', 'x::2::a', 'x::3', 'y::1', 'x'):
+            keys.add(k)
+        self.assertEqual(keys.count('x::'), 4)
+        self.assertEqual(keys.page('x::', 1, 2), ['x::2', 'x::2::a'])
+        self.assertEqual(keys.page('x::', 3, 10), ['x::3'])
+        self.assertEqual(keys.pop_children('x::2::'), ['x::2::a'])
+        self.assertEqual(keys.count('x::'), 3)
+
+    def testDiscard(self):
+        keys = KeyRegistry()
+        keys.add('k')
+        self.assert_(keys.discard('k'))
+        self.assertFalse(keys.discard('k'))
+        self.assertEqual(keys.keys(), [])
+
+class TestBenchmarks(TestCase):
+
+    def testPercentiles(self):
+        p = benchmarks.percentiles(range(1, 101))
+        self.assertEqual((p['p50'], p['p95'], p['p99']), (50, 95, 99))
+        self.assertEqual(benchmarks.percentiles([])['p50'], None)
+
+    def testBackendRun(self):
+        rows = benchmarks.bench_backend(cache, 10, 16)
+        ops = [row['operation'] for row in rows]
+        self.assert_('cache_get' in ops)
+        self.assert_('cache_delete children' in ops)
+        for row in rows:
+            self.assert_(row['ops_per_sec'] > 0)
+
+class TestRequestMemo(TestCase):
+
+    def setUp(self):
+        self.middleware = RequestMemoMiddleware()
+
+    def testOncePerRequest(self):
+        start = MEMO_CALLS
+        self.middleware.process_request(None)
+        memotest(1)
+        memotest(1)
+        memotest(2)
+        self.assertEqual(MEMO_CALLS, start + 2)
+        self.middleware.process_response(None, None)
+
+        self.middleware.process_request(None)
+        memotest(1)
+        self.assertEqual(MEMO_CALLS, start + 3)
+        self.middleware.process_response(None, None)
+
+    def testOutsideRequest(self):
+        start = MEMO_CALLS
+        memotest(1)
+        memotest(1)
+        self.assertEqual(MEMO_CALLS, start + 2)
+
+    def testFindForgottenOnSave(self):
+        self.middleware.process_request(None)
+        try:
+            self.assertEqual(find_by_slug(RegisteredThing, 'registered-slug', 'memo'), None)
+            thing = RegisteredThing.objects.create(slug='memo')
+            self.assertEqual(find_by_slug(RegisteredThing, 'registered-slug', 'memo'), thing)
+        finally:
+            self.middleware.process_response(None, None)
+
+class FakeNode(object):
+    """An in-process cache node which can be made to stop responding."""
+
+    def __init__(self):
+        self.data = {}
+        self.failing = False
+
+    def _check(self):
+        if self.failing:
+            raise IOError('node down')
+
+    def get(self, key, default=None):
+        self._check()
+        return self.data.get(key, default)
+
+    def set(self, key, value, timeout=None):
+        self._check()
+        self.data[key] = value
+
+    def add(self, key, value, timeout=None):
+        self._check()
+        if key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    def delete(self, key):
+        self._check()
+        self.data.pop(key, None)
+
+    def incr(self, key, delta=1):
+        self._check()
+        if key not in self.data:
+            raise ValueError("Key '%s' not found" % key)
+        self.data[key] += delta
+        return self.data[key]
+
+    def get_many(self, keys):
+        self._check()
+        return dict([(k, self.data[k]) for k in keys if k in self.data])
+
+    def set_many(self, data, timeout=None):
+        self._check()
+        self.data.update(data)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def clear(self):
+        self._check()
+        self.data.clear()
+
+class TestMultiNode(TestCase):
+
+    def setUp(self):
+        self.nodes = [('node%i' % i, FakeNode()) for i in range(0, 4)]
+        self.cache = MultiNodeCache(backends=self.nodes, retry_after=60)
+
+    def testSpread(self):
+        for i in range(0, 1000):
+            self.cache.set('key%i' % i, i)
+        for name, node in self.nodes:
+            self.assert_(150 < len(node.data) < 350, (name, len(node.data)))
+        self.assertEqual(self.cache.get('key10'), 10)
+        self.assertEqual(len(self.cache.get_many(['key%i' % i for i in range(0, 1000)])), 1000)
+
+    def testAddNodeRemapsFewKeys(self):
+        keys = ['key%i' % i for i in range(0, 2000)]
+        before = dict([(k, self.cache.ring.get_node(k).name) for k in keys])
+        self.cache.add_node('node4', FakeNode())
+        moved = [k for k in keys if self.cache.ring.get_node(k).name != before[k]]
+        # a fifth node should take about a fifth of the keys, all of them
+        self.assert_(len(moved) < len(keys) * 0.3, len(moved))
+        for k in moved:
+            self.assertEqual(self.cache.ring.get_node(k).name, 'node4')
+
+        self.cache.remove_node('node4')
+        for k in keys:
+            self.assertEqual(self.cache.ring.get_node(k).name, before[k])
+
+    def testNodeDown(self):
+        node = self.cache.ring.get_node('down')
+        node.backend.failing = True
+        self.assertEqual(self.cache.get('down', 'default'), 'default')
+        self.failIf(node.is_up())
+        self.assertEqual(node.errors, 1)
+
+        # its keys go to another node until it answers again
+        self.cache.set('down', 'value')
+        self.assertEqual(self.cache.get('down'), 'value')
+        self.assertNotEqual(self.cache.ring.get_node('down'), node)
+
+        node.backend.failing = False
+        self.assertEqual(len(self.cache.check()), 4)
+        self.assert_(node.is_up())
+        self.assertEqual(self.cache.ring.get_node('down'), node)
+
+    def testIncrMissingIsNotAFailure(self):
+        self.assertRaises(ValueError, self.cache.incr, 'counter')
+        self.assertEqual(len(self.cache.up_nodes()), 4)
+        self.cache.set('counter', 1)
+        self.assertEqual(self.cache.incr('counter', 2), 3)
+
+    def testFlushAll(self):
+        for i in range(0, 100):
+            self.cache.set('key%i' % i, i)
+        self.cache.flush_all()
+        for name, node in self.nodes:
+            self.assertEqual(node.data, {})
+
+    def testRequire(self):
+        orig = caching.cache
+        caching.cache = self.cache
+        try:
+            self.assert_(caching.cache_require())
+            for name, node in self.nodes[1:]:
+                node.failing = True
+            self.assert_(caching.cache_require())
+            self.assertEqual(len(self.cache.up_nodes()), 1)
+            self.nodes[0][1].failing = True
+            self.assertRaises(caching.CacheNotRespondingError, caching.cache_require)
+        finally:
+            caching.cache = orig
+
+    def testNodeStats(self):
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.cache.get('b')
+        stats = self.cache.node_stats()
+        self.assertEqual([s['name'] for s in stats], ['node0', 'node1', 'node2', 'node3'])
+        self.assertEqual(sum([s['sets'] for s in stats]), 1)
+        self.assertEqual(sum([s['gets'] for s in stats]), 2)
+        self.assertEqual(sum([s['hits'] for s in stats]), 1)
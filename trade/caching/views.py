@@ -49,6 +49,30 @@ def stats_page(request):
     else:
         rate = 0
 
+    l1_calls = caching.L1_CACHE.hits + caching.L1_CACHE.misses
+    if l1_calls:
+        l1_rate = float(caching.L1_CACHE.hits)/l1_calls*100
+    else:
+        l1_rate = 0
+
+    sizes = caching.CACHE_SIZES.values()
+    sizes.sort(key=lambda x: x['bytes'], reverse=True)
+
+    if caching.STATS.enabled:
+        fleet = caching.STATS.fleet()
+    else:
+        fleet = []
+
+    if caching.is_multinode_backend():
+        nodes = caching.cache.node_stats()
+        for node in nodes:
+            if node['gets']:
+                node['hit_rate'] = "%02.1f" % (float(node['hits'])/node['gets']*100)
+            else:
+                node['hit_rate'] = "0.0"
+    else:
+        nodes = []
+
     try:
         running = caching.cache_require()
 
@@ -62,20 +86,43 @@ def stats_page(request):
         'cache_backend' : settings.CACHE_BACKEND,
         'cache_calls' : caching.CACHE_CALLS,
         'cache_hits' : caching.CACHE_HITS,
-        'hit_rate' : "%02.1f" % rate
+        'hit_rate' : "%02.1f" % rate,
+        'l1_enabled' : caching.L1_CACHE.enabled(),
+        'l1_count' : len(caching.L1_CACHE),
+        'l1_size' : caching.L1_CACHE.size,
+        'l1_hits' : caching.L1_CACHE.hits,
+        'l1_misses' : caching.L1_CACHE.misses,
+        'l1_hit_rate' : "%02.1f" % l1_rate,
+        'cache_sizes' : sizes,
+        'fleet_stats' : fleet,
+        'cache_nodes' : nodes,
     })
 
     return render_to_response('caching/stats.html', ctx)
 
 stats_page = user_passes_test(lambda u: u.is_authenticated() and u.is_staff, login_url='/accounts/login/')(stats_page)
 
+KEYS_PER_PAGE = 100
+
 def view_page(request):
-    keys = caching.CACHED_KEYS.keys()
+    prefix = request.GET.get('prefix', '')
+    if prefix:
+        prefix = caching.cache_key(prefix)
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
 
-    keys.sort()
+    total = caching.CACHED_KEYS.count(prefix)
+    keys = caching.CACHED_KEYS.page(prefix, (page - 1) * KEYS_PER_PAGE, KEYS_PER_PAGE)
 
     ctx = RequestContext(request, {
         'cached_keys' : keys,
+        'prefix' : request.GET.get('prefix', ''),
+        'page' : page,
+        'total' : total,
+        'has_previous' : page > 1,
+        'has_next' : page * KEYS_PER_PAGE < total,
     })
 
     return render_to_response('caching/view.html', ctx)
@@ -1,6 +1,8 @@
 from django.db.models.fields.related import RelatedField, Field, ManyToManyRel
 from django.contrib.contenttypes.models import ContentType
 
+from trade.caching.request import request_memo
+
 class RelatedMediaField(RelatedField, Field):
     """
     A Field that provides access to RelatedMediaManager, which allows any
@@ -51,6 +53,13 @@ class RelatedMediaField(RelatedField, Field):
             if rel not in opts._media_registry:
                 opts._media_registry.append(rel)
 
+    def bulk_related_objects(self, objs, using):
+        """The relations of ``objs``, deleted along with them like the
+        rows of a GenericRelation."""
+        ctype = ContentType.objects.db_manager(using).get_for_model(self.model)
+        return self.to._base_manager.db_manager(using).filter(content_type=ctype,
+            object_id__in=[obj.pk for obj in objs])
+
     def m2m_db_table(self):
         return self.rel.to._meta.db_table
 
@@ -128,7 +137,7 @@ def create_related_media_manager(superclass, relation_class, media_class):
         def __init__(self, instance, model):
             self.instance = instance
             self.model = model
-            self.ctype = ContentType.objects.get_for_model(self.model)
+            self.ctype = request_memo(('ctype', self.model), ContentType.objects.get_for_model, self.model)
 
             if instance.pk is None:
                 raise ValueError("%r instance needs to have a primary key value before this relation can be used." %
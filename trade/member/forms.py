@@ -4,7 +4,7 @@ from django import forms
 from django.contrib.localflavor.ar import forms as flavorForms
 from django.forms import ModelForm
 
-from trade.member.models import UserProfile
+from trade.member.models import Member, UserProfile
 
 class ProfileForm(ModelForm):
 
@@ -12,4 +12,12 @@ class ProfileForm(ModelForm):
     postal_code = flavorForms.ARPostalCodeField(required=False)
 
     class Meta:
-        model = UserProfile
\ No newline at end of file
+        model = UserProfile
+
+class WantsForm(ModelForm):
+    """What the member is looking for, matched against the listings of
+    the others."""
+
+    class Meta:
+        model = Member
+        fields = ('wants',)
\ No newline at end of file
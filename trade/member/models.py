@@ -1,7 +1,14 @@
 
 from django.db import models
+from django.db.models import F
+from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import User
 
+from tagging.fields import TagField
+
+from trade.caching.models import register_cache_groups
+from trade.caching.request import request_memoize
+
 class Member(models.Model):
     user = models.ForeignKey(User, null=True, blank=True, unique= True)
     profile = models.ForeignKey("UserProfile", unique=True, related_name="member_list")
@@ -9,12 +16,49 @@ class Member(models.Model):
     last_name = models.CharField(max_length=100, null=True)
     email = models.EmailField(max_length=200)
     accept_terms = models.BooleanField(default=False)
+    wants = TagField(verbose_name=_('wants'), blank=True,
+        help_text=_(u'Write space or comma separated words that describe what you are looking for.'))
+
+    # kept by trade.transaction.models as offers come and go
+    unread_offers = models.PositiveIntegerField(default=0, editable=False)
+    pending_received_offers = models.PositiveIntegerField(default=0, editable=False)
+    pending_sent_offers = models.PositiveIntegerField(default=0, editable=False)
     create_time = models.DateTimeField("created on", auto_now_add=True)
     update_time = models.DateTimeField("last updated on", auto_now=True)
 
     def __unicode__(self):
         return u"%s (%s)" % (self.user.username, self.email)
 
+    def save(self, *args, **kwargs):
+        counts = None
+        if self.pk:
+            # the offer counters are only written by queryset updates: the
+            # row is saved with them set to themselves, so changes made
+            # between this read and the UPDATE are kept
+            counts = Member.objects.filter(pk=self.pk).values_list(*OFFER_COUNTERS)
+            if counts:
+                counts = counts[0]
+                for name in OFFER_COUNTERS:
+                    setattr(self, name, F(name))
+        try:
+            super(Member, self).save(*args, **kwargs)
+        finally:
+            if counts:
+                for name, value in zip(OFFER_COUNTERS, counts):
+                    setattr(self, name, value)
+
+OFFER_COUNTERS = ('unread_offers', 'pending_received_offers', 'pending_sent_offers')
+
+register_cache_groups(Member, ('member', 'pk'), ('member-user', 'user_id'))
+
+def member_for_user(user):
+    """The Member of ``user``, looked up once per request."""
+    return _member_for_user_id(user.pk)
+
+@request_memoize
+def _member_for_user_id(user_id):
+    return Member.objects.get(user__pk=user_id)
+
 
 GENDER_OPTIONS = (("F", "Femenino"),("M", "Masculino"))
 
@@ -11,20 +11,21 @@ from django.http import HttpResponse, HttpResponseRedirect
 from django.core.urlresolvers import reverse
 from django.forms.models import inlineformset_factory
 
-from trade.member.models import Member
-from trade.member.forms import ProfileForm
+from trade.member.models import Member, member_for_user
+from trade.member.forms import ProfileForm, WantsForm
+from trade.transaction.matching import matches_for_member
 
 @login_required
 def dashboard(request):
 
     try:
-        member = Member.objects.get(user=request.user)
+        member = member_for_user(request.user)
     except:
         return HttpResponseRedirect(reverse('account_login'))
 
     data = {
         'member': member,
-
+        'matches': matches_for_member(member, limit=10),
     }
 
     return render_to_response('member/dashboard.html', data,
@@ -37,14 +38,19 @@ def perfil_edit(request):
 
     if request.method == 'POST':
         form = ProfileForm(data=request.POST, instance=member.profile)
-        if form.is_valid():
+        wants_form = WantsForm(data=request.POST, instance=member)
+        if form.is_valid() and wants_form.is_valid():
             form.save()
+            # saving the member updates the match index
+            wants_form.save()
         return HttpResponseRedirect(reverse('member_home'))
     else:
         form = ProfileForm(instance = member.profile)
+        wants_form = WantsForm(instance=member)
 
     data = {
         'form': form,
+        'wants_form': wants_form,
 
     }
     return render_to_response('member/perfil_edit.html', data,
@@ -0,0 +1,149 @@
+"""Incremental search indexing off the request thread.
+
+Saving or deleting an object only records its id.  A background thread
+wakes every ``delay`` seconds and pushes the changed objects to the search
+backend ``batch_size`` at a time, removing the ones its index no longer
+covers, so the index is seconds behind the database without full rebuilds.
+
+The queue only lives in memory, so every ``reconcile_interval`` seconds, and
+once when the thread starts, the thread also queues what a restart may have
+lost: the ids in the index that its queryset no longer has, and the objects
+updated in the last interval.
+"""
+
+import threading
+import time
+import logging
+from datetime import datetime, timedelta
+
+from django.db import connection
+
+log = logging.getLogger('product.indexing')
+
+class IndexUpdater(object):
+    """Queues the ids of changed ``model`` instances for ``index``."""
+
+    def __init__(self, model, batch_size=100, delay=5, index=None, reconcile_interval=60*60):
+        self.model = model
+        self.batch_size = batch_size
+        self.delay = delay
+        self.reconcile_interval = reconcile_interval
+        self._index = index
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def index(self):
+        if self._index is None:
+            from haystack import site
+            self._index = site.get_index(self.model)
+        return self._index
+
+    def changed(self, pk):
+        """Schedule the object with primary key ``pk`` for reindexing."""
+        self._lock.acquire()
+        try:
+            self._pending.add(pk)
+            if self._thread is None and self.delay:
+                self._thread = threading.Thread(target=self._run,
+                    name='index-%s' % self.model._meta.module_name)
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def pending(self):
+        return len(self._pending)
+
+    def reconcile(self, since=None):
+        """Queue the ids the index holds that are no longer in its queryset,
+        and the objects updated after the datetime ``since``.  Returns how
+        many were queued."""
+        index = self.index()
+        current = set(index.get_queryset().values_list('pk', flat=True))
+        queued = set([pk for pk in self.indexed_ids() if pk not in current])
+        updated_field = getattr(index, 'get_updated_field', lambda: None)()
+        if since is not None and updated_field:
+            queued.update(index.get_queryset().filter(
+                **{updated_field + '__gte' : since}).values_list('pk', flat=True))
+
+        self._lock.acquire()
+        try:
+            self._pending.update(queued)
+        finally:
+            self._lock.release()
+        log.debug("Queued %i %s to reconcile the index", len(queued),
+            self.model._meta.verbose_name_plural)
+        return len(queued)
+
+    def indexed_ids(self):
+        """The primary keys of the objects in the index."""
+        from haystack.query import SearchQuerySet
+        return [self.model._meta.pk.to_python(result.pk)
+            for result in SearchQuerySet().models(self.model)]
+
+    def flush(self):
+        """Index everything pending now, returning how many were handled."""
+        done = 0
+        while True:
+            self._lock.acquire()
+            try:
+                batch = []
+                while self._pending and len(batch) < self.batch_size:
+                    batch.append(self._pending.pop())
+            finally:
+                self._lock.release()
+            if not batch:
+                return done
+
+            try:
+                self.update(batch)
+                done += len(batch)
+            except Exception, e:
+                # try again on the next round, e.g. when another process
+                # holds the index lock
+                log.warn("Could not index %i %s: %s", len(batch),
+                    self.model._meta.verbose_name_plural, e)
+                self._lock.acquire()
+                try:
+                    self._pending.update(batch)
+                finally:
+                    self._lock.release()
+                return done
+
+    def update(self, ids):
+        """Index the objects ``ids`` with one query and one backend call,
+        removing those no longer in the indexed queryset."""
+        index = self.index()
+        objects = list(index.get_queryset().filter(pk__in=ids))
+        if objects:
+            index.backend.update(index, objects)
+        found = set([ob.pk for ob in objects])
+        opts = self.model._meta
+        for pk in ids:
+            if pk not in found:
+                index.backend.remove('%s.%s.%s' % (opts.app_label, opts.module_name, pk))
+        log.debug("Indexed %i and removed %i %s", len(found), len(ids) - len(found),
+            opts.verbose_name_plural)
+
+    def _run(self):
+        last_reconcile = None
+        while True:
+            time.sleep(self.delay)
+            try:
+                if self.reconcile_interval and (last_reconcile is None
+                        or time.time() - last_reconcile >= self.reconcile_interval):
+                    last_reconcile = time.time()
+                    self._reconcile_safely(datetime.now() - timedelta(
+                        seconds=self.reconcile_interval))
+                self.flush()
+            finally:
+                # the thread keeps its own database connection otherwise
+                connection.close()
+
+    def _reconcile_safely(self, since):
+        try:
+            self.reconcile(since)
+        except Exception, e:
+            log.warn("Could not reconcile the %s index: %s",
+                self.model._meta.verbose_name, e)
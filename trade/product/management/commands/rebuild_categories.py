@@ -0,0 +1,20 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from trade.product.models import rebuild_category_counts, rebuild_category_paths
+
+class Command(NoArgsCommand):
+    help = "Recomputes the materialized path and the product counts of every category."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--counts-only', action='store_true', dest='counts_only', default=False,
+            help='Only recount the products, leaving the paths alone.'),
+    )
+
+    def handle_noargs(self, **options):
+        if not options['counts_only']:
+            count = rebuild_category_paths()
+            self.stdout.write("Rebuilt the paths of %i categories\n" % count)
+        count = rebuild_category_counts()
+        self.stdout.write("Recounted the products of %i categories\n" % count)
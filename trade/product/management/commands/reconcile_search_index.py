@@ -0,0 +1,22 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from trade.product.search_indexes import PRODUCT_UPDATER
+
+class Command(NoArgsCommand):
+    help = ("Removes from the search index the products it should no longer "
+        "have, and reindexes the ones updated recently, e.g. after a restart "
+        "lost the queue of pending changes.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--hours', type='int', dest='hours', default=24,
+            help='Reindex the products updated in the last HOURS hours (default 24).'),
+    )
+
+    def handle_noargs(self, **options):
+        since = datetime.now() - timedelta(hours=options['hours'])
+        queued = PRODUCT_UPDATER.reconcile(since)
+        done = PRODUCT_UPDATER.flush()
+        self.stdout.write("Queued %i products, indexed or removed %i\n" % (queued, done))
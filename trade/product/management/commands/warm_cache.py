@@ -0,0 +1,146 @@
+import Queue
+import threading
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+
+from trade import caching
+from trade.caching.models import cache_groups
+from trade.product.models import Category, Product
+from trade.product.views import detail_fragment
+
+WARMABLE = {
+    'category' : lambda: Category.objects.filter(published=True),
+    'product' : lambda: Product.objects.filter(published=True, active=True),
+}
+
+# rendered fragments cached per object besides the object itself, see
+# product.views.detail_fragment
+FRAGMENTS = {
+    'product' : detail_fragment,
+}
+
+class RateLimiter(object):
+    """Spaces out work shared by several threads to ``rate`` objects per
+    second, 0 meaning no limit."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self, count):
+        if not self.rate:
+            return
+        self._lock.acquire()
+        try:
+            now = time.time()
+            start = max(self._next, now)
+            self._next = start + count / float(self.rate)
+        finally:
+            self._lock.release()
+        if start > now:
+            time.sleep(start - now)
+
+class Command(NoArgsCommand):
+    help = "Pre-populates the cache with the published catalog, for use after a deploy or a cache restart."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--models', dest='models', default='category,product',
+            help='Comma separated models to warm: %s.' % ', '.join(sorted(WARMABLE))),
+        make_option('--batch-size', dest='batch_size', type='int', default=200,
+            help='Objects loaded and cached per query.'),
+        make_option('--threads', dest='threads', type='int', default=4,
+            help='Worker threads.'),
+        make_option('--rate', dest='rate', type='float', default=0,
+            help='Most objects cached per second, 0 for no limit.'),
+        make_option('--no-fragments', action='store_false', dest='fragments', default=True,
+            help='Cache the objects only, not their rendered detail pages.'),
+    )
+
+    def handle_noargs(self, **options):
+        if not caching.cache_enabled():
+            raise CommandError("Caching is disabled.")
+
+        names = [n.strip() for n in options['models'].split(',') if n.strip()]
+        for name in names:
+            if name not in WARMABLE:
+                raise CommandError("Unknown model to warm: %s" % name)
+
+        limiter = RateLimiter(options['rate'])
+        for name in names:
+            fragment = options['fragments'] and FRAGMENTS.get(name) or None
+            self.warm(name, WARMABLE[name](), options['batch_size'],
+                options['threads'], limiter, fragment)
+
+    def warm(self, name, queryset, batch_size, threads, limiter, fragment=None):
+        groups = cache_groups(queryset.model)
+        ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+        total = len(ids)
+        self.stdout.write("%s: warming %i objects in %i groups\n" % (name, total, len(groups)))
+        if not total or not groups:
+            return
+
+        batches = Queue.Queue()
+        for i in range(0, total, batch_size):
+            batches.put(ids[i:i + batch_size])
+
+        progress = {'done' : 0, 'errors' : 0}
+        lock = threading.Lock()
+        start = time.time()
+
+        def worker():
+            try:
+                while True:
+                    try:
+                        batch = batches.get_nowait()
+                    except Queue.Empty:
+                        return
+                    limiter.wait(len(batch))
+                    try:
+                        warmed = self.warm_batch(queryset, groups, batch, fragment)
+                    except Exception, e:
+                        warmed = 0
+                        lock.acquire()
+                        progress['errors'] += 1
+                        lock.release()
+                        self.stderr.write("%s: batch starting at pk %s failed: %s\n" % (name, batch[0], e))
+
+                    lock.acquire()
+                    try:
+                        progress['done'] += warmed
+                        elapsed = time.time() - start
+                        self.stdout.write("%s: %i/%i (%.1f objects/s)\n" % (name,
+                            progress['done'], total, progress['done'] / max(elapsed, 0.001)))
+                    finally:
+                        lock.release()
+            finally:
+                # each thread has its own database connection
+                connection.close()
+
+        workers = [threading.Thread(target=worker) for x in range(0, max(threads, 1))]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+
+        elapsed = time.time() - start
+        self.stdout.write("%s: %i objects cached in %.1fs (%.1f objects/s), %i failed batches\n" % (
+            name, progress['done'], elapsed, progress['done'] / max(elapsed, 0.001), progress['errors']))
+
+    def warm_batch(self, queryset, groups, batch, fragment=None):
+        """Load one batch with a single query and cache every object under
+        each of its groups with a single backend call, then render the
+        ``fragment`` of each object not cached yet."""
+        objects = list(queryset.filter(pk__in=batch))
+        items = []
+        for ob in objects:
+            for groupkey, attr in groups:
+                items.append(((groupkey, getattr(ob, attr)), ob))
+        caching.cache_set_many(items)
+        if fragment is not None:
+            for ob in objects:
+                fragment(ob)
+        return len(objects)
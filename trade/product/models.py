@@ -1,20 +1,35 @@
 # -*- coding: utf-8 -*-
 
+from datetime import datetime
+
 from django.contrib.auth.models import User
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import connection, models, transaction
+from django.db.models import signals, Count, F
+from django.utils.datastructures import SortedDict
 from django.utils.translation import ugettext
 from django.utils.translation import ugettext_lazy as _
 
 from tagging.fields import TagField
 
-from trade.utils.fields import AutoSlugField
+from trade import caching
+from trade.caching.models import forget_cached, register_cache_groups
+from trade.utils.fields import AutoSlugField, SlugRetryMixin
 
 from trade.media.models import RelatedImagesField
+from trade.member.models import Member
+
 
+# Width of each id in Category.path, e.g. "000001/000012/".
+PATH_DIGITS = 6
 
-class Category(models.Model):
+class Category(SlugRetryMixin, models.Model):
     """
     Basic hierarchical category model for storing products.
+
+    Besides ``parent``, each category stores the materialized ``path`` of
+    ids from the root down to itself, so a subtree or the ancestors are
+    fetched with one query.
     """
 
     name = models.CharField(_(u'name'), max_length=200)
@@ -28,22 +43,212 @@ class Category(models.Model):
 
     published = models.BooleanField(default=False)
 
+    path = models.CharField(max_length=255, db_index=True, editable=False, blank=True)
+    depth = models.PositiveIntegerField(default=0, editable=False)
+
+    # published, active products directly in this category and in its
+    # whole subtree, maintained by the Product signal handlers below
+    product_count = models.PositiveIntegerField(default=0, editable=False)
+    total_product_count = models.PositiveIntegerField(default=0, editable=False)
+
     class Meta:
         ordering = ['name']
         verbose_name = _("product category")
         verbose_name_plural = _("product categories")
 
     def __unicode__(self):
-        if self.parent:
-            return u'%s -- %s' % (self.parent, self.name)
-        else:
+        if not self.parent_id:
             return self.name
+        # names come from the cached tree instead of self.parent, which
+        # costs a query per level
+        tree = category_tree()
+        names = [tree[pk]['name'] for pk in self._ancestor_ids() if pk in tree]
+        names.append(self.name)
+        return u' -- '.join(names)
 
     @models.permalink
     def get_absolute_url(self):
         pass
 
-class Product(models.Model):
+    def clean(self):
+        if self.parent_id:
+            prefix = self._parent_path()
+            if self.pk and self._below_self(prefix):
+                raise ValidationError(_(u'A category cannot be moved below itself.'))
+
+    def _parent_path(self):
+        paths = Category.objects.filter(pk=self.parent_id).values_list('path', flat=True)
+        if not paths:
+            raise ValidationError(_(u'The parent category does not exist.'))
+        return paths[0]
+
+    def _below_self(self, prefix):
+        return (u'/%0*d/' % (PATH_DIGITS, self.pk)) in (u'/' + prefix)
+
+    def save(self, *args, **kwargs):
+        old_path = self.path
+        counts = None
+        if self.pk:
+            self._set_path()
+            # the counters are only written by queryset updates: the row is
+            # saved with them set to themselves, so increments made between
+            # this read and the UPDATE are kept
+            counts = Category.objects.filter(pk=self.pk).values_list(
+                'product_count', 'total_product_count')
+            if counts:
+                counts = counts[0]
+                self.product_count = F('product_count')
+                self.total_product_count = F('total_product_count')
+        try:
+            super(Category, self).save(*args, **kwargs)
+        finally:
+            if counts:
+                self.product_count, self.total_product_count = counts
+        if not old_path or old_path != self.path:
+            if not self.path:
+                self._set_path()
+                Category.objects.filter(pk=self.pk).update(path=self.path, depth=self.depth)
+            if old_path:
+                self._move_descendants(old_path, old_path.count('/') - 1)
+                if self.total_product_count:
+                    # the subtree's products leave the old ancestors
+                    _count_products(_path_ids(old_path)[:-1], 0, -self.total_product_count)
+                    _count_products(_path_ids(self.path)[:-1], 0, self.total_product_count)
+            _category_changed(Category, self)
+
+    def _set_path(self):
+        prefix = u''
+        if self.parent_id:
+            prefix = self._parent_path()
+            if self._below_self(prefix):
+                # clean() reports this to forms, this guards the tree
+                raise ValidationError(_(u'A category cannot be moved below itself.'))
+        self.path = prefix + u'%0*d/' % (PATH_DIGITS, self.pk)
+        self.depth = self.path.count('/') - 1
+
+    def _move_descendants(self, old_path, old_depth):
+        """Rewrite the paths below ``old_path`` after this category moved,
+        with a single update."""
+        table = connection.ops.quote_name(Category._meta.db_table)
+        if connection.vendor == 'mysql':
+            new_path = 'CONCAT(%s, SUBSTR(path, %s))'
+        else:
+            new_path = '%s || SUBSTR(path, %s)'
+        cursor = connection.cursor()
+        cursor.execute('UPDATE ' + table + ' SET path = ' + new_path + ', depth = depth + %s'
+            ' WHERE path LIKE %s AND id <> %s', [self.path, len(old_path) + 1,
+            self.depth - old_depth, old_path + '%', self.pk])
+        transaction.commit_unless_managed()
+
+        for child in Category.objects.filter(path__startswith=self.path).exclude(pk=self.pk):
+            forget_cached(child)
+
+    def _ancestor_ids(self):
+        if self.path:
+            return _path_ids(self.path)[:-1]
+        # not saved yet, follow the parents in the cached tree
+        ids = []
+        tree = category_tree()
+        parent = self.parent_id
+        while parent in tree and parent not in ids:
+            ids.insert(0, parent)
+            parent = tree[parent]['parent']
+        return ids
+
+    def get_ancestors(self):
+        """The categories above this one, root first, in one query."""
+        ids = self._ancestor_ids()
+        if not ids:
+            return Category.objects.none()
+        return Category.objects.filter(pk__in=ids).order_by('depth')
+
+    def get_descendants(self, include_self=False):
+        """Every category below this one, in one query."""
+        qs = Category.objects.filter(path__startswith=self.path).order_by('path')
+        if not include_self:
+            qs = qs.exclude(pk=self.pk)
+        return qs
+
+    def get_products(self):
+        """The products in this category or any below it."""
+        return Product.objects.filter(category__path__startswith=self.path)
+
+    def breadcrumbs(self):
+        """The cached tree nodes from the root down to this category."""
+        tree = category_tree()
+        return [tree[pk] for pk in self._ancestor_ids() + [self.pk] if pk in tree]
+
+def _path_ids(path):
+    return [int(x) for x in path.split('/')[:-1]]
+
+def category_tree():
+    """Every category as a dict of id, name, slug, parent, path, depth and
+    product counts, keyed by id in tree order, from one query."""
+    tree = SortedDict()
+    for pk, name, slug, parent, path, depth, count, total in Category.objects.order_by(
+            'path').values_list('pk', 'name', 'slug', 'parent', 'path', 'depth',
+            'product_count', 'total_product_count'):
+        tree[pk] = {'id' : pk, 'name' : name, 'slug' : slug, 'parent' : parent,
+            'path' : path, 'depth' : depth, 'product_count' : count,
+            'total_product_count' : total}
+    return tree
+
+category_tree = caching.cache_function()(category_tree)
+
+def _category_changed(sender, instance, **kwargs):
+    caching.cache_delete_function(category_tree)
+    # detail pages show the category's full name, renaming or moving one
+    # changes it for every product below
+    caching.cache_namespace_bump(*DETAIL_NAMESPACE)
+
+def rebuild_category_paths():
+    """Recompute every path from ``parent``, for rows saved before paths
+    existed.  Returns the number of categories updated."""
+    parents = dict(Category.objects.values_list('pk', 'parent'))
+    paths = {}
+
+    def path_of(pk, seen=()):
+        if pk not in paths:
+            parent = parents[pk]
+            if parent and parent in parents and parent not in seen:
+                prefix = path_of(parent, seen + (pk,))
+            else:
+                prefix = u''
+            paths[pk] = prefix + u'%0*d/' % (PATH_DIGITS, pk)
+        return paths[pk]
+
+    for pk in parents:
+        path = path_of(pk)
+        Category.objects.filter(pk=pk).update(path=path, depth=path.count('/') - 1)
+    caching.cache_delete_function(category_tree)
+    return len(parents)
+
+def rebuild_category_counts():
+    """Recount the products of every category with one aggregate query,
+    writing one update per distinct pair of counts.  Returns the number of
+    categories."""
+    direct = dict(Product.objects.filter(**COUNTED).values('category').annotate(
+        n=Count('pk')).values_list('category', 'n'))
+    paths = dict(Category.objects.values_list('pk', 'path'))
+    totals = dict([(pk, 0) for pk in paths])
+    for pk, count in direct.items():
+        if pk in paths:
+            for ancestor in _path_ids(paths[pk]):
+                if ancestor in totals:
+                    totals[ancestor] += count
+
+    updates = {}
+    for pk in paths:
+        updates.setdefault((direct.get(pk, 0), totals[pk]), []).append(pk)
+    for (count, total), ids in updates.items():
+        Category.objects.filter(pk__in=ids).update(product_count=count, total_product_count=total)
+    caching.cache_delete_function(category_tree)
+    return len(paths)
+
+signals.post_save.connect(_category_changed, sender=Category, dispatch_uid='product-category-tree')
+signals.post_delete.connect(_category_changed, sender=Category, dispatch_uid='product-category-tree')
+
+class Product(SlugRetryMixin, models.Model):
 
     def get_upload_to(self, filename):
         return 'img/%s/main/%s' %(self.slug, filename)
@@ -113,3 +318,112 @@ class MemberProduct(models.Model):
     product = models.ForeignKey("product.Product", related_name="members")
     create_time = models.DateTimeField("created on", auto_now_add=True)
     update_time = models.DateTimeField("last updated on", auto_now=True)
+
+register_cache_groups(Category, ('category', 'pk'), ('category-slug', 'slug'))
+register_cache_groups(Product, ('product', 'pk'), ('product-slug', 'slug'))
+
+# The products a category's counts include.
+COUNTED = {'published' : True, 'active' : True}
+
+def _counted_category(product):
+    if product.published and product.active:
+        return product.category_id
+    return None
+
+def _count_products(ids, direct, total, leaf=None):
+    """Add ``total`` to the recursive count of the categories ``ids``, and
+    ``direct`` to the direct count of ``leaf``."""
+    if leaf and direct:
+        Category.objects.filter(pk=leaf).update(product_count=F('product_count') + direct)
+    if ids and total:
+        Category.objects.filter(pk__in=ids).update(
+            total_product_count=F('total_product_count') + total)
+    for category in Category.objects.filter(pk__in=ids):
+        forget_cached(category)
+    caching.cache_delete_function(category_tree)
+
+def _move_product_count(category_id, delta):
+    path = Category.objects.filter(pk=category_id).values_list('path', flat=True)
+    if path:
+        _count_products(_path_ids(path[0]) or [category_id], delta, delta, leaf=category_id)
+
+def _remember_product_category(sender, instance, **kwargs):
+    instance._counted_category = _counted_category(instance)
+
+def _product_saved(sender, instance, created, **kwargs):
+    old = getattr(instance, '_counted_category', None)
+    if created:
+        old = None
+    new = _counted_category(instance)
+    if old != new:
+        if old:
+            _move_product_count(old, -1)
+        if new:
+            _move_product_count(new, 1)
+    instance._counted_category = new
+
+def _product_deleted(sender, instance, **kwargs):
+    old = getattr(instance, '_counted_category', None)
+    if old:
+        _move_product_count(old, -1)
+
+# the app is also importable as plain 'product', the uid keeps a second
+# import of this module from counting every product twice
+signals.post_init.connect(_remember_product_category, sender=Product,
+    dispatch_uid='product-category-counts')
+signals.post_save.connect(_product_saved, sender=Product,
+    dispatch_uid='product-category-counts')
+signals.post_delete.connect(_product_deleted, sender=Product,
+    dispatch_uid='product-category-counts')
+
+def product_detail(slug):
+    """The product with everything its detail page shows, in four queries
+    whatever the depth of its category: the product and category, then the
+    photos, related images and owning members as ``photo_list``,
+    ``image_list`` and ``member_list``."""
+    product = Product.objects.select_related('category').get(slug=slug)
+    product.photo_list = list(product.photos.all())
+    product.image_list = list(product.images.all())
+    product.member_list = [mp.member for mp in
+        MemberProduct.objects.filter(product=product).select_related('member__user')]
+    return product
+
+# cached detail fragments live in this namespace, see product.views
+DETAIL_NAMESPACE = ('product-detail',)
+
+def _product_touched(sender, instance, **kwargs):
+    # the detail fragment is cached on update_time, so changing what it
+    # shows must move it.  No save(): this also runs while the product
+    # itself is being deleted.
+    if Product.objects.filter(pk=instance.product_id).update(update_time=datetime.now()):
+        forget_cached(instance.product)
+
+for _model in (ProductPhoto, MemberProduct):
+    signals.post_save.connect(_product_touched, sender=_model, dispatch_uid='product-touched')
+    signals.post_delete.connect(_product_touched, sender=_model, dispatch_uid='product-touched')
+
+def _touch_member_products(member_id):
+    products = list(Product.objects.filter(members__member=member_id))
+    if products:
+        Product.objects.filter(pk__in=[p.pk for p in products]).update(
+            update_time=datetime.now())
+        for product in products:
+            forget_cached(product)
+
+def _member_saved(sender, instance, created, **kwargs):
+    if not created:
+        _touch_member_products(instance.pk)
+
+def _remember_username(sender, instance, **kwargs):
+    instance._detail_username = instance.username
+
+def _user_saved(sender, instance, created, **kwargs):
+    # saved on every login, only a new username shows on the detail pages
+    if not created and instance._detail_username != instance.username:
+        for member_id in Member.objects.filter(user=instance).values_list('pk', flat=True):
+            _touch_member_products(member_id)
+    instance._detail_username = instance.username
+
+signals.post_save.connect(_member_saved, sender=Member, dispatch_uid='product-touched')
+signals.post_init.connect(_remember_username, sender=User, dispatch_uid='product-touched')
+signals.post_save.connect(_user_saved, sender=User, dispatch_uid='product-touched')
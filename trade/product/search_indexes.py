@@ -1,7 +1,10 @@
 import datetime
+from django.conf import settings
+from django.db.models import signals
 from haystack.indexes import *
 from haystack import site
 
+from trade.product.indexing import IndexUpdater
 from trade.product.models import Product, Category
 
 class ProductIndex(SearchIndex):
@@ -12,7 +15,11 @@ class ProductIndex(SearchIndex):
 
     def get_queryset(self):
         """Used when the entire index for model is updated."""
-        return Event.objects.filter(published=True, type='event')
+        return Product.objects.filter(published=True, active=True)
+
+    def get_updated_field(self):
+        """Lets ``update_index --age`` reindex only recent changes."""
+        return 'update_time'
 
 class CategoryIndex(SearchIndex):
     description = CharField(document=True, use_template=True)
@@ -24,3 +31,14 @@ class CategoryIndex(SearchIndex):
 
 site.register(Product, ProductIndex)
 site.register(Category, CategoryIndex)
+
+PRODUCT_UPDATER = IndexUpdater(Product,
+    batch_size=getattr(settings, 'SEARCH_UPDATE_BATCH', 100),
+    delay=getattr(settings, 'SEARCH_UPDATE_DELAY', 5),
+    reconcile_interval=getattr(settings, 'SEARCH_RECONCILE_INTERVAL', 60*60))
+
+def _product_changed(sender, instance, **kwargs):
+    PRODUCT_UPDATER.changed(instance.pk)
+
+signals.post_save.connect(_product_changed, sender=Product, dispatch_uid='product-search-index')
+signals.post_delete.connect(_product_changed, sender=Product, dispatch_uid='product-search-index')
@@ -0,0 +1,390 @@
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import get_cache
+from django.core.exceptions import ValidationError
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+
+from trade import caching
+from trade.member.models import Member, UserProfile
+from trade.product.models import Category, Product, ProductPhoto, MemberProduct
+from trade.product.models import product_detail, rebuild_category_counts, rebuild_category_paths
+from trade.product.indexing import IndexUpdater
+from trade.product.views import detail_fragment
+from trade.utils.models import SlugCounter
+
+class ProductDetailTest(TestCase):
+
+    def setUp(self):
+        self.orig = caching.cache
+        caching.cache = get_cache('locmem://')
+        caching.L1_CACHE.clear()
+        ContentType.objects.get_for_model(Product)
+
+        parent = None
+        for name in ('Home', 'Kitchen', 'Pots', 'Iron pots'):
+            parent = Category.objects.create(name=name, parent=parent, published=True)
+        self.category = parent
+        self.product = Product.objects.create(name='Dutch oven', category=parent,
+            published=True, active=True)
+        for name in ('ana', 'bob'):
+            user = User.objects.create(username=name)
+            member = Member.objects.create(user=user, profile=UserProfile.objects.create(),
+                email='%s@example.com' % name)
+            MemberProduct.objects.create(member=member, product=self.product)
+
+    def tearDown(self):
+        caching.cache = self.orig
+        caching.L1_CACHE.clear()
+
+    def testCategoryName(self):
+        self.assertEqual(unicode(self.category), u'Home -- Kitchen -- Pots -- Iron pots')
+        self.assertNumQueries(0, unicode, self.category)
+
+    def testDetailQueries(self):
+        unicode(self.category)
+        with self.assertNumQueries(4):
+            product = product_detail(self.product.slug)
+        self.assertEqual(product.category, self.category)
+        self.assertEqual(sorted([m.user.username for m in product.member_list]), ['ana', 'bob'])
+        self.assertEqual(product.photo_list, [])
+
+    def testFragmentCachedOnUpdateTime(self):
+        unicode(self.category)
+        product = Product.objects.get(pk=self.product.pk)
+        with self.assertNumQueries(4):
+            fragment = detail_fragment(product)
+        self.assert_('Iron pots' in fragment)
+        with self.assertNumQueries(0):
+            self.assertEqual(detail_fragment(product), fragment)
+
+        # a new owner moves update_time, and so the fragment
+        user = User.objects.create(username='cid')
+        member = Member.objects.create(user=user, profile=UserProfile.objects.create(),
+            email='cid@example.com')
+        MemberProduct.objects.create(member=member, product=product)
+        product = Product.objects.get(pk=self.product.pk)
+        self.assert_('cid' in detail_fragment(product))
+
+    def testRootNameColdCache(self):
+        caching.cache.clear()
+        root = Category.objects.get(name='Home')
+        self.assertNumQueries(0, unicode, root)
+        self.assertEqual(unicode(root), u'Home')
+
+    def testFragmentFollowsCategoryAndOwners(self):
+        caching.cache.clear()
+        product = Product.objects.get(pk=self.product.pk)
+        self.assert_('Iron pots' in detail_fragment(product))
+
+        self.category.name = 'Cast iron pots'
+        self.category.save()
+        product = Product.objects.get(pk=self.product.pk)
+        self.assert_('Cast iron pots' in detail_fragment(product))
+
+        user = User.objects.get(username='ana')
+        user.username = 'anna'
+        user.save()
+        product = Product.objects.get(pk=self.product.pk)
+        self.assert_('anna' in detail_fragment(product))
+
+    def testPage(self):
+        url = reverse('product_detail', kwargs={'slug' : self.product.slug})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNumQueries(0, self.client.get, url)
+
+        response = self.client.get(reverse('product_detail', kwargs={'slug' : 'missing'}))
+        self.assertEqual(response.status_code, 404)
+
+class CategoryTreeTest(TestCase):
+
+    def setUp(self):
+        self.orig = caching.cache
+        caching.cache = get_cache('locmem://')
+        caching.L1_CACHE.clear()
+
+        self.home = Category.objects.create(name='Home')
+        self.kitchen = Category.objects.create(name='Kitchen', parent=self.home)
+        self.pots = Category.objects.create(name='Pots', parent=self.kitchen)
+        self.garden = Category.objects.create(name='Garden', parent=self.home)
+
+    def tearDown(self):
+        caching.cache = self.orig
+        caching.L1_CACHE.clear()
+
+    def testPaths(self):
+        self.assertEqual(self.pots.path, '%06d/%06d/%06d/' % (self.home.pk, self.kitchen.pk, self.pots.pk))
+        self.assertEqual(self.pots.depth, 2)
+        self.assertEqual(Category.objects.get(pk=self.pots.pk).path, self.pots.path)
+
+    def testSingleQueries(self):
+        with self.assertNumQueries(1):
+            ancestors = list(self.pots.get_ancestors())
+        self.assertEqual(ancestors, [self.home, self.kitchen])
+        with self.assertNumQueries(1):
+            descendants = list(self.home.get_descendants())
+        self.assertEqual(descendants, [self.kitchen, self.pots, self.garden])
+
+        product = Product.objects.create(name='Wok', category=self.pots)
+        self.assertEqual(list(self.kitchen.get_products()), [product])
+        self.assertEqual(list(self.garden.get_products()), [])
+
+    def testBreadcrumbs(self):
+        self.pots.breadcrumbs()
+        with self.assertNumQueries(0):
+            crumbs = self.pots.breadcrumbs()
+        self.assertEqual([c['name'] for c in crumbs], ['Home', 'Kitchen', 'Pots'])
+
+    def testMove(self):
+        self.kitchen.parent = self.garden
+        self.kitchen.save()
+        pots = Category.objects.get(pk=self.pots.pk)
+        self.assertEqual(pots.depth, 3)
+        self.assertEqual(unicode(pots), u'Home -- Garden -- Kitchen -- Pots')
+        self.assertEqual(list(self.garden.get_descendants()),
+            [Category.objects.get(pk=self.kitchen.pk), pots])
+
+        self.home.parent = pots
+        self.assertRaises(ValidationError, self.home.clean)
+        self.assertRaises(ValidationError, self.home.save)
+
+    def testMissingParent(self):
+        self.assertRaises(ValidationError, Category(name='Orphan', parent_id=999999).clean)
+        self.kitchen.parent_id = 999999
+        self.assertRaises(ValidationError, self.kitchen.clean)
+        self.assertRaises(ValidationError, self.kitchen.save)
+
+    def testMoveDeep(self):
+        wok = Category.objects.create(name='Wok', parent=self.pots)
+        self.kitchen.parent = None
+        self.kitchen.save()
+        wok = Category.objects.get(pk=wok.pk)
+        self.assertEqual(wok.path, '%06d/%06d/%06d/' % (self.kitchen.pk, self.pots.pk, wok.pk))
+        self.assertEqual(wok.depth, 2)
+
+    def testRebuild(self):
+        Category.objects.update(path='', depth=0)
+        rebuild_category_paths()
+        self.assertEqual(Category.objects.get(pk=self.pots.pk).path, self.pots.path)
+
+class CategoryCountTest(TestCase):
+
+    def setUp(self):
+        self.home = Category.objects.create(name='Home')
+        self.kitchen = Category.objects.create(name='Kitchen', parent=self.home)
+        self.garden = Category.objects.create(name='Garden', parent=self.home)
+
+    def counts(self, category):
+        category = Category.objects.get(pk=category.pk)
+        return category.product_count, category.total_product_count
+
+    def testIncremental(self):
+        wok = Product.objects.create(name='Wok', category=self.kitchen, published=True, active=True)
+        Product.objects.create(name='Draft', category=self.kitchen)
+        self.assertEqual(self.counts(self.kitchen), (1, 1))
+        self.assertEqual(self.counts(self.home), (0, 1))
+
+        wok.active = False
+        wok.save()
+        self.assertEqual(self.counts(self.kitchen), (0, 0))
+        self.assertEqual(self.counts(self.home), (0, 0))
+
+        wok.active = True
+        wok.category = self.garden
+        wok.save()
+        self.assertEqual(self.counts(self.kitchen), (0, 0))
+        self.assertEqual(self.counts(self.garden), (1, 1))
+        self.assertEqual(self.counts(self.home), (0, 1))
+
+        Product.objects.get(pk=wok.pk).delete()
+        self.assertEqual(self.counts(self.garden), (0, 0))
+        self.assertEqual(self.counts(self.home), (0, 0))
+
+    def testSaveKeepsConcurrentCounts(self):
+        stale = Category.objects.get(pk=self.kitchen.pk)
+        Product.objects.create(name='Wok', category=self.kitchen, published=True, active=True)
+        stale.name = 'Cooking'
+        stale.save()
+        self.assertEqual(self.counts(self.kitchen), (1, 1))
+        self.assertEqual((stale.product_count, stale.total_product_count), (1, 1))
+
+    def testMoveCategory(self):
+        Product.objects.create(name='Rake', category=self.garden, published=True, active=True)
+        other = Category.objects.create(name='Outdoors')
+        self.garden.parent = other
+        self.garden.save()
+        self.assertEqual(self.counts(self.home), (0, 0))
+        self.assertEqual(self.counts(other), (0, 1))
+        self.assertEqual(self.counts(self.garden), (1, 1))
+
+    def testSaveKeepsCounts(self):
+        stale = Category.objects.get(pk=self.kitchen.pk)
+        Product.objects.create(name='Wok', category=self.kitchen, published=True, active=True)
+        stale.name = 'Cooking'
+        stale.save()
+        self.assertEqual(self.counts(self.kitchen), (1, 1))
+
+    def testRebuild(self):
+        Product.objects.create(name='Wok', category=self.kitchen, published=True, active=True)
+        Product.objects.create(name='Rake', category=self.garden, published=True, active=True)
+        Category.objects.update(product_count=0, total_product_count=0)
+        rebuild_category_counts()
+        self.assertEqual(self.counts(self.home), (0, 2))
+        self.assertEqual(self.counts(self.kitchen), (1, 1))
+
+class SlugAllocationTest(TestCase):
+
+    def testNumbered(self):
+        slugs = [Product.objects.create(name='Bicicleta').slug for x in range(0, 4)]
+        self.assertEqual(slugs, ['bicicleta', 'bicicleta-2', 'bicicleta-3', 'bicicleta-4'])
+
+    def testNoScan(self):
+        for x in range(0, 20):
+            Product.objects.create(name='Bicicleta')
+        # the same handful of queries whatever the number of bicicletas
+        product = Product(name='Bicicleta')
+        field = Product._meta.get_field('slug')
+        self.assertNumQueries(4, field.pre_save, product, True)
+        self.assertEqual(product.slug, 'bicicleta-21')
+
+    def testSeededFromExisting(self):
+        Product.objects.create(name='Bicicleta')
+        Product.objects.create(name='Bicicleta', slug='bicicleta-7')
+        self.assertEqual(Product.objects.create(name='Bicicleta').slug, 'bicicleta-8')
+
+    def testSkipsTakenByHand(self):
+        Product.objects.create(name='Bicicleta')
+        Product.objects.create(name='Bicicleta')
+        Product.objects.create(name='Other', slug='bicicleta-3')
+        self.assertEqual(Product.objects.create(name='Bicicleta').slug, 'bicicleta-4')
+
+    def testResaveKeepsSlug(self):
+        Category.objects.create(name='Tools')
+        tools = Category.objects.create(name='Tools')
+        tools.description = 'Hammers'
+        tools.save()
+        self.assertEqual(Category.objects.get(pk=tools.pk).slug, 'tools-2')
+
+    def testRetryKeepsBase(self):
+        Product.objects.create(name='Bicicleta')
+        Product.objects.create(name='Bicicleta')
+        # as if bicicleta-2 had been handed out twice
+        SlugCounter.objects.update(last=1)
+        field = Product._meta.get_field('slug')
+        missed = []
+        def taken(others, slug):
+            # the first allocation misses a bicicleta-2 saved meanwhile
+            if slug == 'bicicleta-2' and not missed:
+                missed.append(slug)
+                return False
+            return others.filter(slug=slug).exists()
+        field._taken = taken
+        try:
+            product = Product.objects.create(name='Bicicleta')
+        finally:
+            del field._taken
+        self.assertEqual(missed, ['bicicleta-2'])
+        self.assertEqual(product.slug, 'bicicleta-3')
+
+class SlugRetryTransactionTest(TransactionTestCase):
+
+    def saveWithRetry(self):
+        # a bicicleta-2 saved by another process after the counter
+        SlugCounter.objects.update(last=1)
+        field = Product._meta.get_field('slug')
+        missed = []
+        def taken(others, slug):
+            if slug == 'bicicleta-2' and not missed:
+                missed.append(slug)
+                return False
+            return others.filter(slug=slug).exists()
+        field._taken = taken
+        try:
+            return Product.objects.create(name='Bicicleta')
+        finally:
+            del field._taken
+
+    def testRetry(self):
+        Product.objects.create(name='Bicicleta')
+        Product.objects.create(name='Bicicleta')
+        self.assertEqual(self.saveWithRetry().slug, 'bicicleta-3')
+        self.assertEqual(Product.objects.filter(name='Bicicleta').count(), 3)
+
+    def testRetryInTransaction(self):
+        Product.objects.create(name='Bicicleta')
+        Product.objects.create(name='Bicicleta')
+        product = transaction.commit_on_success(self.saveWithRetry)()
+        self.assertEqual(product.slug, 'bicicleta-3')
+        self.assertEqual(Product.objects.filter(name='Bicicleta').count(), 3)
+
+class FakeSearchBackend(object):
+
+    def __init__(self):
+        self.updated = []
+        self.removed = []
+
+    def update(self, index, objects):
+        self.updated.append([ob.pk for ob in objects])
+
+    def remove(self, identifier):
+        self.removed.append(identifier)
+
+class FakeProductIndex(object):
+
+    def __init__(self):
+        self.backend = FakeSearchBackend()
+
+    def get_queryset(self):
+        return Product.objects.filter(published=True, active=True)
+
+    def get_updated_field(self):
+        return 'update_time'
+
+class IndexUpdaterTest(TestCase):
+
+    def setUp(self):
+        self.index = FakeProductIndex()
+        self.updater = IndexUpdater(Product, batch_size=2, delay=0, index=self.index)
+
+    def testBatches(self):
+        ids = [Product.objects.create(name='Item', published=True, active=True).pk
+            for x in range(0, 5)]
+        for pk in ids:
+            self.updater.changed(pk)
+        self.updater.changed(ids[0])
+        self.assertEqual(self.updater.pending(), 5)
+
+        self.assertEqual(self.updater.flush(), 5)
+        self.assertEqual([len(b) for b in self.index.backend.updated], [2, 2, 1])
+        self.assertEqual(sorted(sum(self.index.backend.updated, [])), ids)
+        self.assertEqual(self.updater.pending(), 0)
+
+    def testRemovesUnpublished(self):
+        draft = Product.objects.create(name='Draft')
+        self.updater.changed(draft.pk)
+        self.updater.flush()
+        self.assertEqual(self.index.backend.updated, [])
+        self.assertEqual(self.index.backend.removed, ['product.product.%i' % draft.pk])
+
+    def testReconcile(self):
+        live = Product.objects.create(name='Item', published=True, active=True)
+        gone = Product.objects.create(name='Gone', published=True, active=True)
+        self.updater.indexed_ids = lambda: [live.pk, gone.pk]
+        Product.objects.filter(pk=gone.pk).update(active=False)
+
+        self.assertEqual(self.updater.reconcile(), 1)
+        self.updater.flush()
+        self.assertEqual(self.index.backend.removed, ['product.product.%i' % gone.pk])
+
+        self.assertEqual(self.updater.reconcile(since=live.update_time), 2)
+
+    def testRequeuedOnFailure(self):
+        def fail(index, objects):
+            raise IOError('index locked')
+        self.index.backend.update = fail
+        product = Product.objects.create(name='Item', published=True, active=True)
+        self.updater.changed(product.pk)
+        self.assertEqual(self.updater.flush(), 0)
+        self.assertEqual(self.updater.pending(), 1)
@@ -8,35 +8,54 @@ from django.core.mail import send_mail
 from django.contrib.auth.decorators import login_required
 from django.template import Context, RequestContext, loader
 from django.shortcuts import render_to_response
-from django.http import HttpResponse, HttpResponseRedirect
+from django.template.loader import render_to_string
+from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.core.urlresolvers import reverse
 from django.forms.models import inlineformset_factory
 from django.utils import simplejson
 
+from trade import caching
+from trade.caching.models import find_by_slug
 from trade.utils.decorators import account_login_required
 
-from trade.member.models import Member
+from trade.member.models import Member, member_for_user
 
 from trade.product.models import Product, MemberProduct, ProductPhoto
+from trade.product.models import DETAIL_NAMESPACE, product_detail
 from trade.product.forms import ProductForm, ProductPhotoForm
 
 def detail(request, slug):
-    product = Product.objects.get(slug=slug)
+    product = find_by_slug(Product, 'product-slug', slug)
+    if product is None:
+        raise Http404
 
     data = {
         'product': product,
-
+        'detail': detail_fragment(product),
     }
 
     return render_to_response('product/detail.html', data,
         context_instance=RequestContext(request))
 
+def detail_fragment(product):
+    """The rendered body of the detail page, cached until the product is
+    updated or any category is changed."""
+    stamp = product.update_time.isoformat()
+    try:
+        return caching.cache_namespace_get(DETAIL_NAMESPACE, product.pk, stamp)
+    except caching.NotCachedError:
+        fragment = render_to_string('product/detail-inc.html',
+            {'product': product_detail(product.slug)})
+        caching.cache_set(caching.cache_namespace(*DETAIL_NAMESPACE), product.pk,
+            stamp, value=fragment)
+        return fragment
+
 @account_login_required
 def edit(request, slug):
     product = Product.objects.get(slug=slug)
 
     try:
-        mp = MemberProduct.objects.get(product = product, member=Member.objects.get(user=request.user))
+        mp = MemberProduct.objects.get(product = product, member=member_for_user(request.user))
     except:
         return HttpResponseRedirect(reverse('account_login'))
 
@@ -89,7 +108,7 @@ def add(request):
             product = form.save(commit=False)
             product.active = True
             product.save()
-            member = Member.objects.get(user = request.user)
+            member = member_for_user(request.user)
 
             mp = MemberProduct(member= member, product=product).save()
             for form in formset.forms:
@@ -117,7 +136,7 @@ def delete(request, slug):
     product = Product.objects.get(slug=slug)
 
     try:
-        mp = MemberProduct.objects.get(product = product, member=Member.objects.get(user=request.user))
+        mp = MemberProduct.objects.get(product = product, member=member_for_user(request.user))
     except:
         return HttpResponseRedirect(reverse('account_login'))
 
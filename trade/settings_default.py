@@ -73,6 +73,7 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'trade.caching.request.RequestMemoMiddleware',
     'django.middleware.cache.UpdateCacheMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -148,6 +149,28 @@ CACHE_BACKEND = 'dummy://'
 #CACHE_BACKEND = "file://%s?timeout=%s" %  \
 #    (os.path.abspath(os.path.join(PROJECT_DIR, 'tmp', 'django_cache')), CACHE_TIMEOUT)
 CACHE_MIDDLEWARE_ANONYMOUS_ONLY = True
+# In-process LRU in front of CACHE_BACKEND, off with a size of 0.  When on,
+# other processes' changes show up to CACHE_L1_TIMEOUT seconds late.
+CACHE_L1_SIZE = 0
+CACHE_L1_TIMEOUT = 10
+# How long find_by_* remembers that an object does not exist, for the groups
+# declared with register_cache_groups.
+CACHE_NEGATIVE_TIMEOUT = 60
+# Cached values are pickled with this protocol and zlib compressed once the
+# pickle reaches CACHE_COMPRESS_THRESHOLD bytes (0 disables compression).
+CACHE_PICKLE_PROTOCOL = 2
+CACHE_COMPRESS_THRESHOLD = 8192
+# Per prefix counters shared by all processes through the cache backend,
+# flushed from each process every CACHE_STATS_FLUSH_INTERVAL seconds.
+CACHE_STATS = True
+CACHE_STATS_FLUSH_INTERVAL = 5
+# Most keys each process remembers for the cache admin pages and child deletes.
+CACHE_KEY_REGISTRY_SIZE = 10000
+# Cache URIs to spread keys over by consistent hashing, instead of
+# CACHE_BACKEND alone.  A node that fails is skipped for CACHE_NODE_RETRY
+# seconds.
+#CACHE_NODES = ['memcached://10.0.0.1:11211/', 'memcached://10.0.0.2:11211/']
+CACHE_NODE_RETRY = 30
 
 
 # Thumbnail settings for sorl.thumbnail
@@ -171,4 +194,29 @@ HAYSTACK_CONNECTIONS = {
         'ENGINE': 'haystack.backends.whoosh_backend.WhooshEngine',
         'PATH': os.path.join(os.path.dirname(__file__), 'whoosh_index'),
     },
-}
\ No newline at end of file
+}
+
+# Changed products are pushed to the search index by a background thread
+# every SEARCH_UPDATE_DELAY seconds, SEARCH_UPDATE_BATCH at a time.
+SEARCH_UPDATE_DELAY = 5
+SEARCH_UPDATE_BATCH = 100
+# The queue is not kept across restarts: every SEARCH_RECONCILE_INTERVAL
+# seconds the thread also removes what the index should no longer have and
+# reindexes what changed in that interval (0 disables it, see also the
+# reconcile_search_index command).
+SEARCH_RECONCILE_INTERVAL = 60*60
+
+# The barter match index of each process is rebuilt when older than
+# MATCH_INDEX_MAX_AGE seconds; matches are cached MATCH_CACHE_TIMEOUT seconds.
+MATCH_INDEX_MAX_AGE = 60*10
+MATCH_CACHE_TIMEOUT = 60
+
+# Offers listed per inbox and outbox page.
+OFFERS_PER_PAGE = 20
+
+# Offers pending or accepted and not updated for OFFER_EXPIRE_DAYS are expired
+# by manage.py expire_offers, OFFER_EXPIRE_BATCH per transaction; queued
+# notices are mailed OFFER_NOTICE_BATCH at a time by send_offer_notices.
+OFFER_EXPIRE_DAYS = 30
+OFFER_EXPIRE_BATCH = 500
+OFFER_NOTICE_BATCH = 200
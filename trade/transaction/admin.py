@@ -3,5 +3,6 @@ from django.contrib import admin
 
 
 admin.site.register(Offer)
+admin.site.register(OfferNotice)
 
 
@@ -0,0 +1,46 @@
+"""Benchmarks for the trade cycle search.
+
+Run them with ``manage.py cycle_benchmark``.
+"""
+
+import random
+import time
+
+from trade.transaction.cycles import find_cycles
+
+def random_graph(nodes, edges, seed=1):
+    """A graph of ``nodes`` members and about ``edges`` random edges."""
+    rand = random.Random(seed)
+    degree = max(edges // nodes, 1)
+    graph = {}
+    for node in xrange(0, nodes):
+        targets = set([rand.randrange(0, nodes) for x in xrange(0, degree)])
+        targets.discard(node)
+        graph[node] = targets
+    return graph
+
+def bench_cycles(nodes, edges, max_length=4, seed=1):
+    """Time the enumeration of every cycle of a random graph."""
+    start = time.time()
+    graph = random_graph(nodes, edges, seed)
+    built = time.time() - start
+
+    start = time.time()
+    lengths = {}
+    for cycle in find_cycles(graph, max_length=max_length):
+        lengths[len(cycle)] = lengths.get(len(cycle), 0) + 1
+    elapsed = time.time() - start
+
+    return {
+        'nodes' : nodes,
+        'edges' : sum([len(t) for t in graph.values()]),
+        'max_length' : max_length,
+        'build_s' : built,
+        'search_s' : elapsed,
+        'cycles' : sum(lengths.values()),
+        'by_length' : lengths,
+    }
+
+def run_suite(sizes, max_length=4):
+    """``bench_cycles`` for each (nodes, edges) pair of ``sizes``."""
+    return [bench_cycles(nodes, edges, max_length) for nodes, edges in sizes]
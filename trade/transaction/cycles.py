@@ -0,0 +1,131 @@
+"""Multi-party trade cycles over the want/offer graph.
+
+Members are nodes and there is an edge ``a -> b`` when ``a`` lists a
+product with a tag ``b`` wants.  A cycle a -> b -> c -> a is a trade where
+everyone gives one member and receives from another.  ``find_cycles``
+enumerates the cycles up to a length bound once each, starting every search
+from the cycle's smallest member and pruning, with a breadth-first search
+backwards from that start, every member too far away to close the cycle in
+time.
+"""
+
+import heapq
+
+from trade.transaction.models import TradeCycle, TradeCycleLeg
+
+def build_graph(index):
+    """The adjacency sets of the members in a MatchIndex."""
+    graph = {}
+    for tag, offering in index.offered.items():
+        wanting = index.wanted.get(tag)
+        if not wanting:
+            continue
+        for giver in offering:
+            targets = graph.setdefault(giver, set())
+            targets.update(wanting)
+            targets.discard(giver)
+    return graph
+
+def _reverse(graph):
+    reverse = {}
+    for node, targets in graph.items():
+        for target in targets:
+            reverse.setdefault(target, []).append(node)
+    return reverse
+
+def _distances_to(start, reverse, limit):
+    """Steps from each node above ``start`` back to ``start``, up to
+    ``limit``."""
+    distance = {start : 0}
+    frontier = [start]
+    for step in range(1, limit + 1):
+        following = []
+        for node in frontier:
+            for source in reverse.get(node, ()):
+                if source > start and source not in distance:
+                    distance[source] = step
+                    following.append(source)
+        if not following:
+            break
+        frontier = following
+    return distance
+
+def find_cycles(graph, max_length=4, min_length=3, limit=None):
+    """Yield every simple cycle of ``min_length`` to ``max_length`` members,
+    as a list starting from its smallest member, stopping after ``limit``."""
+    reverse = _reverse(graph)
+    found = 0
+    for start in sorted(graph):
+        distance = _distances_to(start, reverse, max_length - 1)
+        if len(distance) < min_length:
+            continue
+
+        # iterative DFS: the path so far and an iterator per level
+        path = [start]
+        on_path = set(path)
+        stack = [iter(graph.get(start, ()))]
+        while stack:
+            extended = False
+            for node in stack[-1]:
+                if node == start:
+                    if len(path) >= min_length:
+                        yield list(path)
+                        found += 1
+                        if limit and found >= limit:
+                            return
+                    continue
+                if node in on_path or node not in distance:
+                    continue
+                # can it still get back to start within the bound?
+                if len(path) + distance[node] > max_length:
+                    continue
+                path.append(node)
+                on_path.add(node)
+                stack.append(iter(graph.get(node, ())))
+                extended = True
+                break
+            if not extended:
+                stack.pop()
+                on_path.discard(path.pop())
+
+def leg_tags(index, giver, receiver):
+    """The tags ``giver`` lists that ``receiver`` wants."""
+    return sorted(set(index.member_offers.get(giver, ())) & index.member_wants.get(receiver, frozenset()))
+
+def score_cycle(index, cycle):
+    """The weakest leg's weight, a trade being only as likely as its least
+    wanted part, shared out over the members involved."""
+    weights = []
+    for i, giver in enumerate(cycle):
+        receiver = cycle[(i + 1) % len(cycle)]
+        weights.append(sum([index.weight(t) for t in leg_tags(index, giver, receiver)]))
+    return min(weights) / len(cycle)
+
+def best_cycles(index, max_length=4, count=100, limit=None):
+    """The ``count`` best scoring (score, cycle) pairs of ``index``."""
+    graph = build_graph(index)
+    best = []
+    for cycle in find_cycles(graph, max_length=max_length, limit=limit):
+        item = (score_cycle(index, cycle), cycle)
+        if len(best) < count:
+            heapq.heappush(best, item)
+        elif item > best[0]:
+            heapq.heapreplace(best, item)
+    best.sort(reverse=True)
+    return best
+
+def store_cycles(index, scored):
+    """Save (score, cycle) pairs not stored yet as TradeCycle proposals,
+    returning how many were new."""
+    keyed = dict([('-'.join([str(m) for m in cycle]), (score, cycle)) for score, cycle in scored])
+    known = set(TradeCycle.objects.filter(members_key__in=keyed.keys()).values_list(
+        'members_key', flat=True))
+    for key, (score, cycle) in keyed.items():
+        if key in known:
+            continue
+        proposal = TradeCycle.objects.create(members_key=key, score=score)
+        for i, giver in enumerate(cycle):
+            receiver = cycle[(i + 1) % len(cycle)]
+            TradeCycleLeg.objects.create(cycle=proposal, position=i, from_member_id=giver,
+                to_member_id=receiver, tags=', '.join(leg_tags(index, giver, receiver))[:255])
+    return len(keyed) - len(known)
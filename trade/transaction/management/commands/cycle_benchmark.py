@@ -0,0 +1,45 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.utils import simplejson
+
+from trade.transaction import benchmarks
+
+def _sizes(value):
+    sizes = []
+    for pair in value.split(','):
+        if pair.strip():
+            try:
+                nodes, edges = pair.split(':')
+                sizes.append((int(nodes), int(edges)))
+            except ValueError:
+                raise CommandError("Sizes are nodes:edges pairs, not %r" % pair)
+    return sizes
+
+class Command(NoArgsCommand):
+    help = "Times the trade cycle search on random graphs."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='10000:100000,100000:1000000,200000:1000000',
+            help='Comma separated nodes:edges pairs to generate.'),
+        make_option('--max-length', dest='max_length', type='int', default=4,
+            help='Most members in a cycle.'),
+        make_option('--json', dest='json', default='',
+            help='Also write the results to this file as JSON.'),
+    )
+
+    def handle_noargs(self, **options):
+        rows = benchmarks.run_suite(_sizes(options['sizes']), options['max_length'])
+        self.stdout.write("%10s %10s %8s %10s %10s %10s\n" % ('nodes', 'edges', 'length',
+            'build s', 'search s', 'cycles'))
+        for row in rows:
+            self.stdout.write("%(nodes)10i %(edges)10i %(max_length)8i %(build_s)10.2f "
+                "%(search_s)10.2f %(cycles)10i\n" % row)
+
+        if options['json']:
+            out = open(options['json'], 'w')
+            try:
+                simplejson.dump(rows, out, indent=2)
+            finally:
+                out.close()
+            self.stdout.write("\nResults written to %s\n" % options['json'])
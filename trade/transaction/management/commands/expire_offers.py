@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from trade.transaction.models import expire_offers, OFFER_EXPIRE_BATCH, OFFER_EXPIRE_DAYS
+
+class Command(NoArgsCommand):
+    help = "Expires the pending and accepted offers nobody answered, in batches."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=OFFER_EXPIRE_DAYS,
+            help='Expire offers not updated for this many days.'),
+        make_option('--batch', dest='batch', type='int', default=OFFER_EXPIRE_BATCH,
+            help='Offers expired per transaction.'),
+        make_option('--pause', dest='pause', type='float', default=0,
+            help='Seconds to wait between batches.'),
+    )
+
+    def handle_noargs(self, **options):
+        count = expire_offers(days=options['days'], batch_size=options['batch'],
+            pause=options['pause'])
+        self.stdout.write("Expired %i offers\n" % count)
@@ -0,0 +1,32 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from trade.transaction.cycles import best_cycles, store_cycles
+from trade.transaction.matching import build_index
+
+class Command(NoArgsCommand):
+    help = "Finds trades between three or more members and stores the best as proposals."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--max-length', dest='max_length', type='int', default=4,
+            help='Most members in a cycle.'),
+        make_option('--count', dest='count', type='int', default=1000,
+            help='Best cycles to store.'),
+        make_option('--limit', dest='limit', type='int', default=0,
+            help='Stop after enumerating this many cycles, 0 for no limit.'),
+    )
+
+    def handle_noargs(self, **options):
+        start = time.time()
+        index = build_index()
+        self.stdout.write("Indexed %i listings in %.1fs\n" % (len(index), time.time() - start))
+
+        start = time.time()
+        scored = best_cycles(index, max_length=options['max_length'],
+            count=options['count'], limit=options['limit'] or None)
+        self.stdout.write("Scored %i cycles in %.1fs\n" % (len(scored), time.time() - start))
+
+        new = store_cycles(index, scored)
+        self.stdout.write("Stored %i new trade proposals\n" % new)
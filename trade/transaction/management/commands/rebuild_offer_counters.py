@@ -0,0 +1,10 @@
+from django.core.management.base import NoArgsCommand
+
+from trade.transaction.models import rebuild_offer_counters
+
+class Command(NoArgsCommand):
+    help = "Recounts the unread and pending offers of every member."
+
+    def handle_noargs(self, **options):
+        count = rebuild_offer_counters()
+        self.stdout.write("Recounted the offers of %i members\n" % count)
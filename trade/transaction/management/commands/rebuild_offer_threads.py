@@ -0,0 +1,10 @@
+from django.core.management.base import NoArgsCommand
+
+from trade.transaction.models import rebuild_offer_threads
+
+class Command(NoArgsCommand):
+    help = "Recomputes the thread, depth and latest offer of every offer from its parent."
+
+    def handle_noargs(self, **options):
+        count = rebuild_offer_threads()
+        self.stdout.write("Rebuilt the threads of %i offers\n" % count)
@@ -0,0 +1,17 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from trade.transaction.notices import send_notices, OFFER_NOTICE_BATCH
+
+class Command(NoArgsCommand):
+    help = "Mails the queued offer notices, to be run from cron."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch', dest='batch', type='int', default=OFFER_NOTICE_BATCH,
+            help='Notices sent over one mail connection.'),
+    )
+
+    def handle_noargs(self, **options):
+        count = send_notices(batch_size=options['batch'])
+        self.stdout.write("Sent %i offer notices\n" % count)
@@ -0,0 +1,296 @@
+"""Two-way barter matches between members.
+
+An in-process inverted index maps each tag to the members offering
+products with it and to the members wanting it.  The match candidates of a
+member are then found from the postings of its own wants and offers only,
+never by scanning the listings.  Saving a listing, a product or a member's
+wants updates the index of the process doing it; the whole index is rebuilt
+from two queries once it is older than MATCH_INDEX_MAX_AGE, which also
+picks up the changes made by other processes.  That rebuild runs in a
+background thread while requests keep using the old index; the changes made
+meanwhile are logged and replayed onto the new index before it replaces
+the old one.
+"""
+
+import math
+import threading
+import time
+import logging
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import signals
+
+from tagging.utils import parse_tag_input
+
+from trade import caching
+from trade.member.models import Member
+from trade.product.models import MemberProduct, Product
+
+log = logging.getLogger('transaction.matching')
+
+MATCH_INDEX_MAX_AGE = getattr(settings, 'MATCH_INDEX_MAX_AGE', 60*10)
+MATCH_CACHE_TIMEOUT = getattr(settings, 'MATCH_CACHE_TIMEOUT', 60)
+
+def tag_set(value):
+    """The lowercased tags of a TagField value."""
+    return frozenset([t.lower() for t in parse_tag_input(value or '')])
+
+class MatchIndex(object):
+    """Tag postings of what members offer and want."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            # tag -> {member id: listings with the tag}
+            self.offered = {}
+            # tag -> set of member ids
+            self.wanted = {}
+            # member id -> {tag: listings}, member id -> tags
+            self.member_offers = {}
+            self.member_wants = {}
+            # listing id -> (member id, tags)
+            self.listings = {}
+            self.built = None
+        finally:
+            self._lock.release()
+
+    def add_listing(self, listing_id, member_id, tags):
+        """Index (or reindex) one listing of ``member_id``."""
+        self._lock.acquire()
+        try:
+            self.remove_listing(listing_id)
+            tags = frozenset(tags)
+            self.listings[listing_id] = (member_id, tags)
+            offers = self.member_offers.setdefault(member_id, {})
+            for tag in tags:
+                postings = self.offered.setdefault(tag, {})
+                postings[member_id] = postings.get(member_id, 0) + 1
+                offers[tag] = offers.get(tag, 0) + 1
+        finally:
+            self._lock.release()
+
+    def remove_listing(self, listing_id):
+        self._lock.acquire()
+        try:
+            try:
+                member_id, tags = self.listings.pop(listing_id)
+            except KeyError:
+                return
+            offers = self.member_offers[member_id]
+            for tag in tags:
+                _decrement(self.offered[tag], member_id)
+                if not self.offered[tag]:
+                    del self.offered[tag]
+                _decrement(offers, tag)
+            if not offers:
+                del self.member_offers[member_id]
+        finally:
+            self._lock.release()
+
+    def set_wants(self, member_id, tags):
+        """Replace the wishlist of ``member_id``."""
+        self._lock.acquire()
+        try:
+            for tag in self.member_wants.pop(member_id, ()):
+                self.wanted[tag].discard(member_id)
+                if not self.wanted[tag]:
+                    del self.wanted[tag]
+            tags = frozenset(tags)
+            if tags:
+                self.member_wants[member_id] = tags
+                for tag in tags:
+                    self.wanted.setdefault(tag, set()).add(member_id)
+        finally:
+            self._lock.release()
+
+    def weight(self, tag):
+        """Rarer tags make a better match than ones everybody offers."""
+        return 1.0 / math.log(2 + len(self.offered.get(tag, ())))
+
+    def matches(self, member_id, limit=20):
+        """Up to ``limit`` (score, member id, tags they give, tags we give)
+        tuples, best first, for the members who offer something
+        ``member_id`` wants and want something it offers."""
+        self._lock.acquire()
+        try:
+            gets = {}
+            for tag in self.member_wants.get(member_id, ()):
+                for other in self.offered.get(tag, ()):
+                    if other != member_id:
+                        gets.setdefault(other, []).append(tag)
+
+            gives = {}
+            if gets:
+                for tag in self.member_offers.get(member_id, ()):
+                    for other in self.wanted.get(tag, ()):
+                        if other in gets:
+                            gives.setdefault(other, []).append(tag)
+
+            found = []
+            for other, given in gives.items():
+                received = gets[other]
+                score = (sum([self.weight(t) for t in received])
+                    * sum([self.weight(t) for t in given]))
+                found.append((score, other, sorted(received), sorted(given)))
+        finally:
+            self._lock.release()
+
+        found.sort(key=lambda x: (-x[0], x[1]))
+        return found[:limit]
+
+    def __len__(self):
+        return len(self.listings)
+
+def _decrement(counts, key):
+    counts[key] -= 1
+    if not counts[key]:
+        del counts[key]
+
+INDEX = MatchIndex()
+_BUILD_LOCK = threading.Lock()
+_REFRESH_LOCK = threading.Lock()
+
+# (method, args) of the index changes made while a build runs, None when
+# none does
+_CHANGES = None
+_CHANGES_LOCK = threading.Lock()
+
+def listings():
+    """(listing id, member id, product tags) of every listing of a
+    published, active product."""
+    return MemberProduct.objects.filter(product__published=True,
+        product__active=True).values_list('pk', 'member', 'product__tags')
+
+def build_index():
+    """A new index filled from the database with two queries."""
+    start = time.time()
+    index = MatchIndex()
+    for pk, member_id, tags in listings().iterator():
+        index.add_listing(pk, member_id, tag_set(tags))
+    for member_id, wants in Member.objects.exclude(wants='').values_list('pk', 'wants').iterator():
+        index.set_wants(member_id, tag_set(wants))
+    index.built = time.time()
+    log.debug("Built the match index of %i listings in %.2fs", len(index), index.built - start)
+    return index
+
+def current_index():
+    """The index, built first when there is none yet.  An index older than
+    MATCH_INDEX_MAX_AGE is still returned, while one thread of the process
+    rebuilds it in the background."""
+    if INDEX.built is None:
+        _BUILD_LOCK.acquire()
+        try:
+            if INDEX.built is None:
+                _rebuild()
+        finally:
+            _BUILD_LOCK.release()
+    elif time.time() - INDEX.built > MATCH_INDEX_MAX_AGE:
+        # without blocking: another thread may already be refreshing
+        if _REFRESH_LOCK.acquire(False):
+            t = threading.Thread(target=_refresh_index)
+            t.setDaemon(True)
+            t.start()
+    return INDEX
+
+def _rebuild():
+    """Build a new index and swap it in, with the changes made during the
+    build replayed onto it."""
+    global INDEX, _CHANGES
+    _CHANGES_LOCK.acquire()
+    try:
+        _CHANGES = []
+    finally:
+        _CHANGES_LOCK.release()
+
+    index = None
+    try:
+        index = build_index()
+    finally:
+        _CHANGES_LOCK.acquire()
+        try:
+            if index is not None:
+                for method, args in _CHANGES:
+                    getattr(index, method)(*args)
+                INDEX = index
+            _CHANGES = None
+        finally:
+            _CHANGES_LOCK.release()
+
+def _indexing():
+    """Whether there is an index, or one being built, to keep up to date."""
+    return INDEX.built is not None or _CHANGES is not None
+
+def _change(method, *args):
+    """Apply ``method`` to the index, and to the one being built."""
+    _CHANGES_LOCK.acquire()
+    try:
+        if INDEX.built is not None:
+            getattr(INDEX, method)(*args)
+        if _CHANGES is not None:
+            _CHANGES.append((method, args))
+    finally:
+        _CHANGES_LOCK.release()
+
+def _refresh_index():
+    try:
+        try:
+            _rebuild()
+        except Exception, e:
+            log.error("Could not rebuild the match index: %s", e)
+    finally:
+        _REFRESH_LOCK.release()
+        # the thread has its own database connection
+        connection.close()
+
+def matches_for_member(member, limit=20):
+    """The best two-way trades for ``member``, as dicts with the other
+    ``member``, the tags they can give (``gets``) and take (``gives``) and
+    the ``score``."""
+    key = caching.cache_key('matches', member.pk, limit)
+    try:
+        found = caching.cache_get(key)
+    except caching.NotCachedError:
+        found = current_index().matches(member.pk, limit)
+        caching.cache_set(key, value=found, length=MATCH_CACHE_TIMEOUT)
+
+    members = Member.objects.select_related('user').in_bulk([f[1] for f in found])
+    return [{'member' : members[other], 'score' : score, 'gets' : gets, 'gives' : gives}
+        for score, other, gets, gives in found if other in members]
+
+def _listing_saved(sender, instance, **kwargs):
+    if not _indexing():
+        return
+    product = instance.product
+    if product.published and product.active:
+        _change('add_listing', instance.pk, instance.member_id, tag_set(product.tags))
+    else:
+        _change('remove_listing', instance.pk)
+
+def _listing_deleted(sender, instance, **kwargs):
+    _change('remove_listing', instance.pk)
+
+def _product_saved(sender, instance, **kwargs):
+    # tags or activation may have changed, for every member listing it
+    if not _indexing():
+        return
+    tags = tag_set(instance.tags)
+    listed = instance.published and instance.active
+    for pk, member_id in instance.members.values_list('pk', 'member'):
+        if listed:
+            _change('add_listing', pk, member_id, tags)
+        else:
+            _change('remove_listing', pk)
+
+def _member_saved(sender, instance, **kwargs):
+    if _indexing():
+        _change('set_wants', instance.pk, tag_set(instance.wants))
+
+signals.post_save.connect(_listing_saved, sender=MemberProduct, dispatch_uid='match-index')
+signals.post_delete.connect(_listing_deleted, sender=MemberProduct, dispatch_uid='match-index')
+signals.post_save.connect(_product_saved, sender=Product, dispatch_uid='match-index')
+signals.post_save.connect(_member_saved, sender=Member, dispatch_uid='match-index')
@@ -1,27 +1,65 @@
 # -*- coding: utf-8 -*-
 
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import connection, models, transaction
+from django.db.models import signals, Count, F, Q
 from django.utils.translation import ugettext
 from django.utils.translation import ugettext_lazy as _
 
 from tagging.fields import TagField
 
+from trade.caching.models import forget_cached
+from trade.member.models import Member
+from trade.product.models import MemberProduct
 from trade.utils.fields import AutoSlugField
 
 
 class Offer(models.Model):
 
+    class InvalidTransition(ValueError):
+        """An offer can't go from its status to the one asked.  Catch it as
+        ``Offer.InvalidTransition``: the app is importable under two names,
+        and only the model class is the same under both."""
+
+    STATUS_CHOICES = (
+        ('pending', _(u'pending')),
+        ('countered', _(u'countered')),
+        ('accepted', _(u'accepted')),
+        ('confirmed', _(u'confirmed')),
+        ('expired', _(u'expired')),
+        ('cancelled', _(u'cancelled')),
+    )
+    # status -> the statuses it can change to; the others are final
+    TRANSITIONS = {
+        'pending' : ('countered', 'accepted', 'expired', 'cancelled'),
+        'accepted' : ('confirmed', 'expired', 'cancelled'),
+    }
+
     from_member = models.ForeignKey("member.Member", related_name="my_sent_offers")
     to_member = models.ForeignKey("member.Member", related_name="my_reviced_offers")
     message = models.TextField(blank=True)
     from_products = models.ManyToManyField("product.MemberProduct", related_name="from_products")
     to_products = models.ManyToManyField("product.MemberProduct", related_name="to_products")
-    status = models.CharField(max_length=50)
+    status = models.CharField(max_length=50, choices=STATUS_CHOICES, default='pending')
+    # whether to_member has opened it
+    is_read = models.BooleanField(default=False, editable=False)
 
     parent = models.ForeignKey('self', verbose_name=_(u'parent'),
         related_name='children', blank=True, null=True,)
 
+    # The first offer of the negotiation this one belongs to (itself for a
+    # first offer), how many counter-offers deep it is, and whether it is
+    # the newest offer of its thread.  Set when the offer is created.
+    thread = models.ForeignKey('self', related_name='thread_offers', blank=True, null=True,
+        editable=False)
+    depth = models.PositiveIntegerField(default=0, editable=False)
+    is_latest = models.BooleanField(default=True, db_index=True, editable=False)
+
     diff_amount = models.DecimalField(default="0.00", decimal_places=2, max_digits=10, blank=True, null=True,)
 
     create_time = models.DateTimeField("created on", auto_now_add=True)
@@ -32,8 +70,478 @@ class Offer(models.Model):
         verbose_name_plural = _("Ofertas")
 
     def __unicode__(self):
-        if self.parent:
-            return u'%s -- %s' % (self.from_member.user.username, self.to_member.user.username)
-        else:
-            return self.name
+        return u'%s -- %s' % (self.from_member.user.username, self.to_member.user.username)
+
+    def clean(self):
+        try:
+            self._check_status()
+        except self.InvalidTransition, e:
+            raise ValidationError(unicode(e))
+
+    def _check_status(self):
+        saved = getattr(self, '_saved_status', None)
+        if self.pk is None:
+            if self.status not in dict(self.STATUS_CHOICES):
+                raise self.InvalidTransition(u'Unknown offer status: %s' % self.status)
+        elif saved != self.status:
+            check_transition(saved, self.status)
+
+    def save(self, *args, **kwargs):
+        self._check_status()
+        created = self.pk is None
+        parent = None
+        if created and self.parent_id:
+            parent = self.parent
+            self.thread_id = parent.thread_id or parent.pk
+            self.depth = parent.depth + 1
+        super(Offer, self).save(*args, **kwargs)
+
+        if created:
+            if self.thread_id is None:
+                self.thread_id = self.pk
+                Offer.objects.filter(pk=self.pk).update(thread=self.pk)
+            else:
+                Offer.objects.filter(thread=self.thread_id, is_latest=True).exclude(
+                    pk=self.pk).update(is_latest=False)
+            if (parent is not None and parent.from_member_id == self.to_member_id
+                    and parent.to_member_id == self.from_member_id):
+                # an answer to the parent, not the next leg of a trade cycle
+                transition_offers([parent.pk], 'pending', 'countered')
+
+    def change_status(self, status):
+        """Move the offer to ``status`` with a conditional update, raising
+        Offer.InvalidTransition when it can't go there or was changed
+        meanwhile."""
+        previous = self.status
+        check_transition(previous, status)
+        if not transition_offers([self.pk], previous, status):
+            raise self.InvalidTransition(u'Offer %s is no longer %s' % (self.pk, previous))
+        moved = Offer.objects.filter(pk=self.pk).values_list('status', 'update_time')[0]
+        self.status, self.update_time = moved
+        _remember_offer_counts(Offer, self)
+
+    def can_change(self, status):
+        return status in self.TRANSITIONS.get(self.status, ())
+
+    def mark_read(self):
+        """Record that the receiver opened this offer."""
+        if Offer.objects.filter(pk=self.pk, is_read=False).update(is_read=True):
+            _count_offers({(self.to_member_id, 'unread_offers') : -1})
+        self.is_read = True
+        getattr(self, '_offer_counts', {}).pop((self.to_member_id, 'unread_offers'), None)
+
+    def get_thread(self):
+        """Every offer of this negotiation, oldest first, in one query."""
+        return Offer.objects.filter(thread=self.thread_id).order_by('depth', 'create_time', 'pk')
+
+    def latest_in_thread(self):
+        return Offer.objects.get(thread=self.thread_id, is_latest=True)
+
+# Statuses of an offer still waiting for an answer.
+OPEN_STATUSES = ('pending',)
+
+# Statuses the expiry sweeper moves to 'expired' once not updated for
+# OFFER_EXPIRE_DAYS.
+EXPIRING_STATUSES = ('pending', 'accepted')
+
+OFFER_EXPIRE_DAYS = getattr(settings, 'OFFER_EXPIRE_DAYS', 30)
+OFFER_EXPIRE_BATCH = getattr(settings, 'OFFER_EXPIRE_BATCH', 500)
+
+# who is told about an offer reaching a status
+NOTICE_RECIPIENTS = {
+    'pending' : ('to_member',),
+    'countered' : ('from_member',),
+    'accepted' : ('from_member',),
+    'confirmed' : ('from_member', 'to_member'),
+    'expired' : ('from_member', 'to_member'),
+    'cancelled' : ('to_member',),
+}
+
+def check_transition(status, new_status):
+    if new_status not in Offer.TRANSITIONS.get(status, ()):
+        raise Offer.InvalidTransition(u'An offer can not go from %s to %s' % (status, new_status))
+
+COUNTERS = ('unread_offers', 'pending_received_offers', 'pending_sent_offers')
+
+OFFERS_PER_PAGE = getattr(settings, 'OFFERS_PER_PAGE', 20)
+
+def _counts(from_member_id, to_member_id, is_read, status, counts=None):
+    """Add what an offer counts for its members to ``counts``."""
+    if counts is None:
+        counts = {}
+    if to_member_id:
+        if not is_read:
+            key = (to_member_id, 'unread_offers')
+            counts[key] = counts.get(key, 0) + 1
+        if status in OPEN_STATUSES:
+            key = (to_member_id, 'pending_received_offers')
+            counts[key] = counts.get(key, 0) + 1
+    if from_member_id and status in OPEN_STATUSES:
+        key = (from_member_id, 'pending_sent_offers')
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+def _offer_counts(offer):
+    """What ``offer`` adds to the counters of its members."""
+    return _counts(offer.from_member_id, offer.to_member_id, offer.is_read, offer.status)
+
+def _difference(old, new):
+    deltas = dict(new)
+    for key, value in old.items():
+        deltas[key] = deltas.get(key, 0) - value
+    return deltas
+
+def _count_offers(deltas):
+    """Apply {(member id, counter): delta} with one update per counter and
+    distinct delta, however many members change."""
+    grouped = {}
+    for (member_id, counter), delta in deltas.items():
+        if delta:
+            grouped.setdefault((counter, delta), []).append(member_id)
+    ids = set()
+    for (counter, delta), member_ids in grouped.items():
+        Member.objects.filter(pk__in=member_ids).update(**{counter : F(counter) + delta})
+        ids.update(member_ids)
+    if ids:
+        for member in Member.objects.filter(pk__in=ids):
+            forget_cached(member)
+
+def _remember_offer_counts(sender, instance, **kwargs):
+    instance._offer_counts = _offer_counts(instance)
+    instance._saved_status = instance.status
+
+def _offer_saved(sender, instance, created, **kwargs):
+    old = {}
+    if not created:
+        old = getattr(instance, '_offer_counts', {})
+    new = _offer_counts(instance)
+    _count_offers(_difference(old, new))
+    if created or getattr(instance, '_saved_status', None) != instance.status:
+        queue_notices([(instance.pk, instance.from_member_id, instance.to_member_id)],
+            instance.status)
+    _remember_offer_counts(sender, instance)
+
+def _offer_deleted(sender, instance, **kwargs):
+    _count_offers(dict([(key, -value) for key, value in
+        getattr(instance, '_offer_counts', {}).items()]))
+
+# the app is also importable as plain 'transaction', the uid keeps a second
+# import of this module from counting every offer twice
+signals.post_init.connect(_remember_offer_counts, sender=Offer, dispatch_uid='offer-counts')
+signals.post_save.connect(_offer_saved, sender=Offer, dispatch_uid='offer-counts')
+signals.post_delete.connect(_offer_deleted, sender=Offer, dispatch_uid='offer-counts')
+
+def transition_offers(ids, status, new_status, updated_before=None):
+    """Move the offers of ``ids`` still in ``status``, and last updated
+    before ``updated_before`` when given, to ``new_status`` with one
+    update, then adjust the member counters and queue the notices for all
+    of them at once.  Returns how many offers moved.
+
+    The offers are locked while they move, so the counters follow exactly
+    the rows this call changed; only those rows are locked, and only until
+    the transaction ends, which is here unless the caller manages one."""
+    check_transition(status, new_status)
+    ids = list(ids)
+    if not ids:
+        return 0
+    managed = transaction.is_managed()
+    if not managed:
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+    try:
+        rows = _lock_offers(ids, status, updated_before)
+        if rows:
+            Offer.objects.filter(pk__in=[row[0] for row in rows]).update(
+                status=new_status, update_time=datetime.now())
+            old, new = {}, {}
+            for pk, from_member_id, to_member_id, is_read in rows:
+                _counts(from_member_id, to_member_id, is_read, status, old)
+                _counts(from_member_id, to_member_id, is_read, new_status, new)
+            _count_offers(_difference(old, new))
+            queue_notices([row[:3] for row in rows], new_status)
+        if not managed:
+            transaction.commit()
+        return len(rows)
+    except:
+        if not managed:
+            transaction.rollback()
+        raise
+    finally:
+        if not managed:
+            transaction.leave_transaction_management()
+
+def _lock_offers(ids, status, updated_before=None):
+    """(id, from member id, to member id, is_read) of the offers of ``ids``
+    in ``status``, and updated before ``updated_before`` when given, locked
+    until the transaction ends.  SQLite has no FOR UPDATE, a write there
+    locks the whole database anyway."""
+    qn = connection.ops.quote_name
+    sql = 'SELECT %s FROM %s WHERE %s = %%s AND %s IN (%s)' % (
+        ', '.join([qn(Offer._meta.get_field(name).column)
+            for name in ('id', 'from_member', 'to_member', 'is_read')]),
+        qn(Offer._meta.db_table), qn('status'), qn(Offer._meta.pk.column), ', '.join(['%s'] * len(ids)))
+    params = [status] + ids
+    if updated_before is not None:
+        sql += ' AND %s < %%s' % qn(Offer._meta.get_field('update_time').column)
+        params.append(connection.ops.value_to_db_datetime(updated_before))
+    if connection.vendor != 'sqlite':
+        sql += ' FOR UPDATE'
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return [(pk, from_member_id, to_member_id, bool(is_read))
+        for pk, from_member_id, to_member_id, is_read in cursor.fetchall()]
+
+def _expire_batch(ids, status, cutoff):
+    # an offer updated since it was selected is no longer due
+    return transition_offers(ids, status, 'expired', updated_before=cutoff)
+_expire_batch = transaction.commit_on_success(_expire_batch)
+
+def expire_offers(days=OFFER_EXPIRE_DAYS, batch_size=OFFER_EXPIRE_BATCH, pause=0, now=None):
+    """Expire the offers in EXPIRING_STATUSES not updated for ``days``.
+
+    Each batch of ``batch_size`` is selected, moved and committed on its
+    own, so only that many rows are locked at a time; ``pause`` seconds
+    between batches leave room for the site.  Expired offers leave the
+    (status, update_time) range being swept, so no cursor is kept.
+    Returns the number expired."""
+    cutoff = (now or datetime.now()) - timedelta(days=days)
+    total = 0
+    for status in EXPIRING_STATUSES:
+        while True:
+            ids = list(Offer.objects.filter(status=status, update_time__lt=cutoff).order_by(
+                'update_time', 'pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            total += _expire_batch(ids, status, cutoff)
+            if pause:
+                time.sleep(pause)
+    return total
+
+def queue_notices(offers, status):
+    """Queue the notices of (offer id, from member id, to member id)
+    reaching ``status`` with one batched insert."""
+    fields = NOTICE_RECIPIENTS.get(status, ())
+    now = connection.ops.value_to_db_datetime(datetime.now())
+    rows = []
+    for offer_id, from_member_id, to_member_id in offers:
+        members = {'from_member' : from_member_id, 'to_member' : to_member_id}
+        for field in fields:
+            rows.append((members[field], offer_id, status, now))
+    if not rows:
+        return 0
+
+    qn = connection.ops.quote_name
+    opts = OfferNotice._meta
+    columns = ', '.join([qn(opts.get_field(name).column)
+        for name in ('member', 'offer', 'status', 'create_time')])
+    cursor = connection.cursor()
+    cursor.executemany('INSERT INTO %s (%s) VALUES (%%s, %%s, %%s, %%s)' % (
+        qn(opts.db_table), columns), rows)
+    transaction.commit_unless_managed()
+    return len(rows)
+
+def rebuild_offer_counters():
+    """Recount the offer counters of every member with one aggregate query
+    per counter.  Returns the number of members with offers."""
+    Member.objects.update(**dict([(counter, 0) for counter in COUNTERS]))
+    totals = (
+        ('unread_offers', 'to_member', Offer.objects.filter(is_read=False)),
+        ('pending_received_offers', 'to_member', Offer.objects.filter(status__in=OPEN_STATUSES)),
+        ('pending_sent_offers', 'from_member', Offer.objects.filter(status__in=OPEN_STATUSES)),
+    )
+    members = set()
+    for counter, field, queryset in totals:
+        grouped = {}
+        for member_id, n in queryset.values(field).annotate(n=Count('pk')).values_list(field, 'n'):
+            grouped.setdefault(n, []).append(member_id)
+            members.add(member_id)
+        for n, ids in grouped.items():
+            Member.objects.filter(pk__in=ids).update(**{counter : n})
+    return len(members)
+
+def _encode_cursor(offer):
+    return '%s_%i' % (offer.update_time.strftime('%Y%m%d%H%M%S%f'), offer.pk)
+
+def _decode_cursor(cursor):
+    try:
+        stamp, pk = cursor.split('_')
+        return datetime.strptime(stamp, '%Y%m%d%H%M%S%f'), int(pk)
+    except ValueError:
+        return None
+
+def offer_page(queryset, before=None, size=OFFERS_PER_PAGE):
+    """The ``size`` most recently updated offers of ``queryset`` older than
+    the ``before`` cursor, and the cursor of the next page or None.
+
+    The page is found by seeking on (update_time, id), so it costs the same
+    however deep it is, with the indexes in sql/offer.sql."""
+    position = before and _decode_cursor(before)
+    if position:
+        update_time, pk = position
+        queryset = queryset.filter(Q(update_time__lt=update_time)
+            | Q(update_time=update_time, pk__lt=pk))
+    offers = list(queryset.select_related('from_member__user', 'to_member__user').order_by(
+        '-update_time', '-pk')[:size + 1])
+    if len(offers) > size:
+        return offers[:size], _encode_cursor(offers[size - 1])
+    return offers, None
+
+def inbox(member, status=None, before=None, size=OFFERS_PER_PAGE):
+    """A page of the offers ``member`` received, see ``offer_page``."""
+    queryset = Offer.objects.filter(to_member=member)
+    if status:
+        queryset = queryset.filter(status=status)
+    return offer_page(queryset, before, size)
+
+def outbox(member, status=None, before=None, size=OFFERS_PER_PAGE):
+    """A page of the offers ``member`` sent, see ``offer_page``."""
+    queryset = Offer.objects.filter(from_member=member)
+    if status:
+        queryset = queryset.filter(status=status)
+    return offer_page(queryset, before, size)
+
+def member_offers(member):
+    """The offers ``member`` sent or received."""
+    return Offer.objects.filter(Q(from_member=member) | Q(to_member=member))
+
+def latest_offers(member):
+    """The newest offer of each negotiation ``member`` took part in, in
+    one query.  A thread shows up even when its latest offer was between
+    others, as in a trade cycle."""
+    threads = member_offers(member).values('thread')
+    return Offer.objects.filter(is_latest=True, thread__in=threads).order_by('-update_time')
+
+def thread_count(member):
+    """How many negotiations ``member`` took part in, in one query."""
+    return member_offers(member).aggregate(n=Count('thread', distinct=True))['n']
+
+def thread_counts(member_ids):
+    """{member id: negotiations} for several members, in one query."""
+    if not member_ids:
+        return {}
+    table = connection.ops.quote_name(Offer._meta.db_table)
+    placeholders = ', '.join(['%s'] * len(member_ids))
+    cursor = connection.cursor()
+    cursor.execute("""SELECT member_id, COUNT(DISTINCT thread_id) FROM (
+            SELECT from_member_id AS member_id, thread_id FROM %(table)s
+            UNION ALL
+            SELECT to_member_id AS member_id, thread_id FROM %(table)s
+        ) participants WHERE member_id IN (%(ids)s) GROUP BY member_id""" % {
+            'table' : table, 'ids' : placeholders}, list(member_ids))
+    counts = dict([(member_id, 0) for member_id in member_ids])
+    counts.update(dict(cursor.fetchall()))
+    return counts
+
+def rebuild_offer_threads():
+    """Set thread, depth and is_latest on every offer from ``parent``, for
+    offers created before threads were kept.  Returns the number of
+    offers."""
+    parents = dict(Offer.objects.values_list('pk', 'parent'))
+    roots = {}
+
+    def root_of(pk):
+        chain = []
+        while pk not in roots:
+            parent = parents.get(pk)
+            if parent is None or parent not in parents or parent in chain:
+                roots[pk] = (pk, 0)
+                break
+            chain.append(pk)
+            pk = parent
+        root, depth = roots[pk]
+        for pk in reversed(chain):
+            depth += 1
+            roots[pk] = (root, depth)
+        return roots[chain[0]] if chain else roots[pk]
+
+    latest = {}
+    for pk in sorted(parents):
+        root, depth = root_of(pk)
+        Offer.objects.filter(pk=pk).update(thread=root, depth=depth)
+        latest[root] = max(latest.get(root, pk), pk)
+
+    Offer.objects.update(is_latest=False)
+    ids = latest.values()
+    for i in range(0, len(ids), 500):
+        Offer.objects.filter(pk__in=ids[i:i + 500]).update(is_latest=True)
+    return len(parents)
+
+class OfferNotice(models.Model):
+    """An email to send a member about an offer reaching ``status``, queued
+    as offers change and sent by ``manage.py send_offer_notices``."""
+
+    member = models.ForeignKey("member.Member", related_name="offer_notices")
+    offer = models.ForeignKey(Offer, related_name="notices")
+    status = models.CharField(max_length=50, choices=Offer.STATUS_CHOICES)
+    create_time = models.DateTimeField("created on", auto_now_add=True)
+    sent_time = models.DateTimeField("sent on", blank=True, null=True, db_index=True)
+
+    class Meta:
+        verbose_name = _("Aviso")
+        verbose_name_plural = _("Avisos")
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.offer_id, self.status)
+
+class TradeCycle(models.Model):
+    """A proposed trade between three or more members, each giving the next
+    one, found by ``manage.py find_trade_cycles``."""
+
+    STATUS_CHOICES = (
+        ('proposed', _(u'proposed')),
+        ('offered', _(u'offered')),
+        ('dismissed', _(u'dismissed')),
+    )
+
+    # the member ids in cycle order, from the smallest, so a cycle found
+    # again by a later run is not stored twice
+    members_key = models.CharField(max_length=255, unique=True)
+    score = models.FloatField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='proposed')
+    offer = models.ForeignKey(Offer, related_name='trade_cycles', blank=True, null=True)
+
+    create_time = models.DateTimeField("created on", auto_now_add=True)
+
+    class Meta:
+        ordering = ('-score',)
+
+    def __unicode__(self):
+        return u'%s (%.3f)' % (self.members_key, self.score)
+
+    def create_offers(self):
+        """Turn the cycle into one Offer per leg, linked to the first one
+        through ``parent``, and return that first offer."""
+        root = None
+        legs = list(self.legs.select_related('from_member', 'to_member'))
+        for leg in legs:
+            offer = Offer(from_member=leg.from_member, to_member=leg.to_member,
+                status='pending', parent=root,
+                message=ugettext(u'Part of a trade between %i members.') % len(legs))
+            offer.save()
+            wanted = matching.tag_set(leg.tags)
+            given = [mp for mp in MemberProduct.objects.filter(member=leg.from_member,
+                    product__published=True, product__active=True).select_related('product')
+                if matching.tag_set(mp.product.tags) & wanted]
+            if given:
+                offer.from_products.add(*given)
+            if root is None:
+                root = offer
+
+        self.offer = root
+        self.status = 'offered'
+        self.save()
+        return root
+
+class TradeCycleLeg(models.Model):
+    cycle = models.ForeignKey(TradeCycle, related_name='legs')
+    position = models.PositiveIntegerField()
+    from_member = models.ForeignKey("member.Member", related_name="cycle_legs_given")
+    to_member = models.ForeignKey("member.Member", related_name="cycle_legs_received")
+    # what from_member lists that to_member wants
+    tags = models.CharField(max_length=255)
+
+    class Meta:
+        ordering = ('cycle', 'position')
 
+# keeps the barter match index up to date
+from trade.transaction import matching
@@ -0,0 +1,42 @@
+"""Sending the offer notices queued in OfferNotice."""
+
+from datetime import datetime
+import logging
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.mail import send_mass_mail
+from django.template.loader import render_to_string
+
+from trade.transaction.models import OfferNotice
+
+log = logging.getLogger('transaction.notices')
+
+OFFER_NOTICE_BATCH = getattr(settings, 'OFFER_NOTICE_BATCH', 200)
+
+def send_notices(batch_size=OFFER_NOTICE_BATCH):
+    """Mail the unsent notices, ``batch_size`` over one SMTP connection at a
+    time, marking each batch sent with one update.  Returns how many were
+    sent."""
+    site_url = 'http://%s/' % Site.objects.get_current().domain
+    total = 0
+    while True:
+        notices = list(OfferNotice.objects.filter(sent_time__isnull=True).select_related(
+            'member__user', 'offer__from_member__user', 'offer__to_member__user').order_by(
+            'pk')[:batch_size])
+        if not notices:
+            break
+
+        messages = []
+        for notice in notices:
+            context = {'notice' : notice, 'offer' : notice.offer, 'site_url' : site_url}
+            subject = render_to_string('transaction/notice_subject.txt', context)
+            messages.append((' '.join(subject.split()),
+                render_to_string('transaction/notice_email.txt', context),
+                settings.DEFAULT_FROM_EMAIL, [notice.member.email]))
+        send_mass_mail(messages)
+        OfferNotice.objects.filter(pk__in=[n.pk for n in notices]).update(
+            sent_time=datetime.now())
+        total += len(notices)
+        log.debug("Sent %i offer notices", len(notices))
+    return total
@@ -0,0 +1,9 @@
+-- The inbox and outbox pages seek on (update_time, id) among the offers of
+-- one member, optionally of one status; see trade.transaction.models.offer_page.
+CREATE INDEX transaction_offer_inbox ON transaction_offer (to_member_id, status, update_time, id);
+CREATE INDEX transaction_offer_outbox ON transaction_offer (from_member_id, status, update_time, id);
+CREATE INDEX transaction_offer_inbox_all ON transaction_offer (to_member_id, update_time, id);
+CREATE INDEX transaction_offer_outbox_all ON transaction_offer (from_member_id, update_time, id);
+
+-- The expiry sweeper takes the oldest offers of a status, a batch at a time.
+CREATE INDEX transaction_offer_expiry ON transaction_offer (status, update_time, id);
@@ -0,0 +1,359 @@
+import random
+import time
+
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.test import TestCase
+
+from trade.member.models import Member, UserProfile
+from trade.product.models import Product, MemberProduct
+from trade.transaction.models import Offer, TradeCycle
+from trade.transaction.models import latest_offers, rebuild_offer_threads, thread_count, thread_counts
+from trade.transaction.models import inbox, outbox, rebuild_offer_counters
+from trade.transaction.models import OfferNotice, expire_offers, transition_offers
+from trade.transaction.notices import send_notices
+from trade.transaction import matching
+from trade.transaction.benchmarks import random_graph
+from trade.transaction.cycles import best_cycles, find_cycles, store_cycles
+from trade.transaction.matching import MatchIndex, build_index, current_index, matches_for_member
+
+class MatchIndexTest(TestCase):
+
+    def setUp(self):
+        self.index = MatchIndex()
+        self.index.add_listing(1, 'ana', ['bike'])
+        self.index.add_listing(2, 'bob', ['guitar'])
+        self.index.add_listing(3, 'cid', ['guitar', 'amp'])
+        self.index.set_wants('ana', ['guitar', 'amp'])
+        self.index.set_wants('bob', ['bike'])
+        self.index.set_wants('cid', ['bike'])
+
+    def testTwoWay(self):
+        found = self.index.matches('ana')
+        self.assertEqual([m[1] for m in found], ['cid', 'bob'])
+        self.assertEqual(found[0][2:], (['amp', 'guitar'], ['bike']))
+
+    def testOneWayIsNoMatch(self):
+        self.index.set_wants('bob', [])
+        self.assertEqual([m[1] for m in self.index.matches('ana')], ['cid'])
+
+    def testRemoveListing(self):
+        self.index.remove_listing(3)
+        self.assertEqual([m[1] for m in self.index.matches('ana')], ['bob'])
+        self.failIf('amp' in self.index.offered)
+
+    def testLarge(self):
+        index = MatchIndex()
+        rand = random.Random(1)
+        tags = ['tag%i' % i for i in range(0, 5000)]
+        for i in range(0, 100000):
+            index.add_listing(i, i % 20000, rand.sample(tags, 3))
+        for member in range(0, 20000):
+            index.set_wants(member, rand.sample(tags, 5))
+        start = time.time()
+        for member in range(0, 100):
+            index.matches(member)
+        self.assert_(time.time() - start < 1)
+
+def make_member(name, wants):
+    user = User.objects.create(username=name)
+    return Member.objects.create(user=user, profile=UserProfile.objects.create(),
+        email='%s@example.com' % name, wants=wants)
+
+def make_listing(member, name, tags):
+    product = Product.objects.create(name=name, tags=tags, published=True, active=True)
+    MemberProduct.objects.create(member=member, product=product)
+    return product
+
+class MatchingTest(TestCase):
+
+    def setUp(self):
+        self.ana = make_member('ana', 'guitar')
+        self.bob = make_member('bob', 'bike')
+        make_listing(self.ana, 'Bike', 'bike')
+        self.guitar = make_listing(self.bob, 'Guitar', 'guitar')
+        matching.INDEX = build_index()
+
+    def testBuild(self):
+        self.assertEqual(len(matching.INDEX), 2)
+        self.assertEqual([m[1] for m in matching.INDEX.matches(self.ana.pk)], [self.bob.pk])
+
+    def testIncremental(self):
+        self.guitar.active = False
+        self.guitar.save()
+        self.assertEqual(matching.INDEX.matches(self.ana.pk), [])
+
+        self.guitar.active = True
+        self.guitar.save()
+        cid = make_member('cid', 'bike')
+        make_listing(cid, 'Amp', 'guitar')
+        self.assertEqual(len(matching.INDEX.matches(self.ana.pk)), 2)
+
+    def testForMember(self):
+        with self.assertNumQueries(1):
+            found = matches_for_member(self.ana)
+            self.assertEqual(found[0]['member'].user.username, 'bob')
+        self.assertEqual(found[0]['member'], self.bob)
+        self.assertEqual(found[0]['gets'], ['guitar'])
+        self.assertEqual(found[0]['gives'], ['bike'])
+
+    def testStaleServedWhileRefreshing(self):
+        stale = matching.INDEX
+        stale.built = time.time() - matching.MATCH_INDEX_MAX_AGE - 1
+        fresh = MatchIndex()
+        fresh.built = time.time()
+        orig = matching.build_index
+        matching.build_index = lambda: fresh
+        try:
+            self.failUnless(current_index() is stale)
+            # held until the background rebuild is done
+            matching._REFRESH_LOCK.acquire()
+            matching._REFRESH_LOCK.release()
+        finally:
+            matching.build_index = orig
+        self.failUnless(current_index() is fresh)
+
+    def testChangesDuringRebuildReplayed(self):
+        orig = matching.build_index
+        def build():
+            index = orig()
+            # saved after the build read the listings
+            self.guitar.active = False
+            self.guitar.save()
+            return index
+        matching.build_index = build
+        try:
+            matching._rebuild()
+        finally:
+            matching.build_index = orig
+        self.assertEqual(matching.INDEX.matches(self.ana.pk), [])
+        self.assertEqual(matching._CHANGES, None)
+
+def brute_force_cycles(graph, max_length):
+    found = []
+    def walk(path):
+        for node in graph.get(path[-1], ()):
+            if node == path[0] and len(path) >= 3:
+                found.append(list(path))
+            elif node > path[0] and node not in path and len(path) < max_length:
+                walk(path + [node])
+    for start in graph:
+        walk([start])
+    return sorted(found)
+
+class CycleTest(TestCase):
+
+    def testSmall(self):
+        graph = {1 : set([2]), 2 : set([3]), 3 : set([1, 4]), 4 : set([1])}
+        self.assertEqual(sorted(find_cycles(graph)), [[1, 2, 3], [1, 2, 3, 4]])
+        self.assertEqual(list(find_cycles(graph, max_length=3)), [[1, 2, 3]])
+        self.assertEqual(len(list(find_cycles(graph, limit=1))), 1)
+
+    def testMatchesBruteForce(self):
+        graph = random_graph(40, 200, seed=3)
+        self.assertEqual(sorted(find_cycles(graph, max_length=4)),
+            brute_force_cycles(graph, 4))
+
+    def testBestCycles(self):
+        index = MatchIndex()
+        # ana -> bob -> cid -> ana, and no two-way swap
+        index.add_listing(1, 'ana', ['bike'])
+        index.add_listing(2, 'bob', ['guitar'])
+        index.add_listing(3, 'cid', ['lamp'])
+        index.set_wants('bob', ['bike'])
+        index.set_wants('cid', ['guitar'])
+        index.set_wants('ana', ['lamp'])
+        self.assertEqual(index.matches('ana'), [])
+        scored = best_cycles(index)
+        self.assertEqual([cycle for score, cycle in scored], [['ana', 'bob', 'cid']])
+
+class TradeCycleTest(TestCase):
+
+    def testStoreAndOffer(self):
+        ana = make_member('ana', 'guitar')
+        bob = make_member('bob', 'bike')
+        cid = make_member('cid', 'lamp')
+        make_listing(ana, 'Lamp', 'lamp')
+        make_listing(bob, 'Guitar', 'guitar')
+        make_listing(cid, 'Bike', 'bike')
+        index = build_index()
+
+        scored = best_cycles(index, max_length=3)
+        self.assertEqual(store_cycles(index, scored), len(scored))
+        self.assertEqual(store_cycles(index, scored), 0)
+
+        # ana gives cid the lamp, cid gives bob the bike, bob gives ana the guitar
+        proposal = TradeCycle.objects.get(members_key='%i-%i-%i' % (ana.pk, cid.pk, bob.pk))
+        root = proposal.create_offers()
+        offers = Offer.objects.filter(pk=root.pk) | root.children.all()
+        self.assertEqual(offers.count(), 3)
+        self.assertEqual(TradeCycle.objects.get(pk=proposal.pk).status, 'offered')
+
+class OfferThreadTest(TestCase):
+
+    def setUp(self):
+        self.ana = make_member('ana', '')
+        self.bob = make_member('bob', '')
+        self.cid = make_member('cid', '')
+        self.first = Offer.objects.create(from_member=self.ana, to_member=self.bob, status='pending')
+        self.counter = Offer.objects.create(from_member=self.bob, to_member=self.ana,
+            status='pending', parent=self.first)
+        self.last = Offer.objects.create(from_member=self.ana, to_member=self.bob,
+            status='pending', parent=self.counter)
+        self.other = Offer.objects.create(from_member=self.cid, to_member=self.ana, status='pending')
+
+    def testThread(self):
+        last = Offer.objects.get(pk=self.last.pk)
+        self.assertEqual(last.thread_id, self.first.pk)
+        self.assertEqual(last.depth, 2)
+        with self.assertNumQueries(1):
+            thread = list(last.get_thread())
+        self.assertEqual(thread, [self.first, self.counter, self.last])
+
+    def testLatest(self):
+        with self.assertNumQueries(1):
+            latest = list(latest_offers(self.ana))
+        self.assertEqual(sorted([o.pk for o in latest]), [self.last.pk, self.other.pk])
+        self.assertEqual([o.pk for o in latest_offers(self.bob)], [self.last.pk])
+        self.assertEqual(self.first.latest_in_thread(), self.last)
+
+    def testCounts(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(thread_count(self.ana), 2)
+        with self.assertNumQueries(1):
+            counts = thread_counts([self.ana.pk, self.bob.pk, self.cid.pk])
+        self.assertEqual(counts, {self.ana.pk : 2, self.bob.pk : 1, self.cid.pk : 1})
+
+    def testRebuild(self):
+        Offer.objects.update(thread=None, depth=0, is_latest=True)
+        rebuild_offer_threads()
+        last = Offer.objects.get(pk=self.last.pk)
+        self.assertEqual((last.thread_id, last.depth, last.is_latest), (self.first.pk, 2, True))
+        self.failIf(Offer.objects.get(pk=self.counter.pk).is_latest)
+
+def counters(member):
+    member = Member.objects.get(pk=member.pk)
+    return (member.unread_offers, member.pending_received_offers, member.pending_sent_offers)
+
+class OfferBoxTest(TestCase):
+
+    def setUp(self):
+        self.ana = make_member('ana', '')
+        self.bob = make_member('bob', '')
+        self.offers = [Offer.objects.create(from_member=self.ana, to_member=self.bob,
+            status='pending') for i in range(0, 5)]
+
+    def testCounters(self):
+        self.assertEqual(counters(self.bob), (5, 5, 0))
+        self.assertEqual(counters(self.ana), (0, 0, 5))
+
+        offer = Offer.objects.get(pk=self.offers[0].pk)
+        offer.mark_read()
+        offer.mark_read()
+        Offer.objects.get(pk=offer.pk).mark_read()
+        self.assertEqual(counters(self.bob), (4, 5, 0))
+
+        offer = Offer.objects.get(pk=self.offers[1].pk)
+        offer.status = 'accepted'
+        offer.save()
+        self.assertEqual(counters(self.bob), (4, 4, 0))
+        self.assertEqual(counters(self.ana), (0, 0, 4))
+
+        Offer.objects.get(pk=self.offers[2].pk).delete()
+        self.assertEqual(counters(self.bob), (3, 3, 0))
+
+    def testMemberSaveKeepsCounters(self):
+        member = Member.objects.get(pk=self.bob.pk)
+        Offer.objects.create(from_member=self.ana, to_member=self.bob, status='pending')
+        member.save()
+        self.assertEqual(counters(self.bob), (6, 6, 0))
+
+    def testRebuild(self):
+        Offer.objects.get(pk=self.offers[0].pk).mark_read()
+        Member.objects.update(unread_offers=0, pending_received_offers=0, pending_sent_offers=0)
+        self.assertEqual(rebuild_offer_counters(), 2)
+        self.assertEqual(counters(self.bob), (4, 5, 0))
+        self.assertEqual(counters(self.ana), (0, 0, 5))
+
+    def testPages(self):
+        seen = []
+        before = None
+        while True:
+            with self.assertNumQueries(1):
+                page, before = inbox(self.bob, before=before, size=2)
+            seen.extend([o.pk for o in page])
+            self.failUnless(len(page) <= 2)
+            if before is None:
+                break
+        self.assertEqual(seen, sorted([o.pk for o in self.offers], reverse=True))
+        self.assertEqual(inbox(self.ana), ([], None))
+        self.assertEqual(len(outbox(self.ana, status='pending')[0]), 5)
+        self.assertEqual(outbox(self.ana, status='accepted'), ([], None))
+
+class OfferStatusTest(TestCase):
+
+    def setUp(self):
+        self.ana = make_member('ana', '')
+        self.bob = make_member('bob', '')
+        self.offer = Offer.objects.create(from_member=self.ana, to_member=self.bob)
+
+    def testTransitions(self):
+        self.assertEqual(self.offer.status, 'pending')
+        self.offer.change_status('accepted')
+        self.assertEqual(counters(self.ana), (0, 0, 0))
+        self.offer.change_status('confirmed')
+        self.assertEqual(Offer.objects.get(pk=self.offer.pk).status, 'confirmed')
+        self.assertRaises(Offer.InvalidTransition, self.offer.change_status, 'cancelled')
+
+        offer = Offer.objects.get(pk=self.offer.pk)
+        offer.status = 'pending'
+        self.assertRaises(Offer.InvalidTransition, offer.save)
+
+    def testChangedMeanwhile(self):
+        stale = Offer.objects.get(pk=self.offer.pk)
+        self.offer.change_status('cancelled')
+        self.assertRaises(Offer.InvalidTransition, stale.change_status, 'accepted')
+        self.assertEqual(Offer.objects.get(pk=self.offer.pk).status, 'cancelled')
+
+    def testCounterOffer(self):
+        Offer.objects.create(from_member=self.bob, to_member=self.ana, parent=self.offer)
+        self.assertEqual(Offer.objects.get(pk=self.offer.pk).status, 'countered')
+        self.assertEqual(counters(self.ana), (1, 1, 0))
+        self.assertEqual(counters(self.bob), (1, 0, 1))
+        notices = OfferNotice.objects.filter(offer=self.offer).order_by('pk')
+        self.assertEqual([(n.member_id, n.status) for n in notices],
+            [(self.bob.pk, 'pending'), (self.ana.pk, 'countered')])
+
+    def testExpire(self):
+        old = [Offer.objects.create(from_member=self.ana, to_member=self.bob) for i in range(0, 4)]
+        old[0].change_status('accepted')
+        old[1].change_status('cancelled')
+        Offer.objects.filter(pk__in=[o.pk for o in old]).update(
+            update_time=datetime.now() - timedelta(days=40))
+
+        self.assertEqual(expire_offers(days=30, batch_size=1), 3)
+        self.assertEqual(Offer.objects.filter(status='expired').count(), 3)
+        self.assertEqual(Offer.objects.get(pk=self.offer.pk).status, 'pending')
+        self.assertEqual(OfferNotice.objects.filter(status='expired').count(), 6)
+        self.assertEqual(expire_offers(days=30), 0)
+
+        rebuilt = counters(self.bob)
+        rebuild_offer_counters()
+        self.assertEqual(counters(self.bob), rebuilt)
+
+    def testExpireSkipsTouched(self):
+        cutoff = datetime.now() - timedelta(days=30)
+        # selected as older than the cutoff, then updated before the lock
+        self.assertEqual(transition_offers([self.offer.pk], 'pending', 'expired',
+            updated_before=cutoff), 0)
+        self.assertEqual(Offer.objects.get(pk=self.offer.pk).status, 'pending')
+        self.assertEqual(counters(self.bob), (1, 1, 0))
+
+    def testSendNotices(self):
+        self.offer.change_status('accepted')
+        self.assertEqual(send_notices(batch_size=1), 2)
+        self.assertEqual(sorted([m.to[0] for m in mail.outbox]),
+            ['ana@example.com', 'bob@example.com'])
+        self.assertEqual(send_notices(), 0)
@@ -0,0 +1,7 @@
+from django.conf.urls.defaults import *
+
+urlpatterns = patterns('',
+    url(r'^recibidas/$', 'trade.transaction.views.offer_inbox', name='offer_inbox'),
+    url(r'^enviadas/$', 'trade.transaction.views.offer_outbox', name='offer_outbox'),
+    url(r'^(?P<offer_id>\d+)/$', 'trade.transaction.views.offer_detail', name='offer_detail'),
+)
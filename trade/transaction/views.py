@@ -0,0 +1,56 @@
+from django.contrib.auth.decorators import login_required
+from django.template import RequestContext
+from django.shortcuts import render_to_response, get_object_or_404
+from django.http import Http404, HttpResponseRedirect
+from django.core.urlresolvers import reverse
+
+from trade.member.models import member_for_user
+from trade.transaction.models import Offer, inbox, outbox
+
+def _offer_list(request, box, template):
+    try:
+        member = member_for_user(request.user)
+    except:
+        return HttpResponseRedirect(reverse('account_login'))
+
+    status = request.GET.get('status') or None
+    offers, next_page = box(member, status=status, before=request.GET.get('before'))
+
+    data = {
+        'member': member,
+        'offers': offers,
+        'status': status,
+        'next_page': next_page,
+    }
+    return render_to_response(template, data,
+        context_instance=RequestContext(request))
+
+@login_required
+def offer_inbox(request):
+    return _offer_list(request, inbox, 'transaction/inbox.html')
+
+@login_required
+def offer_outbox(request):
+    return _offer_list(request, outbox, 'transaction/outbox.html')
+
+@login_required
+def offer_detail(request, offer_id):
+    try:
+        member = member_for_user(request.user)
+    except:
+        return HttpResponseRedirect(reverse('account_login'))
+
+    offer = get_object_or_404(Offer.objects.select_related('from_member__user',
+        'to_member__user'), pk=offer_id)
+    if member.pk not in (offer.from_member_id, offer.to_member_id):
+        raise Http404
+    if offer.to_member_id == member.pk and not offer.is_read:
+        offer.mark_read()
+
+    data = {
+        'member': member,
+        'offer': offer,
+        'thread': offer.get_thread().select_related('from_member__user', 'to_member__user'),
+    }
+    return render_to_response('transaction/detail.html', data,
+        context_instance=RequestContext(request))
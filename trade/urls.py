@@ -25,6 +25,8 @@ urlpatterns = patterns('',
     (r'^registro/', include('registration.urls')),
     (r'^articulos/', include('product.urls')),
     (r'^cuenta/', include('member.urls')),
+    (r'^ofertas/', include('transaction.urls')),
+    (r'^cache/', include('caching.urls')),
     (r'^admin/', include(admin.site.urls)),
 )
 
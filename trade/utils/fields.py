@@ -1,6 +1,7 @@
 import re
 
 from django import forms
+from django.db import IntegrityError, transaction
 from django.db.models import SlugField
 from django.utils.translation import ugettext as _
 from django.template.defaultfilters import slugify as dj_slugify
@@ -40,34 +41,66 @@ class AutoSlugField(SlugField):
         cls = instance._meta.get_field_by_name(self.attname)[1]
         if not cls:
             cls = instance.__class__
-        proposal = getattr(instance, self.attname)
+        current = getattr(instance, self.attname)
+        proposal = current
         if not self.editable or not proposal:
             proposal = slugify(getattr(instance, self.prepopulate_from))
             if not proposal: # field only contained non-numeric chars
                 proposal = 'zzz'
+
+        others = cls._default_manager.all()
         if instance.pk:
-            similar_ones = cls.objects.filter(**{self.attname + "__startswith": proposal}).exclude(pk=instance.pk).values(self.attname)
-        else:
-            similar_ones = cls.objects.filter(**{self.attname + "__startswith": proposal}).values(self.attname)
-        similar_ones = [elem[self.attname] for elem in similar_ones]
-        if proposal not in similar_ones:
+            others = others.exclude(pk=instance.pk)
+
+        if current and self._numbered(proposal, current) is not None \
+                and not self._taken(others, current):
+            # keep the number this instance already has
+            slug = current
+        elif not self._taken(others, proposal):
             slug = proposal
         else:
-            numbers = []
-            for value in similar_ones:
-                match = re.match(r'^%s%s(\d+)$' % (proposal, self.separator), value)
-                if match:
-                    numbers.append(int(match.group(1)))
-            if len(numbers)==0:
-                slug = "%s%s2" % (proposal, self.separator)
-            else:
-                largest = sorted(numbers)[-1]
-                slug = "%s%s%d" % (proposal, self.separator, largest + 1)
-
-        assert( slug not in similar_ones)
+            slug = self._allocate(cls, others, proposal)
+
         setattr(instance, self.attname, slug)
         return slug
 
+    def _taken(self, others, slug):
+        return others.filter(**{self.attname: slug}).exists()
+
+    def _numbered(self, proposal, slug):
+        """The suffix of ``slug`` as a numbered variant of ``proposal``, 1 for
+        ``proposal`` itself, None otherwise."""
+        if slug == proposal:
+            return 1
+        match = re.match(r'^%s%s(\d+)$' % (re.escape(proposal), re.escape(self.separator)), slug)
+        if match:
+            return int(match.group(1))
+        return None
+
+    def _allocate(self, cls, others, proposal):
+        """The next free numbered slug for ``proposal``, from a counter
+        instead of the similar slugs.  Numbers taken by hand are skipped
+        with one indexed lookup each."""
+        from trade.utils.models import next_slug_number
+
+        key = '%s.%s.%s' % (cls._meta.app_label, cls._meta.object_name, self.attname)
+
+        def seed():
+            # first allocation for this base: start above the slugs that
+            # already exist, the only time they are scanned
+            similar = others.filter(**{self.attname + "__startswith": proposal}).values_list(
+                self.attname, flat=True)
+            numbers = [self._numbered(proposal, value) for value in similar]
+            return max([n for n in numbers if n is not None] + [1])
+
+        while True:
+            number = next_slug_number(key, proposal, seed)
+            if number < 2:
+                continue
+            slug = "%s%s%d" % (proposal, self.separator, number)
+            if not self._taken(others, slug):
+                return slug
+
     def formfield(self, **kwargs):
         # max_length and error_message can be overridden 
         kwargs['max_length'] = kwargs.get('max_length', self.max_length) 
@@ -90,6 +123,64 @@ class AutoSlugField(SlugField):
         return 'varchar(%s)' % self.max_length
 
 
+class SlugRetryMixin(object):
+    """
+    Saves again with a new slug when a concurrent save took the one
+    AutoSlugField allocated, and the unique constraint refused it.  Every
+    attempt starts from the slugs the instance had before saving, so a
+    retry allocates the next number of the same base instead of numbering
+    the slug that was taken.
+    """
+
+    slug_retries = 3
+
+    def save(self, *args, **kwargs):
+        # the savepoints only work inside a transaction, which nothing in
+        # the save may commit: outside of one, the slug counter and the
+        # row are saved in a transaction of their own
+        managed = transaction.is_managed()
+        if managed:
+            return self._save_retrying(*args, **kwargs)
+
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            result = self._save_retrying(*args, **kwargs)
+            transaction.commit()
+            return result
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            transaction.leave_transaction_management()
+
+    def _save_retrying(self, *args, **kwargs):
+        original = dict([(field.attname, getattr(self, field.attname))
+            for field in self._meta.fields if isinstance(field, AutoSlugField)])
+        for attempt in range(0, self.slug_retries):
+            sid = transaction.savepoint()
+            try:
+                result = super(SlugRetryMixin, self).save(*args, **kwargs)
+                transaction.savepoint_commit(sid)
+                return result
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                if attempt == self.slug_retries - 1 or not self._slug_taken():
+                    raise
+                for attname, value in original.items():
+                    setattr(self, attname, value)
+
+    def _slug_taken(self):
+        for field in self._meta.fields:
+            if isinstance(field, AutoSlugField):
+                others = self.__class__._default_manager.filter(
+                    **{field.attname: getattr(self, field.attname)})
+                if self.pk:
+                    others = others.exclude(pk=self.pk)
+                if others.exists():
+                    return True
+        return False
+
 class TagSelectFormField(forms.MultipleChoiceField):
     def clean(self, value):
         return ', '.join(['"%s"' % tag for tag in value ])
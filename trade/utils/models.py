@@ -0,0 +1,48 @@
+from django.db import models, transaction
+from django.db.models import F
+
+class SlugCounter(models.Model):
+    """The highest suffix handed out for a base slug of one field, so
+    AutoSlugField finds the next free slug without scanning the others.
+    ``last`` is 1 once the bare base slug is taken."""
+
+    field = models.CharField(max_length=100)
+    base = models.CharField(max_length=255)
+    last = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('field', 'base'),)
+
+    def __unicode__(self):
+        return u'%s: %s (%i)' % (self.field, self.base, self.last)
+
+def next_slug_number(field, base, seed):
+    """Increment and return the counter of ``base``, creating it from
+    ``seed()`` the first time.
+
+    The increment and the read run in one transaction: the UPDATE locks
+    the counter row until it ends, so no other save can move the counter
+    between them.  Inside a transaction already managed by the caller that
+    one is used, and not committed here, so it is safe under the caller's
+    savepoints; SlugRetryMixin always saves inside one."""
+    managed = transaction.is_managed()
+    if not managed:
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+    try:
+        counters = SlugCounter.objects.filter(field=field, base=base)
+        if not counters.update(last=F('last') + 1):
+            SlugCounter.objects.get_or_create(field=field, base=base,
+                defaults={'last' : seed()})
+            counters.update(last=F('last') + 1)
+        number = counters.values_list('last', flat=True)[0]
+        if not managed:
+            transaction.commit()
+        return number
+    except:
+        if not managed:
+            transaction.rollback()
+        raise
+    finally:
+        if not managed:
+            transaction.leave_transaction_management()